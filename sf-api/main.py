@@ -1,21 +1,53 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import FileResponse
+from fastapi import Depends, FastAPI, Header, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, HTMLResponse, RedirectResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from simple_salesforce import Salesforce
+from simple_salesforce.exceptions import (SalesforceExpiredSession, SalesforceMalformedRequest,
+                                           SalesforceRefusedRequest, SalesforceResourceNotFound)
+from simple_salesforce.util import exception_handler
 from dotenv import load_dotenv
 import openpyxl
 from copy import copy as style_copy
-from openpyxl.utils import get_column_letter
+from functools import lru_cache
+from openpyxl.utils import get_column_letter, column_index_from_string
+import atexit
 import base64
+import contextvars
+import hashlib
+import hmac
 import datetime
 import os
 import json
 import html
 import io
+import queue
 import re # re is already imported but consistent with request
 import requests
 import os
+import subprocess
+import tempfile
 import datetime # existing import is just 'import datetime', user snippet uses 'from datetime import datetime' but we can adapt or just import what's needed.
+import threading
+import urllib.parse
+import time
+import unicodedata
+import uuid
+import zipfile
+import zlib
+from bisect import bisect_left
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from concurrent.futures import ThreadPoolExecutor
+from itertools import groupby
+from typing import Annotated, Literal, Optional
+from xml.sax.saxutils import escape as xml_escape
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles.numbers import BUILTIN_FORMATS_REVERSE, BUILTIN_FORMATS_MAX_SIZE
+from openpyxl.styles.cell_style import StyleArray
+from openpyxl.worksheet.merge import MergedCellRange
+from openpyxl.worksheet.cell_range import CellRange
+from openpyxl.writer.excel import ExcelWriter
 # existing imports...
 
 # Load environment variables
@@ -44,77 +76,3015 @@ URL_CREATE = "https://service.base.vn/extapi/v1/ticket/create"
 URL_EDIT_CUSTOM = "https://service.base.vn/extapi/v1/ticket/edit.custom.fields"
 
 
-app = FastAPI(title="Salesforce Packing List API")
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Fail at startup on a broken output storage configuration (e.g. OUTPUT_STORAGE=s3 without
+    boto3), and with PDF_PREWARM=1 start the PDF workers with the API instead of at the first
+    conversion.
+    """
+    output_storage()
+    if PDF_PREWARM:
+        threading.Thread(target=lambda: pdf_converter().start(), name="pdf-prewarm", daemon=True).start()
+    yield
+
+
+app = FastAPI(title="Salesforce Packing List API", lifespan=lifespan)
+
+# Add CORS Middleware
+from fastapi.middleware.cors import CORSMiddleware
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],  # Allows all origins
+    allow_credentials=True,
+    allow_methods=["*"],  # Allows all methods
+    allow_headers=["*"],  # Allows all headers
+)
+
+class ShipmentRequest(BaseModel):
+    shipment_id: str
+
+# ================= API AUTH =================
+# Endpoints that change or expose Salesforce data beyond the documents a request generated
+# require the API_KEY (X-API-Key header, or Authorization: Bearer). They are disabled while
+# API_KEY is not set.
+API_KEY = os.getenv('API_KEY', '')
+SALESFORCE_ID_RE = re.compile(r"^[a-zA-Z0-9]{15}(?:[a-zA-Z0-9]{3})?$")
+
+
+def api_key_valid(x_api_key: Optional[str], authorization: Optional[str]) -> bool:
+    """Whether a request carries the API_KEY"""
+    if not API_KEY:
+        return False
+    supplied = x_api_key
+    if not supplied and authorization and authorization.lower().startswith("bearer "):
+        supplied = authorization[7:].strip()
+    return bool(supplied) and hmac.compare_digest(supplied.encode("utf-8"), API_KEY.encode("utf-8"))
+
+
+def require_api_key(x_api_key: Annotated[Optional[str], Header()] = None,
+                    authorization: Annotated[Optional[str], Header()] = None) -> None:
+    """Dependency of the endpoints that need the API_KEY"""
+    if not API_KEY:
+        raise HTTPException(status_code=403, detail="This endpoint is disabled (API_KEY is not set)")
+    if not api_key_valid(x_api_key, authorization):
+        raise HTTPException(status_code=401, detail="Invalid or missing API key",
+                            headers={"WWW-Authenticate": "Bearer"})
+
+
+def is_salesforce_id(value: str) -> bool:
+    """15 or 18 character Salesforce record Id"""
+    return bool(value) and SALESFORCE_ID_RE.match(value) is not None
+
+# ================= TABLE EXPANSION ENGINE =================
+# All table growth for a sheet is planned up front and applied in one pass over
+# ws._cells, the row dimensions and the merged ranges, instead of one
+# insert_rows + unmerge/re-merge round per table.
+
+def row_mapper(shifts):
+    """
+    Build the row mapping for a set of row shifts without touching any sheet.
+
+    Args:
+        shifts: Iterable of (anchor_row, delta), as for shift_rows
+
+    Returns:
+        Function mapping an original row number to its new row number (None if removed)
+    """
+    shifts = sorted((anchor, delta) for anchor, delta in shifts if delta)
+    anchors = [anchor for anchor, _ in shifts]
+    offsets = []
+    total = 0
+    for _, delta in shifts:
+        total += delta
+        offsets.append(total)
+
+    def row_map(r):
+        if r is None:
+            return None
+        i = bisect_left(anchors, r)
+        if i == 0:
+            return r
+        anchor, delta = shifts[i - 1]
+        if delta < 0 and r <= anchor - delta:
+            return None
+        return r + offsets[i - 1]
+
+    return row_map
+
+
+def shift_rows(ws, shifts):
+    """
+    Insert and/or delete rows at several anchors in a single pass.
+
+    Args:
+        ws: Worksheet
+        shifts: Iterable of (anchor_row, delta). delta > 0 opens delta empty rows below
+            anchor_row, delta < 0 removes the -delta rows below anchor_row.
+            Deleted ranges must not overlap other anchors.
+
+    Returns:
+        Function mapping an original row number to its new row number (None if removed)
+    """
+    shifts = [(anchor, delta) for anchor, delta in shifts if delta]
+    row_map = row_mapper(shifts)
+    if not shifts:
+        return row_map
+
+    # Cells (including MergedCell placeholders) keep their objects and styles
+    new_cells = {}
+    for (r, c), cell in ws._cells.items():
+        new_r = row_map(r)
+        if new_r is None:
+            continue
+        cell.row = new_r
+        new_cells[(new_r, c)] = cell
+    ws._cells = new_cells
+
+    # Row heights move with their rows
+    dims = list(ws.row_dimensions.items())
+    ws.row_dimensions.clear()
+    for r, dim in dims:
+        new_r = row_map(r)
+        if new_r is None:
+            continue
+        dim.index = new_r
+        ws.row_dimensions[new_r] = dim
+
+    # Merged ranges: shifted when below an anchor, stretched when spanning one
+    ranges = []
+    for mr in ws.merged_cells.ranges:
+        kept = [row_map(r) for r in (mr.min_row, mr.max_row)]
+        if None in kept:
+            kept = [x for x in (row_map(r) for r in range(mr.min_row, mr.max_row + 1)) if x is not None]
+            if not kept:
+                continue
+        mr.min_row, mr.max_row = kept[0], kept[-1]
+        ranges.append(mr)
+    ws.merged_cells.ranges = set(ranges)
+
+    return row_map
+
+
+def relocate_block(ws, top, bottom, delta, min_col=1, max_col=None):
+    """
+    Move a rectangular block of rows by delta rows in one operation.
+
+    Cells (values and styles), merged ranges lying inside the block and the row heights of
+    top..bottom all move together. Whatever sits where the block lands is replaced and the
+    rows it leaves behind are empty.
+
+    Args:
+        ws: Worksheet
+        top, bottom: First and last row of the block
+        delta: Rows to move by (positive = down)
+        min_col, max_col: Column span of the block (defaults to the whole sheet width)
+    """
+    if not delta or bottom < top:
+        return
+    max_col = max_col or ws.max_column
+
+    def in_block(r, c):
+        return top <= r <= bottom and min_col <= c <= max_col
+
+    moved = [(key, cell) for key, cell in ws._cells.items() if in_block(*key)]
+    for key, _ in moved:
+        del ws._cells[key]
+    for (r, c), cell in moved:
+        cell.row = r + delta
+        ws._cells[(r + delta, c)] = cell
+
+    dims = [(r, ws.row_dimensions.pop(r)) for r in range(top, bottom + 1) if r in ws.row_dimensions]
+    for r, dim in dims:
+        dim.index = r + delta
+        ws.row_dimensions[r + delta] = dim
+
+    ranges = []
+    for mr in ws.merged_cells.ranges:
+        if in_block(mr.min_row, mr.min_col) and in_block(mr.max_row, mr.max_col):
+            mr.min_row += delta
+            mr.max_row += delta
+        ranges.append(mr)
+    ws.merged_cells.ranges = set(ranges)
+
+
+def clone_row(ws, template_row, target_rows, copy_values=False, max_col=None):
+    """Copy the styles (and optionally values) and height of template_row onto target_rows."""
+    max_col = max_col or ws.max_column
+    template_cells = []
+    for col in range(1, max_col + 1):
+        cell = ws._cells.get((template_row, col))
+        if cell is not None and (cell.has_style or (copy_values and cell.value is not None)):
+            template_cells.append((col, cell))
+    row_height = ws.row_dimensions[template_row].height if template_row in ws.row_dimensions else None
+
+    for r in target_rows:
+        for col, src in template_cells:
+            dst = ws.cell(row=r, column=col)
+            dst.value = src.value if copy_values else None
+            if src.has_style:
+                dst._style = style_copy(src._style)
+        if row_height is not None:
+            ws.row_dimensions[r].height = row_height
+
+
+# cell attribute -> (workbook style collection, StyleArray field)
+STYLE_ID_FIELDS = {
+    'font': ('_fonts', 'fontId'),
+    'fill': ('_fills', 'fillId'),
+    'border': ('_borders', 'borderId'),
+    'alignment': ('_alignments', 'alignmentId'),
+    'protection': ('_protections', 'protectionId'),
+}
+
+
+def intern_style(wb, number_format=None, **parts):
+    """
+    Register style parts with the workbook once so they can be applied by id.
+
+    Args:
+        wb: Workbook
+        number_format: Optional number format string
+        **parts: font / fill / border / alignment / protection objects
+
+    Returns:
+        {StyleArray field: id} for apply_style_ids
+    """
+    ids = {}
+    for name, value in parts.items():
+        collection, field = STYLE_ID_FIELDS[name]
+        ids[field] = getattr(wb, collection).add(value)
+    if number_format is not None:
+        fmt_id = BUILTIN_FORMATS_REVERSE.get(number_format)
+        if fmt_id is None:
+            fmt_id = wb._number_formats.add(number_format) + BUILTIN_FORMATS_MAX_SIZE
+        ids['numFmtId'] = fmt_id
+    return ids
+
+
+def apply_style_ids(cells, ids):
+    """Apply interned style ids to many cells without building or hashing style objects per cell."""
+    items = tuple(ids.items())
+    for cell in cells:
+        style = cell._style
+        if style is None:
+            style = cell._style = StyleArray()
+        for field, value in items:
+            setattr(style, field, value)
+
+
+def copy_style_ids(src, dst, parts=('font', 'fill', 'border', 'alignment', 'protection', 'number_format')):
+    """Copy the chosen style parts of src (a cell or a saved StyleArray) onto dst by id (same workbook)."""
+    src_style = getattr(src, '_style', src) or StyleArray()
+    if dst._style is None:
+        dst._style = StyleArray()
+    for part in parts:
+        field = 'numFmtId' if part == 'number_format' else STYLE_ID_FIELDS[part][1]
+        setattr(dst._style, field, getattr(src_style, field))
+
+
+def expand_rows(ws, plan, copy_values=False):
+    """
+    Grow several single-row templates in one pass.
+
+    Args:
+        ws: Worksheet
+        plan: Iterable of (template_row, n); each template row ends up repeated n times
+        copy_values: Also copy template values (placeholders) into the new rows
+
+    Returns:
+        Row mapping function from shift_rows (original row -> new row)
+    """
+    plan = [(row, n) for row, n in plan if row]
+    max_col = ws.max_column
+    row_map = shift_rows(ws, [(row, n - 1) for row, n in plan if n > 1])
+    for row, n in plan:
+        if n > 1:
+            new_row = row_map(row)
+            clone_row(ws, new_row, range(new_row + 1, new_row + n), copy_values, max_col)
+    return row_map
+
+
+def find_tag_rows(ws, tags):
+    """Find the first row containing each tag with one scan of the sheet. Returns {tag: row}."""
+    found = {}
+    pending = list(tags)
+    for row in ws.iter_rows():
+        for cell in row:
+            if cell.value and isinstance(cell.value, str):
+                for tag in pending:
+                    if tag in cell.value and tag not in found:
+                        found[tag] = cell.row
+        if len(found) == len(pending):
+            break
+    return found
+
+
+def expand_tag_tables(ws, tables):
+    """
+    Locate tag-marked template rows and grow them all in one pass.
+
+    Args:
+        ws: Worksheet
+        tables: List of (start_tag, row_count)
+
+    Returns:
+        {start_tag: first table row after expansion, or None if the tag is missing}
+    """
+    tag_rows = find_tag_rows(ws, [tag for tag, _ in tables])
+    for tag, _ in tables:
+        if tag not in tag_rows:
+            print(f"Warning: Table tags {tag} not found.")
+    row_map = expand_rows(ws, [(tag_rows[tag], n) for tag, n in tables if tag in tag_rows], copy_values=True)
+    return {tag: (row_map(tag_rows[tag]) if tag in tag_rows else None) for tag, _ in tables}
+
+
+def expand_items_table(ws, template_row, n, total_row=None):
+    """Expand the items table to accommodate n rows"""
+    expand_rows(ws, [(template_row, n)])
+    update_items_totals(ws, template_row, n, total_row)
+
+def update_items_totals(ws, template_row, n, total_row=None):
+    """
+    Point the Total row formulas at the n item rows starting at template_row.
+    total_row is the Total row after expansion; it is looked up on the sheet when not given.
+    """
+    total_header_row = total_row or find_items_total_row(ws, template_row)
+    
+    if total_header_row is None:
+        raise ValueError("Total row not found")
+    
+    first_data_row = template_row
+    last_data_row = template_row + n - 1
+    ws[f"H{total_header_row}"] = f"=SUM(H{first_data_row}:H{last_data_row})"
+    ws[f"J{total_header_row}"] = f"=SUM(J{first_data_row}:J{last_data_row})"
+    ws[f"K{total_header_row}"] = f"=COUNTA(K{first_data_row}:K{last_data_row})"
+
+# ================= TEMPLATE ANCHORS =================
+# Layout positions that are found by their text (Total rows, signature rows, section
+# labels, ...) are resolved once per template file and cached. Generators shift them
+# through their table growth with row_mapper instead of scanning the rendered sheet.
+_TEMPLATE_ANCHOR_CACHE = {}
+
+
+def template_anchors(template_path, sheet_name, finders):
+    """
+    Resolve named layout anchors on the untouched template, cached until the file changes.
+
+    Args:
+        template_path: Template file
+        sheet_name: Sheet to inspect (falls back to the active sheet)
+        finders: {anchor name: function(ws) -> row, rows or None}
+
+    Returns:
+        {anchor name: finder result}
+    """
+    key = (str(template_path), sheet_name, tuple(sorted(finders)))
+    mtime = os.path.getmtime(template_path)
+    cached = _TEMPLATE_ANCHOR_CACHE.get(key)
+    if cached and cached[0] == mtime:
+        return cached[1]
+
+    wb = openpyxl.load_workbook(template_path)
+    ws = wb[sheet_name] if sheet_name in wb.sheetnames else wb.active
+    anchors = {name: finder(ws) for name, finder in finders.items()}
+    _TEMPLATE_ANCHOR_CACHE[key] = (mtime, anchors)
+    return anchors
+
+
+def find_items_total_row(ws, template_row=None):
+    """Row of the "Total" line below the ContainerItems table"""
+    if template_row is None:
+        template_row = find_tag_rows(ws, ["{{TableStart:ContainerItems}}"]).get("{{TableStart:ContainerItems}}")
+        if template_row is None:
+            return None
+    for r in range(template_row + 1, ws.max_row + 1):
+        if ws.cell(row=r, column=1).value == "Total":
+            return r
+    return None
+
+
+def find_pi_summary_rows(ws):
+    """
+    (Subtotal row, last Total row below it) of a PI/quote template, or (None, None).
+    Placeholders are ignored so field names like Total_Price_USD__c don't count.
+    """
+    start_row = None
+    end_row = None
+    for r in range(1, ws.max_row + 1):
+        row_text_u = ""
+        for c in range(1, 15):
+            val = ws.cell(row=r, column=c).value
+            if val:
+                row_text_u += re.sub(r"\{\{.*?\}\}", "", str(val)).upper()
+        if "SUBTOTAL" in row_text_u or "SUB TOTAL" in row_text_u or "SUB-TOTAL" in row_text_u:
+            if start_row is None:
+                start_row = r
+        if ("TOTAL" in row_text_u and "SUB" not in row_text_u) or "TỔNG CỘNG" in row_text_u or "GRAND TOTAL" in row_text_u:
+            if start_row is not None and r > start_row:
+                end_row = r
+    return start_row, end_row
+
+
+def find_po_signature_rows(ws):
+    """Rows holding the "Người soạn lệnh" / "Ngọc Bích" sign-off of a production order template"""
+    rows = []
+    for row in ws.iter_rows():
+        for cell in row:
+            if cell.value and isinstance(cell.value, str):
+                val_upper = cell.value.strip().upper()
+                if "NGƯỜI SOẠN LỆNH" in val_upper or "NGƯỜI SOAN LỆNH" in val_upper or "NGỌC BÍCH" in val_upper:
+                    rows.append(cell.row)
+                    break
+    return rows
+
+
+def find_po_total_row(ws):
+    """Row of the "TỔNG CỘNG" line (column D) of a production order template"""
+    total_row = None
+    for r in range(1, ws.max_row + 1):
+        val = ws.cell(row=r, column=4).value
+        if val and "TỔNG CỘNG" in str(val).upper():
+            total_row = r
+    return total_row
+
+
+def find_case_feedback_rows(ws):
+    """Supply-department feedback label rows (Nội dung / Nguyên nhân / Kết luận) without an AI summary cell"""
+    rows = []
+    for row in ws.iter_rows():
+        values = [str(c.value) for c in row if c.value]
+        lowered = [v.lower() for v in values]
+        if any("nội dung:" in v or "nguyên nhân:" in v or "kết luận và hướng xử lý:" in v for v in lowered) \
+                and not any("{{summary}}" in v for v in lowered):
+            rows.append(row[0].row)
+    return rows
+
+
+def find_case_supply_header_row(ws):
+    """Row of the "PHẢN HỒI TỪ BỘ PHẬN CUNG ỨNG" section header"""
+    for row in ws.iter_rows():
+        for cell in row:
+            if isinstance(cell.value, str) and "PHẢN HỒI TỪ BỘ PHẬN CUNG ỨNG" in cell.value:
+                return cell.row
+    return None
+
+
+PACKING_LIST_ANCHORS = {"items_total": find_items_total_row}
+PI_TABLE_TAGS = [
+    "{{TableStart:ContractProduct2}}",
+    "{{TableStart:PISurcharge}}",
+    "{{TableStart:PIDeposit}}",
+    "{{TableStart:PIDiscount}}",
+]
+PI_ANCHORS = {"summary": find_pi_summary_rows, "table_rows": lambda ws: find_tag_rows(ws, PI_TABLE_TAGS)}
+PO_ANCHORS = {
+    "table_row": lambda ws: find_tag_rows(ws, ["{{TableStart:ProPlanProduct}}"]).get("{{TableStart:ProPlanProduct}}"),
+    "total_row": find_po_total_row,
+    "signatures": find_po_signature_rows,
+}
+CASE_ANCHORS = {"feedback_rows": find_case_feedback_rows, "supply_header": find_case_supply_header_row}
+
+
+# ================= MERGED RANGE INDEX =================
+class MergedRangeIndex:
+    """
+    Row-bucketed index over a worksheet's merged ranges.
+
+    Looking up the merge covering a cell, or the merges overlapping a block, only visits
+    the ranges registered on the rows involved instead of every merge on the sheet.
+    Merge and unmerge through the index so it stays in sync with the worksheet.
+    """
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.rows = {}  # row -> set of merged ranges touching that row
+        for mr in ws.merged_cells.ranges:
+            self._register(mr)
+
+    def _register(self, mr):
+        for r in range(mr.min_row, mr.max_row + 1):
+            self.rows.setdefault(r, set()).add(mr)
+
+    def _unregister(self, mr):
+        for r in range(mr.min_row, mr.max_row + 1):
+            bucket = self.rows.get(r)
+            if bucket is not None:
+                bucket.discard(mr)
+
+    def find(self, row, col):
+        """Return the merged range covering (row, col), or None"""
+        for mr in self.rows.get(row, ()):
+            if mr.min_col <= col <= mr.max_col:
+                return mr
+        return None
+
+    def overlapping(self, min_row, min_col, max_row, max_col):
+        """Return the merged ranges overlapping the block, top-left first"""
+        found = set()
+        for r in range(min_row, max_row + 1):
+            for mr in self.rows.get(r, ()):
+                if mr.min_col <= max_col and mr.max_col >= min_col:
+                    found.add(mr)
+        return sorted(found, key=lambda mr: mr.bounds)
+
+    def contains(self, cr):
+        """Check whether cr lies inside an existing merged range"""
+        return any(cr <= mr for mr in self.rows.get(cr.min_row, ()))
+
+    def add(self, mcr):
+        """Register an already-built MergedCellRange with the worksheet and the index (same rules as ws.merge_cells)"""
+        if not self.contains(mcr):
+            self.ws.merged_cells.ranges.add(mcr)
+            self._register(mcr)
+        self.ws._clean_merge_range(mcr)
+
+    def merge(self, start_row, start_column, end_row, end_column):
+        """Merge a block, like ws.merge_cells"""
+        cr = CellRange(min_col=start_column, min_row=start_row, max_col=end_column, max_row=end_row)
+        mcr = MergedCellRange(self.ws, cr.coord)
+        self.add(mcr)
+        return mcr
+
+    def unmerge(self, mr):
+        """Remove a merged range returned by find/overlapping, like ws.unmerge_cells"""
+        self.ws.merged_cells.ranges.discard(mr)
+        self._unregister(mr)
+        cells = mr.cells
+        next(cells)  # keep the top-left cell
+        for row, col in cells:
+            self.ws._cells.pop((row, col), None)
+
+
+# ================= RUN-LENGTH MERGE ENGINE =================
+def value_runs(values):
+    """
+    Split per-row values into runs of equal consecutive values.
+
+    Returns:
+        List of (offset, length, value)
+    """
+    runs = []
+    offset = 0
+    for value, group in groupby(values):
+        length = sum(1 for _ in group)
+        runs.append((offset, length, value))
+        offset += length
+    return runs
+
+
+def merge_runs(ws, start_row, values, columns, fit_height=False, index=None):
+    """
+    Merge every run of equal consecutive values down the given columns in one batch.
+
+    Args:
+        ws: Worksheet
+        start_row: Sheet row holding values[0]
+        values: One value per table row; runs of equal values get merged
+        columns: {column index: Alignment for the merged cell}; the first column drives fit_height
+        fit_height: Grow row heights so each run's text fits (adjust_row_height_for_merged_cell)
+        index: MergedRangeIndex of ws to keep up to date (a throwaway one is built if omitted)
+
+    Returns:
+        List of (first_row, last_row, value) for every merged run
+    """
+    runs = [(start_row + offset, start_row + offset + length - 1, value)
+            for offset, length, value in value_runs(values) if length > 1]
+    if not runs:
+        return runs
+
+    index = index or MergedRangeIndex(ws)
+    for col in columns:
+        letter = get_column_letter(col)
+        for top, bottom, _ in runs:
+            index.add(MergedCellRange(ws, f"{letter}{top}:{letter}{bottom}"))
+
+    for col, alignment in columns.items():
+        if alignment is not None:
+            apply_style_ids((ws.cell(row=top, column=col) for top, _, _ in runs),
+                            intern_style(ws.parent, alignment=alignment))
+
+    if fit_height:
+        height_col = next(iter(columns))
+        fit_merged_row_heights(ws, [(top, bottom, height_col, value) for top, bottom, value in runs], index=index)
+    return runs
+
+
+# ================= TEXT LAYOUT =================
+# Row heights are fitted from real glyph advance widths (1/1000 em, chars 32-126) of the
+# fonts the templates use. Vietnamese letters are measured by their base letter.
+_GLYPH_WIDTHS = {
+    "times new roman": dict(zip(map(chr, range(32, 127)), (
+        250, 333, 408, 500, 500, 833, 778, 180, 333, 333, 500, 564, 250, 333, 250, 278,
+        500, 500, 500, 500, 500, 500, 500, 500, 500, 500, 278, 278, 564, 564, 564, 444, 921,
+        722, 667, 667, 722, 611, 556, 722, 722, 333, 389, 722, 611, 889,
+        722, 722, 556, 722, 667, 556, 611, 722, 722, 944, 722, 722, 611,
+        333, 278, 333, 469, 500, 333,
+        444, 500, 444, 500, 444, 333, 500, 500, 278, 278, 500, 278, 778,
+        500, 500, 500, 500, 333, 389, 278, 500, 500, 722, 500, 500, 444,
+        480, 200, 480, 541))),
+    "calibri": dict(zip(map(chr, range(32, 127)), (
+        226, 326, 401, 498, 507, 715, 682, 221, 303, 303, 498, 498, 250, 306, 252, 386,
+        507, 507, 507, 507, 507, 507, 507, 507, 507, 507, 268, 268, 498, 498, 498, 463, 894,
+        579, 544, 533, 615, 488, 459, 631, 623, 252, 319, 520, 420, 855,
+        646, 662, 517, 673, 543, 459, 487, 642, 567, 890, 519, 487, 468,
+        307, 386, 307, 498, 498, 291,
+        479, 525, 423, 525, 498, 305, 471, 525, 230, 239, 455, 230, 799,
+        525, 527, 525, 525, 349, 391, 335, 525, 452, 715, 433, 453, 395,
+        314, 460, 314, 498))),
+}
+_BOLD_WIDTH_FACTOR = 1.05
+# Excel column width unit = max digit width of the default font (Calibri 11: 7px)
+_COLUMN_UNIT_PT = 7 * 0.75
+_COLUMN_PADDING_PT = 5 * 0.75
+
+
+def glyph_table_key(font_name) -> str:
+    """Glyph table used for a font name (unknown fonts are measured as Calibri)"""
+    name = (font_name or "").lower()
+    return "times new roman" if "times" in name else "calibri"
+
+
+@lru_cache(maxsize=65536)
+def word_width_em(word: str, table_key: str) -> float:
+    """Advance width of a word in em, diacritics measured by their base letter"""
+    table = _GLYPH_WIDTHS[table_key]
+    fallback = table["n"]
+    total = 0
+    for ch in unicodedata.normalize("NFD", word.replace("đ", "d").replace("Đ", "D")):
+        width = table.get(ch)
+        if width is None:
+            if unicodedata.combining(ch):
+                continue
+            width = 1000 if unicodedata.east_asian_width(ch) in ("W", "F") else fallback
+        total += width
+    return total / 1000
+
+
+def wrapped_line_count(text: str, width_pt: float, table_key: str, size: float, bold=False) -> int:
+    """Lines Excel needs to show text word-wrapped in a cell width_pt wide"""
+    scale = size * (_BOLD_WIDTH_FACTOR if bold else 1)
+    width_em = max(width_pt, 1) / scale
+    space = word_width_em(" ", table_key)
+    total = 0
+    for paragraph in str(text).replace("\r", "").split("\n"):
+        lines, used = 1, 0.0
+        for word in paragraph.split(" "):
+            w = word_width_em(word, table_key)
+            if used and used + space + w > width_em:
+                lines += 1
+                used = 0.0
+            elif used:
+                w += space
+            if w > width_em:
+                # A word longer than the cell breaks at the cell edge
+                extra = int(-(-w // width_em)) - 1
+                lines += extra
+                used = w - extra * width_em
+            else:
+                used += w
+        total += lines
+    return total
+
+
+def wrapped_line_counts(texts, widths_pt, fonts):
+    """
+    Wrapped line counts for many cells in one pass.
+
+    Args:
+        texts: Cell texts
+        widths_pt: Usable width of each cell in points
+        fonts: (name, size, bold) of each cell
+
+    Returns:
+        List of line counts, in input order
+    """
+    return [wrapped_line_count(text, width, glyph_table_key(name), size or 11, bold)
+            for text, width, (name, size, bold) in zip(texts, widths_pt, fonts)]
+
+
+def column_widths_pt(ws):
+    """Function giving the usable text width in points of a column span of ws"""
+    default = ws.sheet_format.defaultColWidth or 8.43
+    widths = {}
+    for dim in ws.column_dimensions.values():
+        if dim.width and dim.min:
+            for col in range(dim.min, (dim.max or dim.min) + 1):
+                widths[col] = dim.width
+
+    def span(min_col, max_col):
+        total = sum(widths.get(col, default) * _COLUMN_UNIT_PT + _COLUMN_PADDING_PT
+                    for col in range(min_col, max_col + 1))
+        return total - _COLUMN_PADDING_PT
+    return span
+
+
+def text_line_counts(ws, cells, texts, index=None):
+    """
+    Wrapped line counts of texts placed in ws cells, using each cell's font and
+    the full width of the merged range it belongs to.
+
+    Args:
+        ws: Worksheet
+        cells: (row, column) of each text
+        texts: Text shown in each cell
+        index: Optional MergedRangeIndex of ws
+
+    Returns:
+        List of line counts, in input order
+    """
+    index = index or MergedRangeIndex(ws)
+    span = column_widths_pt(ws)
+    widths, fonts = [], []
+    for row, col in cells:
+        merged = index.find(row, col)
+        widths.append(span(merged.min_col, merged.max_col) if merged is not None else span(col, col))
+        font = ws.cell(row=row, column=col).font
+        fonts.append((font.name, font.sz, font.b))
+    return wrapped_line_counts(texts, widths, fonts)
+
+
+# ================= PRE-EXPANDED TEMPLATE BUCKETS =================
+# Item tables are compiled into variants that already hold this many styled rows.
+# Rendering loads the smallest bucket that fits and deletes the spare rows, which is
+# much cheaper than inserting and restyling rows. Set to an empty string to disable.
+TEMPLATE_ROW_BUCKETS = tuple(sorted(
+    int(b) for b in os.getenv('TEMPLATE_ROW_BUCKETS', '10,50,200,1000').split(',') if b.strip()
+))
+
+
+def get_compiled_template_directory() -> Path:
+    """
+    Get the directory holding compiled template variants.
+    Use /tmp for serverless environments, templates/compiled for local development.
+    """
+    if is_serverless_environment():
+        compiled_dir = Path("/tmp") / "compiled_templates"
+    else:
+        compiled_dir = Path("templates") / "compiled"
+    compiled_dir.mkdir(parents=True, exist_ok=True)
+    return compiled_dir
+
+
+def compile_template_bucket(template_path, tables, bucket: int) -> Path:
+    """
+    Build a variant of the template whose tag tables are pre-expanded to `bucket` rows.
+    Variants are reused until the source template changes.
+
+    Args:
+        template_path: Source template
+        tables: List of (sheet_name, start_tag); sheet falls back to the active sheet
+        bucket: Number of table rows in the variant
+
+    Returns:
+        Path of the compiled variant
+    """
+    template_path = Path(template_path)
+    target = get_compiled_template_directory() / f"{template_path.stem}__rows{bucket}.xlsx"
+    # A truncated file (no zip directory) is rebuilt
+    if (target.exists() and target.stat().st_mtime >= template_path.stat().st_mtime
+            and zipfile.is_zipfile(target)):
+        return target
+
+    wb = openpyxl.load_workbook(template_path)
+    for sheet_name, start_tag in tables:
+        ws = wb[sheet_name] if sheet_name in wb.sheetnames else wb.active
+        table_row = find_tag_rows(ws, [start_tag]).get(start_tag)
+        if table_row is None:
+            raise ValueError(f"Table tag {start_tag} not found in {template_path}")
+        expand_rows(ws, [(table_row, bucket)])
+
+    # Write to a private file first so concurrent requests never load a half-written variant
+    tmp_path = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    wb.save(tmp_path)
+    os.replace(tmp_path, target)
+    print(f"✓ Compiled {bucket}-row variant of {template_path.name}")
+    return target
+
+
+def load_template_tables(template_path, tables, n: int):
+    """
+    Load a template whose tag tables already hold n styled rows each.
+    Picks the smallest pre-expanded bucket that fits and deletes the spare rows.
+
+    Args:
+        template_path: Source template
+        tables: List of (sheet_name, start_tag); sheet falls back to the active sheet
+        n: Number of table rows needed
+
+    Returns:
+        (wb, [(ws, table_row)], expanded) - expanded is False when no bucket was used and the
+        caller still has to expand the tables itself; table_row is None if the tag is missing
+    """
+    n = max(n, 1)
+    bucket = next((b for b in TEMPLATE_ROW_BUCKETS if b >= n), None) if n > 1 else None
+    source = template_path
+    if bucket is not None:
+        try:
+            source = compile_template_bucket(template_path, tables, bucket)
+        except Exception as e:
+            print(f"⚠ Warning: Could not compile {bucket}-row variant of {template_path}: {e}")
+            bucket = None
+
+    try:
+        wb = openpyxl.load_workbook(source)
+    except Exception as e:
+        if bucket is None:
+            raise
+        # A damaged variant would otherwise be reused until the template changes
+        print(f"⚠ Warning: Could not load {source}, using {template_path}: {e}")
+        Path(source).unlink(missing_ok=True)
+        wb, bucket = openpyxl.load_workbook(template_path), None
+    sheets = []
+    for sheet_name, start_tag in tables:
+        ws = wb[sheet_name] if sheet_name in wb.sheetnames else wb.active
+        sheets.append((ws, find_tag_rows(ws, [start_tag]).get(start_tag)))
+    if bucket is None or any(table_row is None for _, table_row in sheets):
+        return wb, sheets, False
+
+    if bucket > n:
+        for ws, table_row in sheets:
+            shift_rows(ws, [(table_row + n - 1, n - bucket)])
+    return wb, sheets, True
+
+
+def load_template_for_rows(template_path, sheet_name: str, start_tag: str, n: int):
+    """
+    Load a template whose tag table already holds n styled rows (single-table load_template_tables).
+
+    Returns:
+        (wb, ws, table_row, expanded)
+    """
+    wb, [(ws, table_row)], expanded = load_template_tables(template_path, [(sheet_name, start_tag)], n)
+    return wb, ws, table_row, expanded
+
+
+def copy_sheet_to_workbook(src, wb, title):
+    """
+    Copy a worksheet into another workbook: values, styles, dimensions, merges and print setup.
+    The copy is not a selected tab and has no print area (tables grow past it).
+    Used when compiling multi-sheet templates, never per request.
+    """
+    ws = wb.create_sheet(title)
+    style_ids = {}  # source StyleArray -> interned ids in wb
+    for row in src.iter_rows():
+        for cell in row:
+            new_cell = ws.cell(row=cell.row, column=cell.column, value=cell.value)
+            if cell.has_style:
+                key = tuple(cell._style)
+                if key not in style_ids:
+                    style_ids[key] = intern_style(
+                        wb, number_format=cell.number_format, font=style_copy(cell.font),
+                        fill=style_copy(cell.fill), border=style_copy(cell.border),
+                        alignment=style_copy(cell.alignment), protection=style_copy(cell.protection),
+                    )
+                apply_style_ids([new_cell], style_ids[key])
+
+    for key, dim in src.column_dimensions.items():
+        new_dim = ws.column_dimensions[key]
+        new_dim.min, new_dim.max = dim.min, dim.max
+        new_dim.width, new_dim.hidden = dim.width, dim.hidden
+        new_dim.outlineLevel, new_dim.collapsed = dim.outlineLevel, dim.collapsed
+    for idx, dim in src.row_dimensions.items():
+        new_dim = ws.row_dimensions[idx]
+        new_dim.height, new_dim.hidden = dim.height, dim.hidden
+        new_dim.outlineLevel, new_dim.collapsed = dim.outlineLevel, dim.collapsed
+    for mr in src.merged_cells.ranges:
+        ws.merge_cells(mr.coord)
+
+    for attr in ('page_margins', 'print_options', 'sheet_format', 'sheet_properties', 'views', 'HeaderFooter'):
+        setattr(ws, attr, style_copy(getattr(src, attr)))
+    for attr, value in vars(src.page_setup).items():
+        if attr not in ('_parent', 'id'):
+            setattr(ws.page_setup, attr, value)
+    # Only the first sheet is selected, otherwise Excel opens the sheets grouped
+    for view in ws.views.sheetView:
+        view.tabSelected = False
+    ws.freeze_panes = src.freeze_panes
+    if src.print_title_rows:
+        ws.print_title_rows = src.print_title_rows
+    if src.print_title_cols:
+        ws.print_title_cols = src.print_title_cols
+    return ws
+
+
+def compile_combined_template(sheets) -> Path:
+    """
+    Build (once per template change) a multi-sheet template out of single-sheet templates.
+
+    Args:
+        sheets: List of (template_path, sheet_name, title) in output order
+
+    Returns:
+        Path of the combined template
+    """
+    sources = [Path(path) for path, _, _ in sheets]
+    target = get_compiled_template_directory() / ("+".join(p.stem for p in sources) + ".xlsx")
+    if (target.exists() and target.stat().st_mtime >= max(p.stat().st_mtime for p in sources)
+            and zipfile.is_zipfile(target)):
+        return target
+
+    (first_path, first_sheet, first_title), rest = sheets[0], sheets[1:]
+    wb = openpyxl.load_workbook(first_path)
+    ws = wb[first_sheet] if first_sheet in wb.sheetnames else wb.active
+    for other in [sheet for sheet in wb.worksheets if sheet is not ws]:
+        wb.remove(other)
+    ws.title = first_title
+    # The template's fixed print area would cut off the expanded item table
+    ws.print_area = None
+    for path, sheet_name, title in rest:
+        src_wb = openpyxl.load_workbook(path)
+        copy_sheet_to_workbook(src_wb[sheet_name] if sheet_name in src_wb.sheetnames else src_wb.active, wb, title)
+
+    tmp_path = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    wb.save(tmp_path)
+    os.replace(tmp_path, target)
+    print(f"✓ Compiled combined template {target.name}")
+    return target
+
+
+# ================= CACHED FORMULA VALUES =================
+# Totals are written as formulas together with their result (<v>), so viewers and parsers
+# that don't recalculate still see them. Only SUM/COUNTA over a plain range of values are
+# computed here; anything else is left for Excel to recalculate.
+_AGGREGATE_FORMULA_RE = re.compile(r'^=(SUM|COUNTA)\(\$?([A-Z]{1,3})\$?(\d+):\$?([A-Z]{1,3})\$?(\d+)\)$', re.I)
+
+
+class CachedFormula:
+    """A formula cell value with its result; result may be a function evaluated at write time"""
+
+    def __init__(self, formula, result):
+        self.formula = formula
+        self.result = result
+
+    def value(self):
+        return self.result() if callable(self.result) else self.result
+
+
+class TableAggregates:
+    """
+    Running SUM/COUNTA per column of table rows ({column: value} dicts) as they are iterated.
+    An empty table keeps the template row, whose cells aren't seen here, so it gets no result.
+    """
+
+    def __init__(self, rows):
+        self.rows = rows
+        self.row_count = 0
+        self.sums = {}
+        self.counts = {}
+
+    def __iter__(self):
+        for row in self.rows:
+            self.row_count += 1
+            for col, value in row.items():
+                add_aggregate_value(self.sums, self.counts, col, value)
+            yield row
+
+    def formula(self, func, col, first_row, last_row):
+        """CachedFormula for =func(col first_row:col last_row) over the iterated rows"""
+        letter = get_column_letter(col)
+        totals = self.sums if func == "SUM" else self.counts
+        result = lambda: totals.get(col, 0) if self.row_count else None
+        return CachedFormula(f"={func}({letter}{first_row}:{letter}{last_row})", result)
+
+
+def add_aggregate_value(sums, counts, key, value):
+    """Fold one cell value into SUM (numbers only, as Excel) and COUNTA (non-empty) totals"""
+    if value is None or value == "":
+        return
+    counts[key] = counts.get(key, 0) + 1
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        sums[key] = sums.get(key, 0) + value
+
+
+def formula_result_text(value) -> str:
+    """<v> text of a cached formula result"""
+    if value is None:
+        return ""
+    if isinstance(value, float):
+        # Excel keeps 15 significant digits
+        value = float(f"{value:.15g}")
+        return str(int(value)) if value.is_integer() else repr(value)
+    return str(value)
+
+
+def aggregate_formula_value(ws, formula):
+    """Result of a SUM/COUNTA formula over ws values, or None when it can't be computed here"""
+    m = _AGGREGATE_FORMULA_RE.match(formula)
+    if not m:
+        return None
+    func, c1, r1, c2, r2 = m.groups()
+    min_col, max_col = sorted((column_index_from_string(c1.upper()), column_index_from_string(c2.upper())))
+    min_row, max_row = sorted((int(r1), int(r2)))
+    sums, counts = {}, {}
+    cells = ws._cells
+    for r in range(min_row, max_row + 1):
+        for c in range(min_col, max_col + 1):
+            cell = cells.get((r, c))
+            if cell is None:
+                continue
+            value = cell.value
+            if cell.data_type == "f" or isinstance(value, (datetime.date, datetime.time, datetime.timedelta)):
+                return None
+            add_aggregate_value(sums, counts, 0, value)
+    return sums.get(0, 0) if func.upper() == "SUM" else counts.get(0, 0)
+
+
+def formula_cache_values(ws):
+    """{cell reference: result} for the formulas of ws that can be computed here"""
+    values = {}
+    for (r, c), cell in ws._cells.items():
+        if cell.data_type == "f" and isinstance(cell.value, str):
+            result = aggregate_formula_value(ws, cell.value)
+            if result is not None:
+                values[f"{get_column_letter(c)}{r}"] = result
+    return values
+
+
+def fill_cached_formula_values(sheet_xml, values) -> str:
+    """Fill the empty <v> of the formula cells in values ({cell reference: result}) of a sheet part"""
+    def fill(m):
+        ref = m.group(1)
+        if ref not in values:
+            return m.group(0)
+        return f'{m.group(0)[:m.start(2) - m.start(0)]}<v>{formula_result_text(values[ref])}</v></c>'
+    return re.sub(r'<c r="([A-Z]+\d+)"[^>]*><f>[^<]*</f>(<v></v>|<v\s*/>)</c>', fill, sheet_xml)
+
+
+# ================= OUTPUT OPTIMIZATION =================
+# Generated workbooks are rewritten once before upload: unused cell styles, fonts, fills,
+# borders and shared strings are dropped, empty unstyled cells, broken defined names and
+# calcChain/thumbnail parts are removed, and the zip is written at XLSX_COMPRESS_LEVEL
+# (1 = fastest, 9 = smallest). OPTIMIZE_OUTPUT=0 keeps openpyxl's output as is.
+OPTIMIZE_OUTPUT = os.getenv('OPTIMIZE_OUTPUT', '1').lower() not in ('0', 'false', 'no')
+XLSX_COMPRESS_LEVEL = int(os.getenv('XLSX_COMPRESS_LEVEL', '6'))
+
+_SHEET_PART_RE = re.compile(r'^xl/worksheets/sheet\d+\.xml$')
+
+
+def _xml_items(block, tag):
+    """Child elements <tag .../> or <tag ...>...</tag> of an XML fragment, in order"""
+    return re.findall(rf'<{tag}\b[^>]*/>|<{tag}\b[^>]*>.*?</{tag}>', block, re.S)
+
+
+def _set_count(open_tag, count):
+    """Opening tag with its count attribute set"""
+    if 'count="' in open_tag:
+        return re.sub(r'\bcount="\d+"', f'count="{count}"', open_tag, count=1)
+    return open_tag.replace('>', f' count="{count}">', 1)
+
+
+def prune_empty_cells(sheet_xml) -> str:
+    """Drop value-less cells without a style where neither the row nor the column is styled"""
+    styled_cols = set()
+    for attrs in re.findall(r'<col\b([^>]*)/?>', sheet_xml):
+        style = re.search(r'\bstyle="(\d+)"', attrs)
+        if style and style.group(1) != "0":
+            lo = int(re.search(r'\bmin="(\d+)"', attrs).group(1))
+            hi = int(re.search(r'\bmax="(\d+)"', attrs).group(1))
+            styled_cols.update(range(lo, hi + 1))
+
+    def empty_cell(m):
+        return '' if _ooxml_col_index(m.group(1)) not in styled_cols else m.group(0)
+
+    def row(m):
+        attrs, inner = m.group(1), m.group(2) or ''
+        if 'customFormat="1"' not in attrs:
+            inner = re.sub(r'<c r="([A-Z]+)\d+"(?: s="0")?(?: t="(?:n|inlineStr)")?(?:/>|></c>)', empty_cell, inner)
+        if inner:
+            return f'<row{attrs}>{inner}</row>'
+        # Rows without cells only matter when they carry a height or style
+        return '' if re.fullmatch(r' r="\d+"(?: spans="[\d:]+")?', attrs) else f'<row{attrs}/>'
+    return re.sub(r'<row\b([^>]*?)(?:/>|>(.*?)</row>)', row, sheet_xml, flags=re.S)
+
+
+def prune_styles(styles_xml, sheets):
+    """
+    Keep only the cell formats used by the sheets, and the fonts, fills and borders those
+    formats use. Returns (styles_xml, sheets) with renumbered style references.
+    """
+    m = re.search(r'(<cellXfs\b[^>]*>)(.*?)(</cellXfs>)', styles_xml, re.S)
+    if not m:
+        return styles_xml, sheets
+    xfs = _xml_items(m.group(2), 'xf')
+    used = {0}
+    for xml in sheets.values():
+        used.update(int(i) for i in re.findall(r'<(?:c|row)\b[^>]*?\ss="(\d+)"', xml))
+        used.update(int(i) for i in re.findall(r'<col\b[^>]*?\sstyle="(\d+)"', xml))
+    kept = sorted(i for i in used if i < len(xfs))
+    if len(kept) < len(xfs):
+        xf_map = {old: new for new, old in enumerate(kept)}
+        remap = lambda m: f'{m.group(1)}{xf_map.get(int(m.group(2)), 0)}{m.group(3)}'
+        sheets = {name: re.sub(r'(<col\b[^>]*?\sstyle=")(\d+)(")', remap,
+                               re.sub(r'(<(?:c|row)\b[^>]*?\ss=")(\d+)(")', remap, xml))
+                  for name, xml in sheets.items()}
+        xfs = [xfs[i] for i in kept]
+        styles_xml = (styles_xml[:m.start()] + _set_count(m.group(1), len(xfs)) + ''.join(xfs)
+                      + m.group(3) + styles_xml[m.end():])
+
+    # Fonts, fills and borders referenced by the remaining cell formats and the cell styles
+    for kind, tag, attr, required in (('fonts', 'font', 'fontId', {0}), ('fills', 'fill', 'fillId', {0, 1}),
+                                      ('borders', 'border', 'borderId', {0})):
+        block = re.search(rf'(<{kind}\b[^>]*>)(.*?)(</{kind}>)', styles_xml, re.S)
+        if not block:
+            continue
+        items = _xml_items(block.group(2), tag)
+        xf_blocks = [b for b in re.finditer(r'<(cellXfs|cellStyleXfs)\b[^>]*>.*?</\1>', styles_xml, re.S)]
+        used = set(required)
+        for b in xf_blocks:
+            used.update(int(i) for i in re.findall(rf'\b{attr}="(\d+)"', b.group(0)))
+        kept = sorted(i for i in used if i < len(items))
+        if len(kept) == len(items):
+            continue
+        id_map = {old: new for new, old in enumerate(kept)}
+        new_block = _set_count(block.group(1), len(kept)) + ''.join(items[i] for i in kept) + block.group(3)
+        styles_xml = styles_xml[:block.start()] + new_block + styles_xml[block.end():]
+        styles_xml = re.sub(r'<(cellXfs|cellStyleXfs)\b[^>]*>.*?</\1>',
+                            lambda b: re.sub(rf'(\b{attr}=")(\d+)(")',
+                                             lambda a: f'{a.group(1)}{id_map.get(int(a.group(2)), 0)}{a.group(3)}',
+                                             b.group(0)),
+                            styles_xml, flags=re.S)
+    return styles_xml, sheets
+
+
+def prune_shared_strings(sst_xml, sheets):
+    """Keep only the shared strings the sheets use. Returns (sst_xml, sheets)."""
+    m = re.search(r'(<sst\b[^>]*>)(.*?)(</sst>)', sst_xml, re.S)
+    if not m:
+        return sst_xml, sheets
+    cell_re = r'(<c\b[^>]*?\bt="s"[^>]*>\s*<v>)(\d+)(</v>)'
+    refs = [int(i) for xml in sheets.values() for _, i, _ in re.findall(cell_re, xml)]
+    items = _xml_items(m.group(2), 'si')
+    kept = sorted(i for i in set(refs) if i < len(items))
+    if len(kept) < len(items):
+        sst_map = {old: new for new, old in enumerate(kept)}
+        remap = lambda c: f'{c.group(1)}{sst_map.get(int(c.group(2)), 0)}{c.group(3)}'
+        sheets = {name: re.sub(cell_re, remap, xml) for name, xml in sheets.items()}
+    open_tag = re.sub(r'\buniqueCount="\d+"', f'uniqueCount="{len(kept)}"', _set_count(m.group(1), len(refs)), count=1)
+    sst_xml = sst_xml[:m.start()] + open_tag + ''.join(items[i] for i in kept) + m.group(3) + sst_xml[m.end():]
+    return sst_xml, sheets
+
+
+def optimize_xlsx_parts(parts) -> dict:
+    """Apply the output optimizations to {part name: bytes} of a workbook"""
+    dropped = [name for name in parts if name == 'xl/calcChain.xml' or name.startswith('docProps/thumbnail')]
+    for name in dropped:
+        del parts[name]
+    for name in ('[Content_Types].xml', '_rels/.rels', 'xl/_rels/workbook.xml.rels'):
+        if name in parts and dropped:
+            xml = parts[name].decode('utf-8')
+            xml = re.sub(r'<(?:Override|Relationship)\b[^>]*(?:calcChain|thumbnail)[^>]*/>', '', xml)
+            parts[name] = xml.encode('utf-8')
+
+    sheets = {name: prune_empty_cells(data.decode('utf-8')) for name, data in parts.items()
+              if _SHEET_PART_RE.match(name)}
+    if 'xl/styles.xml' in parts:
+        styles_xml, sheets = prune_styles(parts['xl/styles.xml'].decode('utf-8'), sheets)
+        parts['xl/styles.xml'] = styles_xml.encode('utf-8')
+    if 'xl/sharedStrings.xml' in parts:
+        sst_xml, sheets = prune_shared_strings(parts['xl/sharedStrings.xml'].decode('utf-8'), sheets)
+        parts['xl/sharedStrings.xml'] = sst_xml.encode('utf-8')
+    for name, xml in sheets.items():
+        parts[name] = xml.encode('utf-8')
+
+    if 'xl/workbook.xml' in parts:
+        xml = parts['xl/workbook.xml'].decode('utf-8')
+        xml = re.sub(r'<definedName\b[^>]*>[^<]*#REF![^<]*</definedName>', '', xml)
+        xml = re.sub(r'<definedNames>\s*</definedNames>|<definedNames/>', '', xml)
+        parts['xl/workbook.xml'] = xml.encode('utf-8')
+    return parts
+
+
+def write_xlsx(parts, part_values=None, optimize=True):
+    """
+    Build an xlsx from workbook parts, filling cached formula values and optimizing.
+
+    Args:
+        parts: {part name: bytes}, in archive order
+        part_values: {sheet part name: {cell reference: result}} for fill_cached_formula_values
+        optimize: Apply the output optimizations
+
+    Returns:
+        (xlsx bytes, {"xml_bytes_before", "xml_bytes_after", "file_bytes"})
+    """
+    xml_before = sum(len(data) for data in parts.values())
+    for name, values in (part_values or {}).items():
+        if name in parts:
+            parts[name] = fill_cached_formula_values(parts[name].decode('utf-8'), values).encode('utf-8')
+    if optimize:
+        parts = optimize_xlsx_parts(parts)
+
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED, allowZip64=True) as zf:
+        for name, data in parts.items():
+            zf.writestr(name, data, compresslevel=XLSX_COMPRESS_LEVEL)
+    data = buffer.getvalue()
+    return data, {"xml_bytes_before": xml_before, "xml_bytes_after": sum(len(d) for d in parts.values()),
+                  "file_bytes": len(data)}
+
+
+def _report_optimization(label, before_bytes, stats, started):
+    print(f"✓ Optimized {label}: {before_bytes:,} -> {stats['file_bytes']:,} bytes, "
+          f"XML {stats['xml_bytes_before']:,} -> {stats['xml_bytes_after']:,} "
+          f"({(datetime.datetime.now() - started).total_seconds() * 1000:.0f} ms)")
+
+
+def optimize_xlsx(data: bytes, label="workbook") -> bytes:
+    """Optimize xlsx bytes written by another engine"""
+    started = datetime.datetime.now()
+    with zipfile.ZipFile(io.BytesIO(data)) as zf:
+        parts = {info.filename: zf.read(info) for info in zf.infolist()}
+    optimized, stats = write_xlsx(parts)
+    _report_optimization(label, len(data), stats, started)
+    return optimized
+
+
+def workbook_bytes(wb, label="workbook") -> bytes:
+    """
+    Serialize wb in memory, with cached results for the SUM/COUNTA formulas computed here and,
+    unless OPTIMIZE_OUTPUT is off, optimized (compressed once, at XLSX_COMPRESS_LEVEL).
+    In preview mode nothing is serialized; PreviewReady carries the filled values instead.
+    """
+    if preview_active():
+        raise PreviewReady(workbook_preview(wb))
+
+    part_values = {}
+    # openpyxl writes worksheets as xl/worksheets/sheet{n}.xml in workbook order
+    for idx, ws in enumerate(wb.worksheets, start=1):
+        values = formula_cache_values(ws)
+        if values:
+            part_values[f"xl/worksheets/sheet{idx}.xml"] = values
+    buffer = io.BytesIO()
+    if not part_values and not OPTIMIZE_OUTPUT:
+        wb.save(buffer)
+        return buffer.getvalue()
+
+    started = datetime.datetime.now()
+    # openpyxl writes uncompressed into memory; the parts are compressed once in write_xlsx
+    wb.properties.modified = datetime.datetime.now(tz=datetime.timezone.utc).replace(tzinfo=None)
+    ExcelWriter(wb, zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED, allowZip64=True)).save()
+    with zipfile.ZipFile(buffer) as zf:
+        parts = {info.filename: zf.read(info) for info in zf.infolist()}
+    data, stats = write_xlsx(parts, part_values, OPTIMIZE_OUTPUT)
+    if OPTIMIZE_OUTPUT:
+        _report_optimization(label, buffer.getbuffer().nbytes, stats, started)
+    return data
+
+
+def save_workbook(wb, file_path) -> bytes:
+    """Write wb to file_path now (see workbook_bytes). Returns the file bytes."""
+    data = workbook_bytes(wb, os.path.basename(str(file_path)))
+    write_output_file(file_path, data)
+    return data
+
+
+# ================= IN-MEMORY OUTPUT =================
+# Rendered documents stay in memory: the bytes go straight to the Salesforce upload, and
+# /download serves a small cache of recent renders. Writing the file to the output directory
+# is a side effect set by OUTPUT_WRITE: async (default), sync, or off (default on serverless,
+# where the output directory is only /tmp).
+# Streamed renders (?stream=true) are never held as bytes: they are written to a spooled
+# temporary file (in memory up to RENDER_SPOOL_MB, then on disk) that the upload, the output
+# storage and /download read in chunks. The last SPOOLED_RENDERS_KEPT of them are kept for /download.
+OUTPUT_WRITE = os.getenv('OUTPUT_WRITE', '').lower()
+RECENT_RENDERS_MAX_BYTES = int(os.getenv('RECENT_RENDERS_MAX_MB', '64')) * 1024 * 1024
+RENDER_SPOOL_BYTES = int(os.getenv('RENDER_SPOOL_MB', '1')) * 1024 * 1024
+RENDER_CHUNK_BYTES = 256 * 1024
+SPOOLED_RENDERS_KEPT = int(os.getenv('SPOOLED_RENDERS_KEPT', '8'))
+
+_RECENT_RENDERS = OrderedDict()
+_RECENT_RENDERS_LOCK = threading.Lock()
+_OUTPUT_WRITER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="output-writer")
+_SPOOLED_RENDERS = OrderedDict()
+
+
+class RenderedFile:
+    """
+    A rendered document in a SpooledTemporaryFile. Written like a file while rendering, then
+    finish(); after that it supports len(), contiguous slices (data[a:b]) and chunked reads from
+    several threads. The temporary file is removed with the last reference.
+    """
+
+    def __init__(self):
+        self._file = tempfile.SpooledTemporaryFile(max_size=RENDER_SPOOL_BYTES)
+        self._lock = threading.Lock()
+        self._size = 0
+        self.version = uuid.uuid4().hex
+
+    # Writing (zipfile needs write, tell, seek and flush)
+    def write(self, data):
+        return self._file.write(data)
+
+    def tell(self):
+        return self._file.tell()
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        return self._file.seek(offset, whence)
+
+    def flush(self):
+        self._file.flush()
+
+    def finish(self) -> "RenderedFile":
+        """End of rendering; returns self"""
+        self._size = self._file.seek(0, io.SEEK_END)
+        return self
+
+    # Reading
+    def __len__(self):
+        return self._size
+
+    def __bool__(self):
+        # A file object, even while empty (zipfile tests "if not fp")
+        return True
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        with self._lock:
+            self._file.seek(offset)
+            return self._file.read(max(0, min(size, self._size - offset)))
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice) or key.step not in (None, 1):
+            raise TypeError("RenderedFile supports contiguous slices only")
+        start, stop, _ = key.indices(self._size)
+        return self.read_at(start, stop - start)
+
+    def chunks(self, start=0, end=None, chunk_bytes=RENDER_CHUNK_BYTES):
+        """Bytes start..end (exclusive) in chunks"""
+        end = self._size if end is None else end
+        for offset in range(start, end, chunk_bytes):
+            yield self.read_at(offset, min(chunk_bytes, end - offset))
+
+    def reader(self) -> "RenderedFileReader":
+        """Seekable read-only file object with its own position"""
+        return RenderedFileReader(self)
+
+
+class RenderedFileReader(io.RawIOBase):
+    """File object over a RenderedFile (for zipfile and boto3)"""
+
+    def __init__(self, rendered: RenderedFile):
+        self._rendered = rendered
+        self._position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self._position, io.SEEK_END: len(self._rendered)}[whence]
+        self._position = max(0, base + offset)
+        return self._position
+
+    def readinto(self, buffer):
+        data = self._rendered.read_at(self._position, len(buffer))
+        buffer[:len(data)] = data
+        self._position += len(data)
+        return len(data)
+
+
+def open_output(data):
+    """Seekable file object over file bytes or a RenderedFile"""
+    return data.reader() if isinstance(data, RenderedFile) else io.BytesIO(data)
+
+
+def output_chunks(data):
+    """File bytes or a RenderedFile as a sequence of byte chunks"""
+    return data.chunks() if isinstance(data, RenderedFile) else (data,)
+
+
+def output_write_mode() -> str:
+    """"async", "sync" or "off" """
+    if OUTPUT_WRITE in ('async', 'sync', 'off'):
+        return OUTPUT_WRITE
+    if is_serverless_environment():
+        # /tmp isn't shared between instances; an object store is, but must be written before
+        # the function is frozen
+        return 'sync' if OUTPUT_STORAGE == 's3' else 'off'
+    return 'async'
+
+
+def remember_render(file_name: str, data: bytes) -> None:
+    """Keep a rendered file for /download, evicting the oldest beyond RECENT_RENDERS_MAX_BYTES"""
+    with _RECENT_RENDERS_LOCK:
+        _RECENT_RENDERS[file_name] = data
+        _RECENT_RENDERS.move_to_end(file_name)
+        total = sum(len(d) for d in _RECENT_RENDERS.values())
+        while total > RECENT_RENDERS_MAX_BYTES and len(_RECENT_RENDERS) > 1:
+            _, evicted = _RECENT_RENDERS.popitem(last=False)
+            total -= len(evicted)
+
+
+def recent_render(file_name: str):
+    """Bytes of a recently rendered file, or None"""
+    with _RECENT_RENDERS_LOCK:
+        return _RECENT_RENDERS.get(file_name)
+
+
+def remember_spooled_render(file_name: str, data: RenderedFile) -> None:
+    """Keep a streamed render for /download, dropping the oldest beyond SPOOLED_RENDERS_KEPT"""
+    with _RECENT_RENDERS_LOCK:
+        _SPOOLED_RENDERS[file_name] = data
+        _SPOOLED_RENDERS.move_to_end(file_name)
+        while len(_SPOOLED_RENDERS) > SPOOLED_RENDERS_KEPT:
+            _SPOOLED_RENDERS.popitem(last=False)
+
+
+def spooled_render(file_name: str):
+    """RenderedFile of a recent streamed render, or None"""
+    with _RECENT_RENDERS_LOCK:
+        return _SPOOLED_RENDERS.get(file_name)
+
+
+def write_output_file(file_path, data: bytes) -> None:
+    """Write a file (bytes or a RenderedFile) atomically (readers never see a partial file)"""
+    file_path = Path(file_path)
+    tmp_path = file_path.with_name(f"{file_path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "wb") as f:
+        for chunk in output_chunks(data):
+            f.write(chunk)
+    os.replace(tmp_path, file_path)
+
+
+def _write_output(file_path, data):
+    output_storage().write(Path(file_path).name, data)
+
+
+def _write_output_in_background(file_path, data):
+    try:
+        _write_output(file_path, data)
+    except OSError as e:
+        print(f"⚠ Warning: Could not write {file_path}: {e}")
+
+
+def keep_output(file_path, data: bytes) -> bytes:
+    """
+    Register a rendered document (bytes or a RenderedFile): cached for /download and written
+    to the output storage (file_path for local storage) as OUTPUT_WRITE says. Returns data.
+    """
+    if isinstance(data, RenderedFile):
+        remember_spooled_render(Path(file_path).name, data)
+    else:
+        remember_render(Path(file_path).name, data)
+    mode = output_write_mode()
+    if mode == 'sync':
+        _write_output(file_path, data)
+    elif mode == 'async':
+        _OUTPUT_WRITER.submit(_write_output_in_background, file_path, data)
+    return data
+
+
+# ================= OUTPUT RETENTION =================
+# Generated files in the output directory are tracked in an index (name -> path, size, last use)
+# that /download looks files up in, and a background sweeper keeps the directory within
+# OUTPUT_MAX_MB and OUTPUT_MAX_AGE_HOURS: files unused for longer than the age limit go first,
+# then the least recently used ones. The index is seeded from the directory (every file but
+# in-progress *.tmp writes, and the render bundles) on first use, so files from earlier runs
+# are covered too.
+OUTPUT_MAX_MB = os.getenv('OUTPUT_MAX_MB', '')
+OUTPUT_MAX_AGE_SECONDS = float(os.getenv('OUTPUT_MAX_AGE_HOURS', '72')) * 3600
+OUTPUT_SWEEP_SECONDS = float(os.getenv('OUTPUT_SWEEP_SECONDS', '600'))
+
+
+def output_quota_bytes() -> int:
+    """OUTPUT_MAX_MB, default 1024 MB (256 MB of /tmp on serverless)"""
+    if OUTPUT_MAX_MB:
+        return int(float(OUTPUT_MAX_MB) * 1024 * 1024)
+    return (256 if is_serverless_environment() else 1024) * 1024 * 1024
+
+
+class OutputIndex:
+    """LRU index of the generated files in the output directory, with size and age quotas"""
+
+    def __init__(self):
+        self._files = OrderedDict()  # name -> [path, size, last used], least recently used first
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._sweeper = None
+
+    def _load(self):
+        """Seed the index from the output directories (lock held)"""
+        if self._loaded:
+            return
+        self._loaded = True
+        found = []
+        for directory in {get_output_directory().resolve(), Path("output").resolve()}:
+            # Generated files (xlsx, pdf, ...) and the render bundles
+            for subdirectory, prefix in ((directory, ""), (directory / "bundles", "bundles/")):
+                if not subdirectory.is_dir():
+                    continue
+                for path in subdirectory.iterdir():
+                    # In-progress atomic writes
+                    if path.name.endswith(".tmp"):
+                        continue
+                    try:
+                        stat = path.stat()
+                    except OSError:
+                        continue
+                    if os.path.isfile(path):
+                        found.append((stat.st_mtime, prefix + path.name, path, stat.st_size))
+        for last_used, name, path, size in sorted(found):
+            self._put(name, path, size, last_used)
+
+    def _put(self, name, path, size, last_used):
+        previous = self._files.pop(name, None)
+        if previous:
+            self._bytes -= previous[1]
+        self._files[name] = [path, size, last_used]
+        self._bytes += size
+
+    def _start_sweeper(self):
+        if self._sweeper is None and OUTPUT_SWEEP_SECONDS > 0:
+            self._sweeper = threading.Thread(target=self._sweep_forever, name="output-sweeper", daemon=True)
+            self._sweeper.start()
+
+    def _sweep_forever(self):
+        while True:
+            time.sleep(OUTPUT_SWEEP_SECONDS)
+            try:
+                self.sweep()
+            except Exception as e:
+                print(f"⚠ Warning: Output sweep failed: {e}")
+
+    def add(self, file_path, size: int, name=None) -> None:
+        """Track a file just written (under its file name by default); sweeps right away when the
+        size quota is exceeded"""
+        file_path = Path(file_path)
+        with self._lock:
+            self._load()
+            self._put(name or file_path.name, file_path, size, time.time())
+            over_quota = self._bytes > output_quota_bytes()
+            self._start_sweeper()
+        if over_quota:
+            self.sweep()
+
+    def get(self, file_name: str):
+        """Path of a tracked file (marked as used), or None"""
+        with self._lock:
+            self._load()
+            self._start_sweeper()
+            entry = self._files.get(file_name)
+            if entry is None:
+                return None
+            entry[2] = time.time()
+            self._files.move_to_end(file_name)
+            return entry[0]
+
+    def discard(self, file_name: str) -> None:
+        with self._lock:
+            entry = self._files.pop(file_name, None)
+            if entry:
+                self._bytes -= entry[1]
+
+    def sweep(self, now=None) -> list:
+        """
+        Delete expired files, then least recently used ones until the size quota is met.
+
+        Returns:
+            Names of the deleted files
+        """
+        now = time.time() if now is None else now
+        with self._lock:
+            self._load()
+            quota = output_quota_bytes()
+            victims = [name for name, (_, _, last_used) in self._files.items()
+                       if now - last_used > OUTPUT_MAX_AGE_SECONDS]
+            remaining = self._bytes - sum(self._files[name][1] for name in victims)
+            expired = set(victims)
+            for name, (_, size, _) in self._files.items():
+                if remaining <= quota:
+                    break
+                if name not in expired:
+                    victims.append(name)
+                    remaining -= size
+            removed = [(name, self._files.pop(name)) for name in victims]
+            self._bytes -= sum(entry[1] for _, entry in removed)
+
+        freed = 0
+        for name, (path, size, _) in removed:
+            try:
+                path.unlink()
+                freed += size
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                print(f"⚠ Warning: Could not remove {path}: {e}")
+        if removed:
+            print(f"✓ Output retention: removed {len(removed)} files ({freed:,} bytes)")
+        return [name for name, _ in removed]
+
+
+OUTPUT_FILES = OutputIndex()
+
+
+# ================= OUTPUT STORAGE =================
+# Where generated files are written: the local output directory (default) or, with
+# OUTPUT_STORAGE=s3, an S3-compatible bucket (AWS S3, MinIO, R2, ... via S3_ENDPOINT_URL) that
+# every instance shares. Uploads to the bucket are multipart with parallel parts, on the output
+# writer thread. /download redirects to a presigned URL for the files this process wrote or has
+# seen in the bucket, so the bytes don't pass through the API process; other names are read
+# with one GET (no HEAD first) and streamed through. Retention in the bucket is left to its
+# lifecycle rules. Needs boto3; the app doesn't start with OUTPUT_STORAGE=s3 without it.
+OUTPUT_STORAGE = os.getenv('OUTPUT_STORAGE', 'local').lower()
+S3_BUCKET = os.getenv('S3_BUCKET')
+S3_PREFIX = os.getenv('S3_PREFIX', 'generated/')
+S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')
+S3_REGION = os.getenv('S3_REGION')
+S3_PRESIGN_SECONDS = int(os.getenv('S3_PRESIGN_SECONDS', '900'))
+S3_MULTIPART_CHUNK_BYTES = int(os.getenv('S3_MULTIPART_CHUNK_MB', '8')) * 1024 * 1024
+S3_KNOWN_KEYS_MAX = 10000
+
+
+class LocalOutputStorage:
+    """Generated files in the output directory, kept within quota by OUTPUT_FILES"""
+
+    def write(self, file_name: str, data: bytes) -> None:
+        file_path = get_output_directory() / file_name
+        write_output_file(file_path, data)
+        OUTPUT_FILES.add(file_path, len(data))
+
+    def path(self, file_name: str):
+        """Local path of a stored file, or None"""
+        # Files written by this process are indexed
+        file_path = OUTPUT_FILES.get(file_name)
+        if file_path is not None:
+            if file_path.exists():
+                return file_path
+            OUTPUT_FILES.discard(file_name)
+        # Written by another worker, or the legacy output directory
+        for directory in (get_output_directory(), Path("output")):
+            if (directory / file_name).exists():
+                return directory / file_name
+        return None
+
+    def download_url(self, file_name: str):
+        """Files are served by the API"""
+        return None
+
+    def fetch(self, file_name: str):
+        """Files are read with path()"""
+        return None
+
+
+class S3OutputStorage:
+    """Generated files in an S3-compatible bucket, downloaded with presigned URLs"""
+
+    def __init__(self, client=None, transfer_config=None):
+        if not S3_BUCKET:
+            raise ValueError("S3_BUCKET is required for OUTPUT_STORAGE=s3")
+        if client is None:
+            try:
+                import boto3
+                from boto3.s3.transfer import TransferConfig
+            except ImportError:
+                raise ValueError("OUTPUT_STORAGE=s3 needs boto3 (pip install boto3)")
+            client = boto3.client("s3", endpoint_url=S3_ENDPOINT_URL, region_name=S3_REGION)
+            transfer_config = TransferConfig(multipart_threshold=S3_MULTIPART_CHUNK_BYTES,
+                                             multipart_chunksize=S3_MULTIPART_CHUNK_BYTES, max_concurrency=4)
+        self._client = client
+        self._transfer_config = transfer_config
+        self._known = OrderedDict()  # names known to be in the bucket, oldest first
+        self._known_lock = threading.Lock()
+
+    def _remember(self, file_name: str) -> None:
+        with self._known_lock:
+            self._known[file_name] = True
+            self._known.move_to_end(file_name)
+            while len(self._known) > S3_KNOWN_KEYS_MAX:
+                self._known.popitem(last=False)
+
+    def key(self, file_name: str) -> str:
+        return f"{S3_PREFIX}{file_name}"
+
+    def write(self, file_name: str, data: bytes) -> None:
+        # Multipart above S3_MULTIPART_CHUNK_BYTES, parts uploaded in parallel
+        self._client.upload_fileobj(
+            open_output(data), S3_BUCKET, self.key(file_name),
+            ExtraArgs={"ContentType": media_type_for(file_name),
+                       "ContentDisposition": attachment_headers(file_name)["Content-Disposition"]},
+            Config=self._transfer_config,
+        )
+        self._remember(file_name)
+
+    def path(self, file_name: str):
+        """Nothing is kept on local disk"""
+        return None
+
+    def download_url(self, file_name: str):
+        """Presigned GET URL of a file known to be in the bucket (no request is made), or None"""
+        with self._known_lock:
+            if file_name not in self._known:
+                return None
+            self._known.move_to_end(file_name)
+        return self._client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": S3_BUCKET, "Key": self.key(file_name),
+                    "ResponseContentDisposition": attachment_headers(file_name)["Content-Disposition"]},
+            ExpiresIn=S3_PRESIGN_SECONDS,
+        )
+
+    def fetch(self, file_name: str):
+        """
+        GET a stored file not known here yet.
+
+        Returns:
+            The get_object response (Body, ContentLength, ETag), or None when the bucket doesn't
+            have the file
+        """
+        try:
+            obj = self._client.get_object(Bucket=S3_BUCKET, Key=self.key(file_name))
+        except self._client.exceptions.ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        # Later downloads are redirected
+        self._remember(file_name)
+        return obj
+
+
+_OUTPUT_STORAGE = None
+_OUTPUT_STORAGE_LOCK = threading.Lock()
+
+
+def output_storage():
+    """The configured output storage backend (created on first use)"""
+    global _OUTPUT_STORAGE
+    with _OUTPUT_STORAGE_LOCK:
+        if _OUTPUT_STORAGE is None:
+            if OUTPUT_STORAGE == 's3':
+                _OUTPUT_STORAGE = S3OutputStorage()
+            elif OUTPUT_STORAGE == 'local':
+                _OUTPUT_STORAGE = LocalOutputStorage()
+            else:
+                raise ValueError(f"Unknown OUTPUT_STORAGE: {OUTPUT_STORAGE}")
+        return _OUTPUT_STORAGE
+
+
+# ================= CONTENTVERSION UPLOAD =================
+# Files are inserted with the multipart/binary form of the ContentVersion insert: the JSON
+# fields and the raw file bytes go in one request body that is read from the render buffer,
+# instead of a base64 copy inside a JSON string. SF_UPLOAD_GZIP=1 also gzips the request body
+# (xlsx parts are already deflated, so this mostly helps documents with uncompressed content).
+SF_UPLOAD_GZIP = os.getenv('SF_UPLOAD_GZIP', '0').lower() in ('1', 'true', 'yes')
+SF_UPLOAD_CHUNK_BYTES = 256 * 1024
+SF_UPLOAD_TIMEOUT = int(os.getenv('SF_UPLOAD_TIMEOUT', '300'))
+
+
+class MultipartBody:
+    """Read-only file object over byte segments; requests streams it with a Content-Length"""
+
+    def __init__(self, segments):
+        # A RenderedFile is sliced like bytes, read from its temporary file
+        self._segments = [segment if isinstance(segment, RenderedFile) else memoryview(segment)
+                          for segment in segments if len(segment)]
+        self._length = sum(len(segment) for segment in self._segments)
+        self._index = 0
+        self._offset = 0
+
+    def __len__(self):
+        return self._length
+
+    def read(self, size=-1):
+        out = []
+        while self._index < len(self._segments) and size != 0:
+            segment = self._segments[self._index]
+            end = len(segment) if size < 0 else min(len(segment), self._offset + size)
+            out.append(segment[self._offset:end])
+            if size > 0:
+                size -= end - self._offset
+            self._offset = end
+            if self._offset == len(segment):
+                self._index += 1
+                self._offset = 0
+        return b"".join(out)
+
+
+def gzip_segments(segments, chunk_bytes=SF_UPLOAD_CHUNK_BYTES):
+    """Gzip byte segments chunk by chunk"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for segment in segments:
+        view = segment if isinstance(segment, RenderedFile) else memoryview(segment)
+        for start in range(0, len(view), chunk_bytes):
+            chunk = compressor.compress(view[start:start + chunk_bytes])
+            if chunk:
+                yield chunk
+    yield compressor.flush()
+
+
+def upload_content_version(sf, file_name, data, parent_id, content_document_id=None):
+    """
+    Upload a generated file to Salesforce as a ContentVersion published to a record.
+
+    Args:
+        sf: Salesforce connection
+        file_name: File name; the title is the name without extension
+        data: File bytes or RenderedFile
+        parent_id: FirstPublishLocationId (Shipment, Contract, Quote or Case)
+        content_document_id: Add the file as a new version of this ContentDocument instead
+            (it keeps its links, so parent_id isn't used)
+
+    Returns:
+        Salesforce create result ({"id", "success", "errors"})
+    """
+    entity = {
+        "Title": file_name.rsplit(".", 1)[0],
+        "PathOnClient": file_name,
+    }
+    if content_document_id:
+        entity["ContentDocumentId"] = content_document_id
+        entity["ReasonForChange"] = "Regenerated"
+    else:
+        entity["FirstPublishLocationId"] = parent_id
+    boundary = f"sfapi{os.urandom(12).hex()}"
+    segments = [
+        (f"--{boundary}\r\n"
+         'Content-Disposition: form-data; name="entity_content"\r\n'
+         "Content-Type: application/json\r\n\r\n"
+         f"{json.dumps(entity)}\r\n"
+         f"--{boundary}\r\n"
+         f'Content-Disposition: form-data; name="VersionData"; filename="{file_name}"\r\n'
+         "Content-Type: application/octet-stream\r\n\r\n").encode("utf-8"),
+        data,
+        f"\r\n--{boundary}--\r\n".encode("utf-8"),
+    ]
+    headers = {
+        "Authorization": f"Bearer {sf.session_id}",
+        "Content-Type": f'multipart/form-data; boundary="{boundary}"',
+    }
+    if SF_UPLOAD_GZIP:
+        segments = list(gzip_segments(segments))
+        headers["Content-Encoding"] = "gzip"
+
+    response = sf.session.post(f"{sf.base_url}sobjects/ContentVersion/", data=MultipartBody(segments),
+                               headers=headers, timeout=SF_UPLOAD_TIMEOUT)
+    if response.status_code >= 300:
+        exception_handler(response, "ContentVersion")
+    return response.json()
+
+# ================= DOCUMENT VERSIONS =================
+# A regenerated document is added as a new ContentVersion of the file generated before for the
+# same record and document type (title prefix, e.g. "PI_"), instead of creating one more file.
+# VERSION_EXISTING_DOCUMENTS=0 always creates a new file.
+VERSION_EXISTING_DOCUMENTS = os.getenv('VERSION_EXISTING_DOCUMENTS', '1').lower() in ('1', 'true', 'yes')
+
+# Title prefixes of the files the generators upload
+GENERATED_DOCUMENT_TYPES = ("Packing_List_", "Invoice_", "Combined_Export_", "PI_", "Production_Order_", "Quote_", "Case_")
+
+
+def generated_documents(sf, parent_id, document_type, limit=None, extension="xlsx"):
+    """
+    Generated files of a document type linked to a record.
+
+    Args:
+        sf: Salesforce connection
+        parent_id: Linked record Id
+        document_type: Title prefix of the generated files
+        limit: Maximum number of files
+        extension: File extension (xlsx, or pdf for the PDF copies)
+
+    Returns:
+        ContentDocumentIds, most recently changed first
+    """
+    # "_" is a LIKE wildcard in SOQL
+    title_pattern = document_type.replace("_", "\\_")
+    query = f"""
+        SELECT ContentDocumentId
+        FROM ContentDocumentLink
+        WHERE LinkedEntityId = '{parent_id}'
+        AND ContentDocument.Title LIKE '{title_pattern}%'
+        AND ContentDocument.FileExtension = '{extension}'
+        ORDER BY ContentDocument.LastModifiedDate DESC
+        {f"LIMIT {limit}" if limit else ""}
+    """
+    _, records = query_records(sf, query)
+    return [record["ContentDocumentId"] for record in records]
+
+
+def find_previous_document(sf, parent_id, document_type, extension="xlsx"):
+    """The most recently changed generated file of a document type linked to a record, or None"""
+    try:
+        documents = generated_documents(sf, parent_id, document_type, limit=1, extension=extension)
+    except Exception as e:
+        print(f"⚠ Warning: Could not look up previous {document_type} documents of {parent_id}: {e}")
+        return None
+    return documents[0] if documents else None
+
+
+def upload_document(sf, file_name, data, parent_id, document_type=None):
+    """
+    Upload a generated file, as a new version of the previous one of its document type if there
+    is one, and schedule the cleanup of older files of that type.
+    """
+    extension = file_name.rsplit(".", 1)[-1].lower()
+    content_document_id = None
+    if document_type and VERSION_EXISTING_DOCUMENTS:
+        content_document_id = find_previous_document(sf, parent_id, document_type, extension)
+    result = upload_content_version(sf, file_name, data, parent_id, content_document_id)
+    if content_document_id:
+        print(f"✓ Added {file_name} as a new version of {content_document_id}")
+    schedule_document_cleanup(sf, parent_id, document_type, content_version_id=result.get("id"),
+                              keep_document_id=content_document_id, extension=extension)
+    return result
+
+
+# ================= DOCUMENT CLEANUP =================
+# Generated files superseded by a newer one of the same document type (left by regenerations
+# before files were versioned, or by concurrent ones) are deleted with sObject Collections
+# requests of up to 200 ids. This runs on demand with POST /cleanup-documents/{record_id}, and
+# in the background after each successful upload of the types listed in CLEANUP_DOCUMENT_TYPES
+# (opt-in, e.g. PI_,Production_Order_,Quote_,Case_ for what the Visualforce pages used to clean
+# up). Every deleted ContentDocument Id is logged.
+CLEANUP_DOCUMENT_TYPES = tuple(
+    t.strip() for t in os.getenv('CLEANUP_DOCUMENT_TYPES', '').split(',')
+    if t.strip() in GENERATED_DOCUMENT_TYPES
+)
+SOBJECT_COLLECTION_MAX = 200
+
+_CLEANUP_WORKER = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sf-cleanup")
+
+
+def delete_records(sf, record_ids):
+    """
+    Delete records with sObject Collections DELETE requests (SOBJECT_COLLECTION_MAX ids each,
+    not all-or-none).
+
+    Returns:
+        (deleted ids, [{"id", "errors"}] for the records that couldn't be deleted)
+    """
+    deleted, failed = [], []
+    for start in range(0, len(record_ids), SOBJECT_COLLECTION_MAX):
+        batch = record_ids[start:start + SOBJECT_COLLECTION_MAX]
+        results = sf.restful("composite/sobjects", method="DELETE",
+                             params={"ids": ",".join(batch), "allOrNone": "false"}) or []
+        # Results are in request order
+        for record_id, result in zip(batch, results):
+            if result.get("success"):
+                deleted.append(record_id)
+            else:
+                failed.append({"id": record_id, "errors": result.get("errors", [])})
+    return deleted, failed
+
+
+def cleanup_superseded_documents(sf, parent_id, document_type, keep_document_id=None, extension="xlsx"):
+    """
+    Delete the generated files of a document type linked to a record, except the current one.
+
+    Args:
+        sf: Salesforce connection
+        parent_id: Linked record Id
+        document_type: Title prefix of the generated files
+        keep_document_id: ContentDocumentId of the current file (default: the most recently changed)
+        extension: File extension (xlsx and pdf files are cleaned up separately)
+
+    Returns:
+        {"record_id", "document_type", "extension", "kept", "deleted", "failed"}
+    """
+    if not is_salesforce_id(parent_id):
+        raise ValueError(f"Invalid Salesforce record Id: {parent_id}")
+    documents = generated_documents(sf, parent_id, document_type, extension=extension)
+    if keep_document_id is None and documents:
+        keep_document_id = documents[0]
+    superseded = [document_id for document_id in documents if document_id != keep_document_id]
+    deleted, failed = delete_records(sf, superseded) if superseded else ([], [])
+    if deleted:
+        print(f"✓ Deleted {len(deleted)} superseded {document_type} {extension} documents of {parent_id} "
+              f"(kept {keep_document_id}): {', '.join(deleted)}")
+    for failure in failed:
+        print(f"⚠ Warning: Could not delete {failure['id']}: {failure['errors']}")
+    return {
+        "record_id": parent_id,
+        "document_type": document_type,
+        "extension": extension,
+        "kept": keep_document_id,
+        "deleted": deleted,
+        "failed": failed,
+    }
+
+
+def _cleanup_after_upload(sf, parent_id, document_type, content_version_id, keep_document_id, extension):
+    try:
+        if keep_document_id is None:
+            records = sf.query(f"SELECT ContentDocumentId FROM ContentVersion WHERE Id = '{content_version_id}'")["records"]
+            if not records:
+                return
+            keep_document_id = records[0]["ContentDocumentId"]
+        cleanup_superseded_documents(sf, parent_id, document_type, keep_document_id, extension)
+    except Exception as e:
+        print(f"⚠ Warning: Cleanup of {document_type} documents of {parent_id} failed: {e}")
+
+
+def schedule_document_cleanup(sf, parent_id, document_type, content_version_id, keep_document_id=None,
+                              extension="xlsx"):
+    """Clean up the files superseded by a just uploaded ContentVersion in the background"""
+    if document_type in CLEANUP_DOCUMENT_TYPES and content_version_id:
+        _CLEANUP_WORKER.submit(_cleanup_after_upload, sf, parent_id, document_type, content_version_id,
+                               keep_document_id, extension)
+
+
+# ================= BACKGROUND PUBLISH =================
+# With PUBLISH_IN_BACKGROUND=1 the generate endpoints answer as soon as the file is rendered:
+# the response carries the download URL and a publish job id, and the ContentVersion upload
+# runs on a worker thread, retried with exponential backoff. GET /publish-status/{job_id}
+# reports the job. Serverless functions may be frozen once the response is sent, so keep the
+# default (upload before responding) there.
+PUBLISH_IN_BACKGROUND = os.getenv('PUBLISH_IN_BACKGROUND', '0').lower() in ('1', 'true', 'yes')
+PUBLISH_WORKERS = int(os.getenv('PUBLISH_WORKERS', '2'))
+PUBLISH_MAX_ATTEMPTS = int(os.getenv('PUBLISH_MAX_ATTEMPTS', '5'))
+PUBLISH_RETRY_BASE_SECONDS = float(os.getenv('PUBLISH_RETRY_BASE_SECONDS', '2'))
+PUBLISH_RETRY_MAX_SECONDS = 60
+PUBLISH_JOBS_KEPT = 1000
+
+_PUBLISH_JOBS = OrderedDict()
+_PUBLISH_JOBS_LOCK = threading.Lock()
+_PUBLISH_WORKER = ThreadPoolExecutor(max_workers=PUBLISH_WORKERS, thread_name_prefix="sf-publish")
+
+# Rejections that a retry won't fix
+_PERMANENT_UPLOAD_ERRORS = (SalesforceMalformedRequest, SalesforceRefusedRequest, SalesforceResourceNotFound)
+
+
+def _update_publish_job(job_id, **fields):
+    with _PUBLISH_JOBS_LOCK:
+        _PUBLISH_JOBS[job_id].update(fields)
+
+
+def _run_publish_job(job_id, sf, file_name, data, parent_id, document_type):
+    """Upload one queued file, retrying transient failures"""
+    error = None
+    for attempt in range(1, PUBLISH_MAX_ATTEMPTS + 1):
+        _update_publish_job(job_id, status="uploading", attempts=attempt)
+        try:
+            if sf is None:
+                sf = get_salesforce_connection()
+            result = upload_document(sf, file_name, data, parent_id, document_type)
+        except _PERMANENT_UPLOAD_ERRORS as e:
+            error = e
+            break
+        except SalesforceExpiredSession as e:
+            error = e
+            sf = None
+        except Exception as e:
+            error = e
+        else:
+            _update_publish_job(job_id, status="done", content_version_id=result["id"], error=None,
+                                finished_at=datetime.datetime.now().isoformat())
+            print(f"✓ Published {file_name} to {parent_id}: {result['id']}")
+            return
+        if attempt < PUBLISH_MAX_ATTEMPTS:
+            delay = min(PUBLISH_RETRY_BASE_SECONDS * 2 ** (attempt - 1), PUBLISH_RETRY_MAX_SECONDS)
+            _update_publish_job(job_id, status="retrying", error=str(error))
+            print(f"⚠ Warning: Upload of {file_name} failed (attempt {attempt}), retrying in {delay:.0f}s: {error}")
+            time.sleep(delay)
+
+    _update_publish_job(job_id, status="failed", error=str(error), finished_at=datetime.datetime.now().isoformat())
+    print(f"⚠ Warning: Upload of {file_name} to {parent_id} failed: {error}")
+
+
+def publish_content_version(sf, file_name, data, parent_id, document_type=None):
+    """
+    Attach a generated file to a record: uploaded now, or queued when PUBLISH_IN_BACKGROUND is on.
+
+    Args:
+        sf: Salesforce connection
+        file_name: File name
+        data: File bytes
+        parent_id: FirstPublishLocationId
+        document_type: Title prefix; the file becomes a new version of the previous one (see upload_document)
+
+    Returns:
+        The create result; for a queued upload {"id": None, "publish_job_id": job id}
+    """
+    result = _publish_file(sf, file_name, data, parent_id, document_type)
+    # ?pdf=true: the PDF copy follows the xlsx
+    pdf_outputs = _PDF_OUTPUT.get()
+    if pdf_outputs is not None and file_name.lower().endswith(".xlsx"):
+        publish_pdf(sf, file_name, data, parent_id, document_type, pdf_outputs)
+    return result
+
+
+def _publish_file(sf, file_name, data, parent_id, document_type):
+    if not PUBLISH_IN_BACKGROUND:
+        return upload_document(sf, file_name, data, parent_id, document_type)
+
+    job_id = uuid.uuid4().hex
+    with _PUBLISH_JOBS_LOCK:
+        _PUBLISH_JOBS[job_id] = {
+            "job_id": job_id,
+            "status": "pending",
+            "file_name": file_name,
+            "parent_id": parent_id,
+            "attempts": 0,
+            "content_version_id": None,
+            "error": None,
+            "created_at": datetime.datetime.now().isoformat(),
+            "finished_at": None,
+        }
+        # Forget the oldest finished jobs
+        finished = [key for key, job in _PUBLISH_JOBS.items() if job["status"] in ("done", "failed")]
+        for key in finished[:max(0, len(_PUBLISH_JOBS) - PUBLISH_JOBS_KEPT)]:
+            del _PUBLISH_JOBS[key]
+    _PUBLISH_WORKER.submit(_run_publish_job, job_id, sf, file_name, data, parent_id, document_type)
+    return {"id": None, "success": None, "publish_job_id": job_id}
+
+
+def publish_status(job_id):
+    """Copy of a publish job, or None"""
+    with _PUBLISH_JOBS_LOCK:
+        job = _PUBLISH_JOBS.get(job_id)
+        return dict(job) if job else None
+
+
+# ================= PDF OUTPUT =================
+# ?pdf=true on the generate endpoints also converts the generated xlsx to PDF: the PDF is kept
+# and uploaded to the record like the xlsx (as a version of the previous PDF of its type), and
+# the response gains pdf_file_name / pdf_download_url / pdf_salesforce_content_version_id.
+# Conversion runs on PDF_WORKERS headless LibreOffice processes that are started once (at the
+# first conversion, or at startup with PDF_PREWARM=1) and driven over UNO, so a request doesn't
+# pay for an office start. At most PDF_QUEUE_MAX conversions wait for a free worker; beyond that
+# the PDF is skipped with pdf_error. PDFs are cached by a hash of the workbook content, so an
+# unchanged document is converted once. Needs LibreOffice and its Python UNO bridge.
+SOFFICE_PATH = os.getenv('SOFFICE_PATH', 'soffice')
+PDF_WORKERS = int(os.getenv('PDF_WORKERS', '2'))
+PDF_QUEUE_MAX = int(os.getenv('PDF_QUEUE_MAX', '8'))
+PDF_PREWARM = os.getenv('PDF_PREWARM', '0').lower() in ('1', 'true', 'yes')
+PDF_START_TIMEOUT = float(os.getenv('PDF_START_TIMEOUT', '60'))
+PDF_CONVERT_TIMEOUT = float(os.getenv('PDF_CONVERT_TIMEOUT', '120'))
+PDF_CACHE_MAX_BYTES = int(os.getenv('PDF_CACHE_MAX_MB', '64')) * 1024 * 1024
+PDF_MEDIA_TYPE = "application/pdf"
+
+# Set by generate_with_pdf: publish_content_version converts xlsx files and records the PDF here
+_PDF_OUTPUT = contextvars.ContextVar("pdf_output", default=None)
+
+
+class PdfQueueFull(Exception):
+    """All PDF workers are busy and PDF_QUEUE_MAX conversions are already waiting"""
+
+
+def xlsx_content_key(data: bytes) -> str:
+    """
+    Cache key of a workbook: sha256 of its parts, except the document properties, whose
+    modified time changes on every render.
+    """
+    digest = hashlib.sha256()
+    try:
+        with zipfile.ZipFile(open_output(data)) as zf:
+            for name in sorted(zf.namelist()):
+                if name == "docProps/core.xml":
+                    continue
+                digest.update(name.encode("utf-8") + b"\0")
+                digest.update(zf.read(name))
+    except zipfile.BadZipFile:
+        digest = hashlib.sha256()
+        for chunk in output_chunks(data):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _uno_properties(**values):
+    import uno
+    properties = []
+    for name, value in values.items():
+        prop = uno.createUnoStruct("com.sun.star.beans.PropertyValue")
+        prop.Name, prop.Value = name, value
+        properties.append(prop)
+    return tuple(properties)
+
+
+class OfficeWorker:
+    """A headless LibreOffice process with its own profile, kept running and driven over UNO"""
+
+    def __init__(self, index: int):
+        self.index = index
+        self.pipe_name = f"sf_api_office_{os.getpid()}_{index}"
+        # Per process: an office instance must not share its profile with another API worker's
+        self.profile_dir = Path(tempfile.gettempdir()) / f"sf_api_office_profile_{os.getpid()}_{index}"
+        self.process = None
+        self.desktop = None
+
+    def alive(self) -> bool:
+        return self.desktop is not None and self.process is not None and self.process.poll() is None
+
+    def start(self) -> None:
+        """Start the office process and connect to it (no-op when it is running)"""
+        if self.alive():
+            return
+        self.stop()
+        try:
+            import uno
+            from com.sun.star.connection import NoConnectException
+        except ImportError:
+            raise ValueError("PDF output needs LibreOffice with its Python UNO bridge (python3-uno)")
+        connection = f"pipe,name={self.pipe_name};urp;StarOffice.ComponentContext"
+        started = time.monotonic()
+        try:
+            self.process = subprocess.Popen(
+                [SOFFICE_PATH, "--headless", "--invisible", "--nologo", "--nodefault", "--norestore",
+                 "--nolockcheck", f"-env:UserInstallation={self.profile_dir.as_uri()}", f"--accept={connection}"],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+            )
+        except OSError as e:
+            raise ValueError(f"Could not start LibreOffice ({SOFFICE_PATH}): {e}")
+
+        local_context = uno.getComponentContext()
+        resolver = local_context.ServiceManager.createInstanceWithContext(
+            "com.sun.star.bridge.UnoUrlResolver", local_context)
+        while True:
+            try:
+                context = resolver.resolve(f"uno:{connection}")
+                break
+            except NoConnectException:
+                if self.process.poll() is not None or time.monotonic() - started > PDF_START_TIMEOUT:
+                    self.stop()
+                    raise RuntimeError(f"LibreOffice worker {self.index} did not start")
+                time.sleep(0.25)
+        self.desktop = context.ServiceManager.createInstanceWithContext("com.sun.star.frame.Desktop", context)
+        print(f"✓ Started LibreOffice worker {self.index} in {time.monotonic() - started:.1f}s")
+
+    def stop(self) -> None:
+        """Stop the office process (the profile is kept for the next start)"""
+        self.desktop = None
+        if self.process is not None:
+            if self.process.poll() is None:
+                self.process.terminate()
+                try:
+                    self.process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self.process.kill()
+                    self.process.wait()
+            self.process = None
+
+    def _kill(self) -> None:
+        if self.process is not None and self.process.poll() is None:
+            print(f"⚠ Warning: LibreOffice worker {self.index} timed out, killing it")
+            self.process.kill()
+
+    def convert(self, xlsx_path: Path, pdf_path: Path) -> None:
+        """
+        Convert a workbook to PDF. A conversion that takes longer than PDF_CONVERT_TIMEOUT kills
+        the process; it is restarted by the next conversion.
+        """
+        self.start()
+        watchdog = threading.Timer(PDF_CONVERT_TIMEOUT, self._kill)
+        watchdog.start()
+        try:
+            document = self.desktop.loadComponentFromURL(
+                xlsx_path.as_uri(), "_blank", 0, _uno_properties(Hidden=True, ReadOnly=True))
+            try:
+                # Formulas written by openpyxl have no cached results
+                document.calculateAll()
+                document.storeToURL(pdf_path.as_uri(), _uno_properties(FilterName="calc_pdf_Export"))
+            finally:
+                document.close(True)
+        except Exception:
+            if not self.alive():
+                self.stop()
+            raise
+        finally:
+            watchdog.cancel()
+
+
+class PdfConverter:
+    """Pool of warm office workers with a bounded wait queue and a PDF cache"""
+
+    def __init__(self, workers=PDF_WORKERS, queue_max=PDF_QUEUE_MAX, worker_factory=OfficeWorker):
+        self.workers = [worker_factory(index) for index in range(max(1, workers))]
+        self._idle = queue.Queue()
+        for worker in self.workers:
+            self._idle.put(worker)
+        # Running plus waiting conversions
+        self._slots = threading.BoundedSemaphore(len(self.workers) + max(0, queue_max))
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._cache_lock = threading.Lock()
+
+    def start(self) -> None:
+        """Start every worker ahead of the first conversion"""
+        for worker in self.workers:
+            try:
+                worker.start()
+            except Exception as e:
+                print(f"⚠ Warning: Could not start LibreOffice worker {worker.index}: {e}")
+
+    def stop(self) -> None:
+        for worker in self.workers:
+            worker.stop()
+
+    def cached(self, key: str):
+        with self._cache_lock:
+            data = self._cache.get(key)
+            if data is not None:
+                self._cache.move_to_end(key)
+            return data
+
+    def _remember(self, key: str, data: bytes) -> None:
+        if len(data) > PDF_CACHE_MAX_BYTES:
+            return
+        with self._cache_lock:
+            if key in self._cache:
+                return
+            self._cache[key] = data
+            self._cache_bytes += len(data)
+            while self._cache_bytes > PDF_CACHE_MAX_BYTES:
+                _, dropped = self._cache.popitem(last=False)
+                self._cache_bytes -= len(dropped)
+
+    def convert(self, data: bytes) -> bytes:
+        """
+        Convert xlsx bytes (or a RenderedFile) to PDF bytes.
+
+        Raises:
+            PdfQueueFull: when the queue is full or no worker frees up within PDF_CONVERT_TIMEOUT
+            ValueError: when LibreOffice or the UNO bridge is not available
+        """
+        key = xlsx_content_key(data)
+        pdf = self.cached(key)
+        if pdf is not None:
+            return pdf
+        if not self._slots.acquire(blocking=False):
+            raise PdfQueueFull(f"PDF queue is full ({PDF_QUEUE_MAX} waiting)")
+        try:
+            try:
+                worker = self._idle.get(timeout=PDF_CONVERT_TIMEOUT)
+            except queue.Empty:
+                raise PdfQueueFull("No PDF worker became free")
+            try:
+                with tempfile.TemporaryDirectory(prefix="sf_api_pdf_") as tmp:
+                    xlsx_path, pdf_path = Path(tmp) / "document.xlsx", Path(tmp) / "document.pdf"
+                    write_output_file(xlsx_path, data)
+                    started = time.monotonic()
+                    worker.convert(xlsx_path, pdf_path)
+                    pdf = pdf_path.read_bytes()
+                print(f"✓ Converted to PDF in {time.monotonic() - started:.2f}s on worker {worker.index}")
+            finally:
+                self._idle.put(worker)
+        finally:
+            self._slots.release()
+        self._remember(key, pdf)
+        return pdf
+
+
+_PDF_CONVERTER = None
+_PDF_CONVERTER_LOCK = threading.Lock()
+
+
+def pdf_converter() -> PdfConverter:
+    """The PDF worker pool (created on first use; workers start at their first conversion)"""
+    global _PDF_CONVERTER
+    with _PDF_CONVERTER_LOCK:
+        if _PDF_CONVERTER is None:
+            _PDF_CONVERTER = PdfConverter()
+            atexit.register(_PDF_CONVERTER.stop)
+        return _PDF_CONVERTER
+
+
+def publish_pdf(sf, file_name, data, parent_id, document_type, outputs: dict) -> None:
+    """
+    Convert a generated xlsx to PDF, keep it and attach it to the record. Failures don't fail
+    the document; they are reported in outputs["pdf_error"].
+
+    Args:
+        sf: Salesforce connection
+        file_name: xlsx file name
+        data: xlsx bytes
+        parent_id: Record the xlsx was attached to
+        document_type: Title prefix (the PDF is versioned separately from the xlsx)
+        outputs: Response fields of generate_with_pdf, updated in place
+    """
+    pdf_name = file_name.rsplit(".", 1)[0] + ".pdf"
+    try:
+        pdf = pdf_converter().convert(data)
+    except Exception as e:
+        print(f"⚠ Warning: Could not convert {file_name} to PDF: {e}")
+        outputs["pdf_error"] = str(e)
+        return
+    keep_output(get_output_directory() / pdf_name, pdf)
+    outputs["pdf_file_name"] = pdf_name
+    outputs["pdf_download_url"] = download_url(pdf_name)
+    try:
+        result = publish_content_version(sf, pdf_name, pdf, parent_id, document_type)
+    except Exception as e:
+        print(f"⚠ Warning: Could not upload {pdf_name}: {e}")
+        outputs["pdf_error"] = str(e)
+        return
+    outputs["pdf_salesforce_content_version_id"] = result.get("id")
+    if result.get("publish_job_id"):
+        outputs["pdf_publish_job_id"] = result["publish_job_id"]
+
+
+def generate_with_pdf(pdf: bool, generate, *args):
+    """
+    Run a document generator, with ?pdf=true also converting and uploading its file as PDF.
+    Blocking: async endpoints call it with run_in_threadpool.
+
+    Returns:
+        The generator's result, with the pdf_* fields added when a PDF was requested
+    """
+    if not pdf:
+        return generate(*args)
+    outputs = {}
+    token = _PDF_OUTPUT.set(outputs)
+    try:
+        result = generate(*args)
+    finally:
+        _PDF_OUTPUT.reset(token)
+    if isinstance(result, dict):
+        result.update(outputs)
+    return result
+
+
+# ================= PREVIEW =================
+# ?preview=json|html on the generate endpoints runs the Salesforce fetch and the template
+# fill, then stops at save_workbook: nothing is written or uploaded and the filled sheet
+# values are returned instead, so data can be checked before creating a real document.
+PreviewMode = Optional[Literal["json", "html"]]
+_PREVIEW_MODE = contextvars.ContextVar("preview_mode", default=None)
+
+
+class PreviewReady(Exception):
+    """Raised by save_workbook in preview mode to stop a generator before it writes or uploads"""
+
+    def __init__(self, preview):
+        super().__init__("Preview ready")
+        self.preview = preview
+
+
+def preview_active() -> bool:
+    """Whether the current request is a preview"""
+    return _PREVIEW_MODE.get() is not None
+
+
+def preview_value(value):
+    """JSON-compatible form of a cell value"""
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bool, int, float, str)):
+        return value
+    return str(value)
+
+
+def workbook_preview(wb) -> dict:
+    """
+    Filled values of every sheet, formulas replaced by their result when computed here.
+
+    Returns:
+        {"sheets": [{"title", "rows": [{"row": n, "cells": {column letter: value}}]}]}
+    """
+    sheets = []
+    for ws in wb.worksheets:
+        results = formula_cache_values(ws)
+        rows = {}
+        for (r, c), cell in sorted(ws._cells.items()):
+            value = cell.value
+            if value is None or value == "":
+                continue
+            letter = get_column_letter(c)
+            if cell.data_type == "f":
+                value = results.get(f"{letter}{r}", value)
+            rows.setdefault(r, {})[letter] = preview_value(value)
+        sheets.append({"title": ws.title, "rows": [{"row": r, "cells": cells} for r, cells in rows.items()]})
+    return {"sheets": sheets}
+
+
+def preview_html(preview) -> str:
+    """Render a workbook preview as plain HTML tables, one per sheet"""
+    parts = ['<!DOCTYPE html><html><head><meta charset="utf-8"><title>Preview</title><style>'
+             'table{border-collapse:collapse;font:12px sans-serif;margin-bottom:24px}'
+             'td,th{border:1px solid #ccc;padding:2px 6px;white-space:pre-wrap;vertical-align:top}'
+             'th{background:#f3f3f3}</style></head><body>']
+    for sheet in preview["sheets"]:
+        columns = sorted({col for row in sheet["rows"] for col in row["cells"]}, key=column_index_from_string)
+        parts.append(f'<h3>{html.escape(sheet["title"])}</h3><table><tr><th></th>')
+        parts.extend(f'<th>{col}</th>' for col in columns)
+        parts.append('</tr>')
+        for row in sheet["rows"]:
+            parts.append(f'<tr><th>{row["row"]}</th>')
+            parts.extend(f'<td>{html.escape(str(row["cells"].get(col, "")))}</td>' for col in columns)
+            parts.append('</tr>')
+        parts.append('</table>')
+    parts.append('</body></html>')
+    return ''.join(parts)
+
+
+def run_preview(mode, generate, *args):
+    """
+    Run a document generator in preview mode. Blocking: async endpoints call it with
+    run_in_threadpool.
 
-# Add CORS Middleware
-from fastapi.middleware.cors import CORSMiddleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],  # Allows all origins
-    allow_credentials=True,
-    allow_methods=["*"],  # Allows all methods
-    allow_headers=["*"],  # Allows all headers
-)
+    Args:
+        mode: "json" or "html"
+        generate: Generator function (fetch, fill, save_workbook, upload)
+        *args: Generator arguments
 
-class ShipmentRequest(BaseModel):
-    shipment_id: str
+    Returns:
+        JSON response dict, or HTMLResponse for mode "html"
+    """
+    started = datetime.datetime.now()
+    token = _PREVIEW_MODE.set(mode)
+    try:
+        generate(*args)
+    except PreviewReady as ready:
+        preview = ready.preview
+    else:
+        raise ValueError("Document generator finished without reaching the preview point")
+    finally:
+        _PREVIEW_MODE.reset(token)
+    preview["elapsed_ms"] = round((datetime.datetime.now() - started).total_seconds() * 1000)
+    if mode == "html":
+        return HTMLResponse(preview_html(preview))
+    return {"status": "success", "message": "Preview generated", "data": preview}
+
+
+# ================= FILE RESPONSES =================
+# Generate endpoints answer with JSON by default. With ?response=file, or an Accept header that
+# prefers the xlsx (or octet-stream) media type over JSON, the rendered bytes are returned in the
+# same response and the Salesforce ids move to X- headers. Callers on serverless hosts then don't
+# need a second /download request, which may reach an instance without the file.
+XLSX_MEDIA_TYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+ResponseFormat = Optional[Literal["json", "file"]]
+
+
+def media_type_for(file_name: str) -> str:
+    """Media type of a generated file (xlsx or its PDF copy)"""
+    return PDF_MEDIA_TYPE if file_name.lower().endswith(".pdf") else XLSX_MEDIA_TYPE
+
+
+def _accept_quality(accept: str) -> dict:
+    """{media type: q} from an Accept header"""
+    qualities = {}
+    for item in accept.split(","):
+        media_type, *params = [part.strip() for part in item.split(";")]
+        q = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    q = float(param[2:])
+                except ValueError:
+                    q = 0.0
+        if media_type:
+            qualities[media_type.lower()] = max(q, qualities.get(media_type.lower(), 0.0))
+    return qualities
+
+
+def wants_file(response: ResponseFormat, accept: Optional[str]) -> bool:
+    """
+    Whether a generate request asked for the file itself.
+
+    Args:
+        response: ?response= value; overrides the Accept header
+        accept: Accept header
+
+    Returns:
+        True for response=file, or when the Accept header names the xlsx or octet-stream media type
+        with at least the quality JSON gets (wildcards alone keep JSON)
+    """
+    if response:
+        return response == "file"
+    if not accept:
+        return False
+    qualities = _accept_quality(accept)
+    file_q = max(qualities.get(XLSX_MEDIA_TYPE, 0.0), qualities.get("application/octet-stream", 0.0))
+    json_q = max(qualities.get("application/json", 0.0), qualities.get("application/*", 0.0),
+                 qualities.get("*/*", 0.0))
+    return file_q > 0 and file_q >= json_q
+
+
+def attachment_headers(file_name: str) -> dict:
+    """Content-Disposition for a download, with an ASCII fallback name for non-ASCII file names"""
+    fallback = file_name.encode("ascii", "replace").decode("ascii").replace("?", "_").replace('"', "_")
+    disposition = f'attachment; filename="{fallback}"'
+    if fallback != file_name:
+        disposition += f"; filename*=UTF-8''{urllib.parse.quote(file_name)}"
+    return {"Content-Disposition": disposition}
+
+
+def file_response(result: dict) -> Response:
+    """
+    Return a generator's file as the response body.
+
+    Args:
+        result: Generator result (file_name / file_path, Salesforce ids)
+
+    Returns:
+        xlsx Response with X-Salesforce-ContentVersion-Id / X-Publish-Job-Id headers when set
+    """
+    file_name = result.get("file_name") or os.path.basename(result["file_path"])
+    data = recent_render(file_name)
+    if data is None:
+        data = spooled_render(file_name)
+    if data is None:
+        with open(result["file_path"], "rb") as f:
+            data = f.read()
+
+    headers = attachment_headers(file_name)
+    if result.get("salesforce_content_version_id"):
+        headers["X-Salesforce-ContentVersion-Id"] = result["salesforce_content_version_id"]
+    if result.get("publish_job_id"):
+        headers["X-Publish-Job-Id"] = result["publish_job_id"]
+    if result.get("pdf_download_url"):
+        headers["X-Pdf-Download-Url"] = urllib.parse.quote(result["pdf_download_url"])
+    if result.get("pdf_salesforce_content_version_id"):
+        headers["X-Pdf-ContentVersion-Id"] = result["pdf_salesforce_content_version_id"]
+    if result.get("status") == "partial_success":
+        headers["X-Salesforce-Upload-Error"] = result.get("message", "")[:200].encode("ascii", "replace").decode("ascii")
+    if isinstance(data, RenderedFile):
+        headers["Content-Length"] = str(len(data))
+        return StreamingResponse(data.chunks(), media_type=XLSX_MEDIA_TYPE, headers=headers)
+    return Response(content=data, media_type=XLSX_MEDIA_TYPE, headers=headers)
+
+
+# ================= DOWNLOADS =================
+# Generated files never change (their names carry a timestamp), so /download answers with an
+# ETag derived from the file version (content hash, mtime and size, or ContentVersion Id),
+# private immutable caching, 304 for a matching If-None-Match and single byte ranges
+# (206 / 416). Files no longer kept here are fetched from their ContentVersion in Salesforce,
+# streamed through, and kept like a fresh render so repeat downloads are served locally. That
+# read-through needs the API_KEY or a signed link: with API_KEY set, the download_url of a
+# generate response carries an expiry and an HMAC signature (DOWNLOAD_URL_SECONDS).
+DOWNLOAD_CACHE_CONTROL = "private, max-age=31536000, immutable"
+DOWNLOAD_URL_SECONDS = int(os.getenv('DOWNLOAD_URL_SECONDS', '86400'))
+_RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def download_signature(file_name: str, expires: int) -> str:
+    return hmac.new(API_KEY.encode("utf-8"), f"{file_name}:{expires}".encode("utf-8"), hashlib.sha256).hexdigest()
+
+
+def download_url(file_name: str) -> str:
+    """/download URL of a generated file, signed for DOWNLOAD_URL_SECONDS when API_KEY is set"""
+    url = f"/download/{urllib.parse.quote(file_name)}"
+    if not API_KEY:
+        return url
+    expires = int(time.time()) + DOWNLOAD_URL_SECONDS
+    return f"{url}?expires={expires}&signature={download_signature(file_name, expires)}"
+
+
+def download_signature_valid(file_name: str, expires: Optional[int], signature: Optional[str]) -> bool:
+    """Whether a download link is signed with the API_KEY and not expired"""
+    if not (API_KEY and expires and signature) or expires < time.time():
+        return False
+    return hmac.compare_digest(signature, download_signature(file_name, expires))
+
+
+def download_headers(file_name: str, size: int, version: str) -> dict:
+    """
+    Headers of a download: disposition, ETag, caching and range support.
+
+    Args:
+        file_name: File name
+        size: File size
+        version: Identifies the file content (content hash, mtime, ContentVersion Id)
+    """
+    etag = hashlib.md5(f"{file_name}:{size}:{version}".encode("utf-8")).hexdigest()
+    return {
+        **attachment_headers(file_name),
+        "ETag": f'"{etag}"',
+        "Cache-Control": DOWNLOAD_CACHE_CONTROL,
+        "Accept-Ranges": "bytes",
+    }
+
+
+def not_modified_response(request: Request, headers: dict):
+    """304 response when If-None-Match matches the ETag, else None"""
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return None
+    tags = [tag.strip()[2:] if tag.strip().startswith("W/") else tag.strip() for tag in if_none_match.split(",")]
+    if "*" in tags or headers["ETag"] in tags:
+        return Response(status_code=304, headers={"ETag": headers["ETag"], "Cache-Control": DOWNLOAD_CACHE_CONTROL})
+    return None
+
+
+def requested_range(request: Request, size: int, etag: str):
+    """
+    Byte range asked for by a Range header.
+
+    Returns:
+        (start, end) inclusive, or None to send the whole file (no Range, stale If-Range,
+        several ranges or an unparsable header)
+
+    Raises:
+        HTTPException 416 for an unsatisfiable range
+    """
+    header = request.headers.get("range")
+    if not header:
+        return None
+    if_range = request.headers.get("if-range")
+    if if_range and if_range.strip() != etag:
+        return None
+    match = _RANGE_RE.match(header.strip())
+    if not match or not (match[1] or match[2]):
+        return None
+    if match[1]:
+        start = int(match[1])
+        end = min(int(match[2]), size - 1) if match[2] else size - 1
+        if match[2] and int(match[2]) < start:
+            return None
+    else:
+        start, end = max(size - int(match[2]), 0), size - 1
+    if start >= size or end < start:
+        raise HTTPException(status_code=416, detail="Requested range not satisfiable",
+                            headers={"Content-Range": f"bytes */{size}"})
+    return start, end
+
+
+def bytes_download_response(request: Request, data: bytes, file_name: str, version=None) -> Response:
+    """
+    Download response for file bytes held in memory (ETag from the content unless version is
+    given), or for a RenderedFile (ETag from its version, body streamed from its temporary file)
+    """
+    if isinstance(data, RenderedFile):
+        version = version or data.version
+    headers = download_headers(file_name, len(data), version or hashlib.md5(data).hexdigest())
+    not_modified = not_modified_response(request, headers)
+    if not_modified:
+        return not_modified
+    byte_range = requested_range(request, len(data), headers["ETag"])
+    if byte_range is None:
+        if isinstance(data, RenderedFile):
+            headers["Content-Length"] = str(len(data))
+            return StreamingResponse(data.chunks(), media_type=media_type_for(file_name), headers=headers)
+        return Response(content=data, media_type=media_type_for(file_name), headers=headers)
+    start, end = byte_range
+    headers["Content-Range"] = f"bytes {start}-{end}/{len(data)}"
+    return Response(content=data[start:end + 1], status_code=206, media_type=media_type_for(file_name),
+                    headers=headers)
+
+
+def file_download_response(request: Request, file_path: Path, file_name: str) -> Response:
+    """Download response for a local file (FileResponse serves the ranges)"""
+    stat = file_path.stat()
+    headers = download_headers(file_name, stat.st_size, str(stat.st_mtime_ns))
+    not_modified = not_modified_response(request, headers)
+    if not_modified:
+        return not_modified
+    return FileResponse(path=str(file_path), media_type=media_type_for(file_name), headers=headers)
+
+
+def stored_download_response(request: Request, file_name: str, obj) -> Response:
+    """Download response for a file read from object storage (get_object response)"""
+    headers = download_headers(file_name, obj["ContentLength"], obj.get("ETag", ""))
+    body = obj["Body"]
+    not_modified = not_modified_response(request, headers)
+    if not_modified:
+        body.close()
+        return not_modified
+
+    def stream():
+        try:
+            yield from body.iter_chunks(SF_UPLOAD_CHUNK_BYTES)
+        finally:
+            body.close()
+
+    # Ranges are left to the presigned URL of later downloads
+    headers["Content-Length"] = str(obj["ContentLength"])
+    return StreamingResponse(stream(), media_type=media_type_for(file_name), headers=headers)
+
+
+def salesforce_download_response(request: Request, file_name: str):
+    """
+    Download response for a generated file that is only left in Salesforce.
+
+    Args:
+        request: Download request
+        file_name: Generated file name (PathOnClient of its ContentVersion)
+
+    Returns:
+        Response, or None when no generated ContentVersion has this name
+    """
+    if not (file_name.startswith(GENERATED_DOCUMENT_TYPES) and file_name.endswith((".xlsx", ".pdf"))):
+        return None
+    sf = get_salesforce_connection()
+    path_on_client = file_name.replace("\\", "\\\\").replace("'", "\\'")
+    records = sf.query(f"""
+        SELECT Id, ContentSize
+        FROM ContentVersion
+        WHERE PathOnClient = '{path_on_client}'
+        ORDER BY CreatedDate DESC
+        LIMIT 1
+    """)["records"]
+    if not records:
+        return None
+
+    headers = download_headers(file_name, records[0]["ContentSize"], records[0]["Id"])
+    not_modified = not_modified_response(request, headers)
+    if not_modified:
+        return not_modified
+
+    upstream = sf.session.get(f"{sf.base_url}sobjects/ContentVersion/{records[0]['Id']}/VersionData",
+                              headers={"Authorization": f"Bearer {sf.session_id}"}, stream=True,
+                              timeout=SF_UPLOAD_TIMEOUT)
+    if upstream.status_code >= 300:
+        upstream.close()
+        exception_handler(upstream, "ContentVersion")
+    file_path = get_output_directory() / file_name
+    print(f"Fetching {file_name} from Salesforce ContentVersion {records[0]['Id']}")
+
+    if request.headers.get("range"):
+        # Ranges are served from the complete file
+        try:
+            data = upstream.content
+        finally:
+            upstream.close()
+        return bytes_download_response(request, keep_output(file_path, data), file_name, records[0]["Id"])
+
+    def stream():
+        chunks = []
+        try:
+            for chunk in upstream.iter_content(SF_UPLOAD_CHUNK_BYTES):
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            upstream.close()
+        # Only reached when the whole file was sent
+        keep_output(file_path, b"".join(chunks))
+
+    headers["Content-Length"] = str(records[0]["ContentSize"])
+    return StreamingResponse(stream(), media_type=media_type_for(file_name), headers=headers)
+
+
+# ================= INCREMENTAL RE-RENDER =================
+# With INCREMENTAL_RENDER=1 a render bundle (rendered template cells + table rows) is kept
+# per record next to the output. Regenerating the same document with the same number of
+# table rows loads the previous output and rewrites only the cells whose value changed.
+# Cells the fill rewrites after rendering the template text (Total formulas, formulas shifted
+# by the table expansion) are left out of the bundle, so a patch never writes over them.
+# INCREMENTAL_RENDER_VERIFY=1 also renders every patched document from scratch and serves
+# that one, with a warning, when the two differ.
+INCREMENTAL_RENDER = os.getenv('INCREMENTAL_RENDER', '').lower() in ('1', 'true', 'yes')
+INCREMENTAL_RENDER_VERIFY = os.getenv('INCREMENTAL_RENDER_VERIFY', '').lower() in ('1', 'true', 'yes')
+
+
+def find_text_cells(ws):
+    """All (row, col, text) string cells of a template sheet"""
+    return [(cell.row, cell.column, cell.value) for row in ws.iter_rows() for cell in row
+            if isinstance(cell.value, str)]
+
+
+def render_bundle_path(kind: str, record_id: str) -> Path:
+    """Location of the latest render bundle for a document kind and record"""
+    bundle_dir = get_output_directory() / "bundles"
+    bundle_dir.mkdir(parents=True, exist_ok=True)
+    return bundle_dir / f"{kind}_{sanitize_filename(record_id)}.json"
+
+
+def build_render_bundle(template_path, sheet_name, start_tag, render_text, rows, file_path):
+    """
+    Describe a render by its inputs: every rendered template cell outside the table and
+    the table rows, in output coordinates.
+
+    Args:
+        template_path: Template used for the render
+        sheet_name: Sheet holding the table
+        start_tag: Tag marking the table row
+        render_text: Function applied to template strings
+        rows: List of {column_index: value} dicts, one per table row
+        file_path: Output file of this render
+
+    Returns:
+        JSON-compatible bundle dict, or None if the template has no such table
+    """
+    text_cells = template_anchors(template_path, sheet_name, {"text_cells": find_text_cells})["text_cells"]
+    table_row = next((r for r, _, text in text_cells if start_tag in text), None)
+    if table_row is None:
+        return None
+    row_map = row_mapper([(table_row, max(len(rows), 1) - 1)])
+    bundle = {
+        "file_path": str(file_path),
+        "template": str(template_path),
+        "template_mtime": os.path.getmtime(template_path),
+        "sheet": sheet_name,
+        "table_row": table_row,
+        "cells": {f"{row_map(r)},{c}": render_text(text) for r, c, text in text_cells if r != table_row},
+        "rows": [{str(col): value for col, value in row.items()} for row in rows],
+    }
+    # Round-trip once so values compare equal to a bundle read back from disk
+    return json.loads(json.dumps(bundle, default=str))
+
+
+def settle_render_bundle(bundle, ws) -> None:
+    """
+    Align a bundle with the filled sheet of a full render: cells whose final value isn't their
+    rendered template text were rewritten by the fill, so they move from "cells" to "rewritten".
+    """
+    rewritten = set(bundle.get("rewritten", ()))
+    for key, value in list(bundle["cells"].items()):
+        r, c = key.split(",")
+        if ws.cell(int(r), int(c)).value != value:
+            del bundle["cells"][key]
+            rewritten.add(key)
+    bundle["rewritten"] = sorted(rewritten)
+
+
+def check_patched_render(patched, fresh, sheet_name, file_name):
+    """
+    Choose between a patched and a full render of the same document.
+
+    Args:
+        patched: Bytes from patch_previous_render, or None
+        fresh: Bytes of the full render
+        sheet_name: Sheet the patch was applied to
+        file_name: For the warning
+
+    Returns:
+        patched when it is set and its sheet has the same cell values as fresh, else fresh
+    """
+    if patched is None:
+        return fresh
+    sheets = [openpyxl.load_workbook(io.BytesIO(data))[sheet_name] for data in (patched, fresh)]
+    values = [{(cell.row, cell.column): cell.value for row in ws.iter_rows() for cell in row
+               if cell.value is not None} for ws in sheets]
+    if values[0] == values[1]:
+        return patched
+    differing = sorted(key for key in values[0].keys() | values[1].keys() if values[0].get(key) != values[1].get(key))
+    print(f"⚠ Warning: Patched {file_name} differs from a full render in {len(differing)} cells "
+          f"(first at row {differing[0][0]}, column {differing[0][1]}); using the full render")
+    return fresh
+
+
+def render_bundle_key(path: Path) -> str:
+    """OUTPUT_FILES name of a bundle (not a /download file name)"""
+    return f"bundles/{path.name}"
+
+
+def load_render_bundle(kind: str, record_id: str):
+    """Read the previous render bundle, or None"""
+    path = render_bundle_path(kind, record_id)
+    # Keeps it from being evicted as unused
+    OUTPUT_FILES.get(render_bundle_key(path))
+    try:
+        with open(path, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_render_bundle(kind: str, record_id: str, bundle) -> None:
+    """Store a render bundle for the next incremental render"""
+    path = render_bundle_path(kind, record_id)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(bundle, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+    # Bundles are evicted by the output retention like the files they patch
+    OUTPUT_FILES.add(path, path.stat().st_size, name=render_bundle_key(path))
+
+
+def patch_previous_render(previous, bundle, file_path):
+    """
+    Produce file_path by patching the previous output with the cells that differ between bundles.
+
+    Returns:
+        The new file bytes (not kept yet), or None when the previous render can't be reused:
+        different template, different table size, empty table, a bundle from before rewritten
+        cells were tracked, or output no longer available
+    """
+    if not previous or not bundle:
+        return None
+    if (previous.get("template") != bundle["template"]
+            or previous.get("template_mtime") != bundle["template_mtime"]
+            or previous.get("sheet") != bundle["sheet"]
+            or len(previous.get("rows", ())) != len(bundle["rows"])
+            or not bundle["rows"]
+            or "rewritten" not in previous):
+        return None
+    previous_path = previous.get("file_path", "")
+    source = recent_render(Path(previous_path).name)
+    if source is not None:
+        source = io.BytesIO(source)
+    elif os.path.exists(previous_path):
+        source = previous_path
+    else:
+        return None
+
+    # Same template and table size, so the fill rewrites the same cells as last time
+    for key in previous["rewritten"]:
+        bundle["cells"].pop(key, None)
+    bundle["rewritten"] = previous["rewritten"]
+
+    wb = openpyxl.load_workbook(source)
+    ws = wb[bundle["sheet"]]
+    changed = 0
+    old_cells = previous["cells"]
+    for key, value in bundle["cells"].items():
+        if old_cells.get(key) != value:
+            r, c = key.split(",")
+            ws.cell(int(r), int(c)).value = value
+            changed += 1
+    table_row = bundle["table_row"]
+    for idx, (old_row, new_row) in enumerate(zip(previous["rows"], bundle["rows"])):
+        if old_row != new_row:
+            for col, value in new_row.items():
+                if old_row.get(col) != value:
+                    ws.cell(table_row + idx, int(col)).value = value
+                    changed += 1
+    data = workbook_bytes(wb, os.path.basename(str(file_path)))
+    print(f"✓ Patched {changed} changed cells into {os.path.basename(str(file_path))}")
+    return data
 
-def expand_items_table(ws, template_row, n):
-    """Expand the items table to accommodate n rows"""
-    max_col = ws.max_column
-    row_style = []
-    for col in range(1, max_col + 1):
-        cell = ws.cell(row=template_row, column=col)
-        row_style.append(style_copy(cell._style) if cell.has_style else None)
-    row_height = ws.row_dimensions[template_row].height
-    add_rows = max(0, n - 1)
-    
-    # Handle merged cells
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > template_row:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-    
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-    
-    # Insert rows
-    if add_rows > 0:
-        ws.insert_rows(template_row + 1, amount=add_rows)
-        for offset in range(1, add_rows + 1):
-            r = template_row + offset
-            for col in range(1, max_col + 1):
-                dst = ws.cell(row=r, column=col)
-                dst.value = None
-                st = row_style[col - 1]
-                if st is not None:
-                    dst._style = style_copy(st)
-            if row_height is not None:
-                ws.row_dimensions[r].height = row_height
-    
-    # Re-merge shifted cells
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
-    
-    # Update total formulas
-    total_header_row = None
-    for r in range(template_row + 1, ws.max_row + 1):
-        if ws.cell(row=r, column=1).value == "Total":
-            total_header_row = r
-            break
-    
-    if total_header_row is None:
-        raise ValueError("Total row not found")
-    
-    first_data_row = template_row
-    last_data_row = template_row + n - 1
-    ws[f"H{total_header_row}"] = f"=SUM(H{first_data_row}:H{last_data_row})"
-    ws[f"J{total_header_row}"] = f"=SUM(J{first_data_row}:J{last_data_row})"
-    ws[f"K{total_header_row}"] = f"=COUNTA(K{first_data_row}:K{last_data_row})"
 
 def get_salesforce_connection():
     """Initialize Salesforce connection"""
@@ -135,6 +3105,29 @@ def get_salesforce_connection():
         consumer_secret=consumer_secret
     )
 
+def query_records(sf, query):
+    """
+    Run a SOQL query and page through the result lazily with query_more.
+
+    Args:
+        sf: Salesforce connection instance
+        query: SOQL query
+
+    Returns:
+        (totalSize, iterator over the records); only one page is held in memory at a time
+    """
+    first_page = sf.query(query)
+
+    def records():
+        page = first_page
+        while True:
+            yield from page['records']
+            if page.get('done', True) or not page.get('nextRecordsUrl'):
+                break
+            page = sf.query_more(page['nextRecordsUrl'], identifier_is_url=True)
+
+    return first_page.get('totalSize', 0), records()
+
 def get_picklist_values(sf, object_name: str, field_name: str) -> list[str]:
     """
     Get picklist values dynamically from Salesforce for any object and field.
@@ -165,20 +3158,21 @@ def get_picklist_values(sf, object_name: str, field_name: str) -> list[str]:
         print(f"⚠ Warning: Could not fetch picklist values for {object_name}.{field_name}: {e}")
         return []
 
+def is_serverless_environment() -> bool:
+    """Check if we're running on a read-only serverless filesystem (Vercel, AWS Lambda)"""
+    return (
+        os.getenv('VERCEL') is not None or  # Vercel
+        os.getenv('AWS_LAMBDA_FUNCTION_NAME') is not None or  # AWS Lambda
+        os.getenv('LAMBDA_TASK_ROOT') is not None  # AWS Lambda alternative
+    )
+
 def get_output_directory() -> Path:
     """
     Get the appropriate output directory based on environment.
     Use /tmp for serverless environments (Vercel, AWS Lambda) where filesystem is read-only.
     Use ./output for local development.
     """
-    # Check if we're in a serverless environment
-    is_serverless = (
-        os.getenv('VERCEL') is not None or  # Vercel
-        os.getenv('AWS_LAMBDA_FUNCTION_NAME') is not None or  # AWS Lambda
-        os.getenv('LAMBDA_TASK_ROOT') is not None  # AWS Lambda alternative
-    )
-    
-    if is_serverless:
+    if is_serverless_environment():
         output_dir = Path("/tmp")
     else:
         output_dir = Path("output")
@@ -221,6 +3215,486 @@ def format_picklist_checkboxes(options, selected_value, uppercase=False):
         
     return "\n".join(formatted_lines)
 
+# ================= DIRECT OOXML RENDER ENGINE =================
+# Renders a template by editing the xlsx package directly instead of loading it
+# into openpyxl. Only the target sheet, sharedStrings.xml and (when a wrapped
+# style is needed) styles.xml are rewritten; every other part is copied as-is.
+# Enable per template with DIRECT_RENDER_TEMPLATES=packing_list_template.xlsx,...
+# ('*' enables it for every template that supports it).
+
+DIRECT_RENDER_TEMPLATES = {
+    name.strip() for name in os.getenv('DIRECT_RENDER_TEMPLATES', '').split(',') if name.strip()
+}
+
+_DIRECT_TEMPLATE_CACHE = {}
+
+# Longest text a cell may hold (Excel's limit; openpyxl truncates to it as well)
+MAX_CELL_TEXT = 32767
+
+# Item count from which packing lists and invoices are streamed: Container_Item__c pages
+# are read lazily and the sheet is written row by row, so memory stays flat.
+STREAM_RENDER_MIN_ROWS = int(os.getenv('STREAM_RENDER_MIN_ROWS', '2000'))
+
+_ROW_RE = re.compile(r'<row\b([^>]*?)(?:/>|>(.*?)</row>)', re.S)
+_CELL_RE = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.S)
+_ATTR_RE = re.compile(r'([\w:]+)="([^"]*)"')
+_SI_RE = re.compile(r'<si>(.*?)</si>|<si/>', re.S)
+_T_RE = re.compile(r'<t(?:\s[^>]*)?>(.*?)</t>|<t\s*/>', re.S)
+_REF_RE = re.compile(r'(\$?[A-Z]{1,3})(\$?)(\d+)')
+
+
+def use_direct_render(template_path) -> bool:
+    """Check whether a template is configured for the direct OOXML render engine."""
+    if preview_active():
+        return False
+    name = os.path.basename(str(template_path))
+    return '*' in DIRECT_RENDER_TEMPLATES or name in DIRECT_RENDER_TEMPLATES
+
+
+def _ooxml_text(fragment):
+    """Return the plain text of a <si> or <is> fragment (rich text runs are flattened)."""
+    fragment = re.sub(r'<rPh\b.*?</rPh>', '', fragment, flags=re.S)
+    return html.unescape(''.join(m.group(1) or '' for m in _T_RE.finditer(fragment)))
+
+
+def _ooxml_shift_ref(ref, anchor_row, delta):
+    """Shift every row number greater than anchor_row in a cell/range reference by delta."""
+    def shift(m):
+        row = int(m.group(3))
+        if row > anchor_row:
+            row += delta
+        return f"{m.group(1)}{m.group(2)}{row}"
+    return _REF_RE.sub(shift, ref)
+
+
+def _ooxml_col_index(letters):
+    """Convert column letters (e.g. 'AB') to a 1-based column index."""
+    index = 0
+    for ch in letters.lstrip('$'):
+        index = index * 26 + (ord(ch) - 64)
+    return index
+
+
+class DirectTemplate:
+    """Parsed xlsx template that can be rendered without openpyxl."""
+
+    def __init__(self, template_path, sheet_name):
+        self.template_path = str(template_path)
+        with zipfile.ZipFile(self.template_path) as zf:
+            self.members = [(info, zf.read(info.filename)) for info in zf.infolist()]
+        parts = {info.filename: data for info, data in self.members}
+
+        self.sheet_part = self._find_sheet_part(parts, sheet_name)
+        sheet_xml = parts[self.sheet_part].decode('utf-8')
+        start = sheet_xml.index('<sheetData')
+        data_open_end = sheet_xml.index('>', start) + 1
+        if sheet_xml[data_open_end - 2] == '/':
+            body, self.tail = '', sheet_xml[data_open_end:]
+        else:
+            end = sheet_xml.index('</sheetData>')
+            body, self.tail = sheet_xml[data_open_end:end], sheet_xml[end + len('</sheetData>'):]
+        self.head = sheet_xml[:start] + '<sheetData>'
+
+        # rows: list of (row_number, row_attrs, [(col_index, col_letters, cell_attrs, inner_xml)])
+        self.rows = []
+        for m in _ROW_RE.finditer(body):
+            attrs = m.group(1)
+            row_number = int(re.search(r'\br="(\d+)"', attrs).group(1))
+            cells = []
+            for cm in _CELL_RE.finditer(m.group(2) or ''):
+                cell_attrs = dict(_ATTR_RE.findall(cm.group(1)))
+                letters = re.match(r'[A-Z]+', cell_attrs['r']).group(0)
+                cells.append((_ooxml_col_index(letters), letters, cell_attrs, cm.group(2) or ''))
+            self.rows.append((row_number, attrs, cells))
+
+        sst = parts.get('xl/sharedStrings.xml', b'').decode('utf-8')
+        self.shared_strings = [_ooxml_text(m.group(1) or '') for m in _SI_RE.finditer(sst)]
+        self.sst_xml = sst
+        self.styles_xml = parts['xl/styles.xml'].decode('utf-8')
+
+    @staticmethod
+    def _find_sheet_part(parts, sheet_name):
+        workbook_xml = parts['xl/workbook.xml'].decode('utf-8')
+        rels_xml = parts['xl/_rels/workbook.xml.rels'].decode('utf-8')
+        rid = None
+        for m in re.finditer(r'<sheet\b([^>]*)/>', workbook_xml):
+            attrs = dict(_ATTR_RE.findall(m.group(1)))
+            if html.unescape(attrs.get('name', '')) == sheet_name:
+                rid = attrs.get('r:id')
+                break
+        if rid is None:
+            raise ValueError(f"Sheet '{sheet_name}' not found in template")
+        for m in re.finditer(r'<Relationship\b([^>]*)/>', rels_xml):
+            attrs = dict(_ATTR_RE.findall(m.group(1)))
+            if attrs.get('Id') == rid:
+                target = attrs['Target'].lstrip('/')
+                return target if target.startswith('xl/') else f"xl/{target}"
+        raise ValueError(f"Sheet part for '{sheet_name}' not found in template")
+
+    def cell_text(self, cell_attrs, inner):
+        """Return the text of a string cell, or None for non-string cells."""
+        cell_type = cell_attrs.get('t')
+        if cell_type == 's':
+            m = re.search(r'<v>(\d+)</v>', inner)
+            return self.shared_strings[int(m.group(1))] if m else None
+        if cell_type == 'inlineStr':
+            return _ooxml_text(inner)
+        return None
+
+    def find_cell(self, text, exact=False, min_row=1, max_col=None):
+        """Find the first (row, col) whose text contains (or equals) the given text."""
+        for row_number, _, cells in self.rows:
+            if row_number < min_row:
+                continue
+            for col, _, cell_attrs, inner in cells:
+                if max_col is not None and col > max_col:
+                    continue
+                value = self.cell_text(cell_attrs, inner)
+                if value is not None and (value == text if exact else text in value):
+                    return row_number, col
+        return None
+
+    def render(self, render_text=None, table_row=None, table_rows=(), cell_values=None,
+               wrap_placeholders=()):
+        """
+        Render the template and return the xlsx bytes.
+
+        Args:
+            render_text: Function applied to every template string (placeholder substitution)
+            table_row: Template row that is repeated once per entry of table_rows
+            table_rows: List of {column_index: value} dicts, one per table row
+            cell_values: {(row, column): value} written after expansion (output coordinates)
+            wrap_placeholders: Cells whose template text contains one of these get wrap_text
+        """
+        buffer = io.BytesIO()
+        self.render_to(buffer, render_text, table_row, table_rows, cell_values, wrap_placeholders)
+        return buffer.getvalue()
+
+    def render_to(self, out, render_text=None, table_row=None, table_rows=(), cell_values=None,
+                  wrap_placeholders=(), row_count=None, inline_table_strings=False):
+        """
+        Render the template into a file object, writing the sheet row by row.
+
+        Same arguments as render(), plus:
+            row_count: Number of table rows; required when table_rows is an iterator.
+                Missing rows are written empty, extra rows are dropped.
+            inline_table_strings: Write table strings inline instead of into the shared
+                string table, so memory does not grow with the number of rows
+        """
+        render_text = render_text or (lambda text: text)
+        cell_values = dict(cell_values or {})
+        if row_count is None:
+            row_count = len(table_rows)
+        n = max(row_count, 1) if table_row else 0
+        delta = n - 1 if table_row else 0
+        anchor = table_row or 0
+
+        new_strings = []
+        string_index = {}
+        rendered_cache = {}
+        wrap_styles = {}
+        styles_xml = self.styles_xml
+
+        def add_string(text):
+            if text not in string_index:
+                string_index[text] = len(self.shared_strings) + len(new_strings)
+                new_strings.append(text)
+            return string_index[text]
+
+        def wrap_style(style_id):
+            nonlocal styles_xml
+            if style_id not in wrap_styles:
+                styles_xml, wrap_styles[style_id] = _ooxml_add_wrap_style(styles_xml, int(style_id or 0))
+            return str(wrap_styles[style_id])
+
+        def value_xml(ref, style, value, inline=False):
+            style_attr = f' s="{style}"' if style is not None else ''
+            if value is None or value == '':
+                return f'<c r="{ref}"{style_attr}/>'
+            if isinstance(value, CachedFormula):
+                return (f'<c r="{ref}"{style_attr}><f>{xml_escape(value.formula[1:])}</f>'
+                        f'<v>{formula_result_text(value.value())}</v></c>')
+            if isinstance(value, bool):
+                return f'<c r="{ref}"{style_attr} t="b"><v>{int(value)}</v></c>'
+            if isinstance(value, (int, float)):
+                return f'<c r="{ref}"{style_attr} t="n"><v>{value}</v></c>'
+            value = ILLEGAL_CHARACTERS_RE.sub('', str(value))[:MAX_CELL_TEXT]
+            if value.startswith('='):
+                return f'<c r="{ref}"{style_attr}><f>{xml_escape(value[1:])}</f><v></v></c>'
+            if inline:
+                return f'<c r="{ref}"{style_attr} t="inlineStr"><is><t xml:space="preserve">{xml_escape(value)}</t></is></c>'
+            return f'<c r="{ref}"{style_attr} t="s"><v>{add_string(value)}</v></c>'
+
+        def template_cell_xml(ref, cell_attrs, inner):
+            text = self.cell_text(cell_attrs, inner)
+            style = cell_attrs.get('s')
+            if text is None:
+                attrs = ''.join(f' {k}="{v}"' for k, v in cell_attrs.items() if k != 'r')
+                return f'<c r="{ref}"{attrs}/>' if not inner else f'<c r="{ref}"{attrs}>{inner}</c>'
+            if text not in rendered_cache:
+                rendered_cache[text] = render_text(text)
+            if any(p in text for p in wrap_placeholders):
+                style = wrap_style(style)
+            return value_xml(ref, style, rendered_cache[text])
+
+        def emit_row(out_row, attrs, cells, values=None, keep_template=True):
+            attrs = re.sub(r'\br="\d+"', f'r="{out_row}"', attrs)
+            pending = {col: v for (r, col), v in cell_values.items() if r == out_row}
+            parts = []
+            seen = set()
+            for col, letters, cell_attrs, inner in cells:
+                ref = f"{letters}{out_row}"
+                seen.add(col)
+                if col in pending:
+                    parts.append((col, value_xml(ref, cell_attrs.get('s'), pending[col])))
+                elif values is not None and col in values:
+                    parts.append((col, value_xml(ref, cell_attrs.get('s'), values[col], inline_table_strings)))
+                elif keep_template:
+                    parts.append((col, template_cell_xml(ref, cell_attrs, inner)))
+                else:
+                    parts.append((col, value_xml(ref, cell_attrs.get('s'), None)))
+            for col, value in pending.items():
+                if col not in seen:
+                    parts.append((col, value_xml(f"{get_column_letter(col)}{out_row}", None, value)))
+            parts.sort(key=lambda p: p[0])
+            inner_xml = ''.join(xml for _, xml in parts)
+            return f'<row{attrs}>{inner_xml}</row>' if inner_xml else f'<row{attrs}/>'
+
+        head = re.sub(r'(<dimension ref=")([^"]+)(")',
+                      lambda m: m.group(1) + _ooxml_shift_ref(m.group(2), anchor, delta) + m.group(3),
+                      self.head)
+        tail = re.sub(r'(\b(?:ref|sqref)=")([^"]+)(")',
+                      lambda m: m.group(1) + _ooxml_shift_ref(m.group(2), anchor, delta) + m.group(3),
+                      self.tail) if delta else self.tail
+
+        def write_sheet(sheet_out):
+            sheet_out.write(head.encode('utf-8'))
+            rows = iter(table_rows)
+            for row_number, attrs, cells in self.rows:
+                if table_row and row_number == table_row:
+                    for offset in range(n):
+                        values = next(rows, None) if offset < row_count else None
+                        sheet_out.write(emit_row(row_number + offset, attrs, cells, values,
+                                                 keep_template=(offset == 0)).encode('utf-8'))
+                    if next(rows, None) is not None:
+                        print(f"⚠ Warning: More table rows than the expected {row_count}; extra rows were dropped")
+                else:
+                    out_row = row_number + delta if row_number > anchor else row_number
+                    sheet_out.write(emit_row(out_row, attrs, cells).encode('utf-8'))
+            sheet_out.write(('</sheetData>' + tail).encode('utf-8'))
+
+        def shared_strings_xml():
+            sst_xml = self.sst_xml
+            if new_strings:
+                total = len(self.shared_strings) + len(new_strings)
+                extra = ''.join(f'<si><t xml:space="preserve">{xml_escape(s)}</t></si>' for s in new_strings)
+                sst_xml = sst_xml.replace('</sst>', extra + '</sst>')
+                sst_xml = re.sub(r'\bcount="\d+"', f'count="{total}"', sst_xml, count=1)
+                sst_xml = re.sub(r'\buniqueCount="\d+"', f'uniqueCount="{total}"', sst_xml, count=1)
+            return sst_xml
+
+        with zipfile.ZipFile(out, 'w', zipfile.ZIP_DEFLATED) as zf:
+            deferred = []
+            for info, data in self.members:
+                name = info.filename
+                # Row numbers changed, so the calculation chain is dropped and Excel rebuilds it
+                if name == 'xl/calcChain.xml':
+                    continue
+                if name == self.sheet_part:
+                    with zf.open(info, 'w') as sheet_out:
+                        write_sheet(sheet_out)
+                    continue
+                # Shared strings and styles are only complete once the sheet has been written
+                if name in ('xl/sharedStrings.xml', 'xl/styles.xml'):
+                    deferred.append(info)
+                    continue
+                if name == 'xl/workbook.xml':
+                    data = _ooxml_force_recalc(data.decode('utf-8')).encode('utf-8')
+                elif name == 'xl/_rels/workbook.xml.rels':
+                    data = re.sub(r'<Relationship\b[^>]*calcChain[^>]*/>', '', data.decode('utf-8')).encode('utf-8')
+                elif name == '[Content_Types].xml':
+                    data = re.sub(r'<Override\b[^>]*calcChain[^>]*/>', '', data.decode('utf-8')).encode('utf-8')
+                zf.writestr(info, data)
+            for info in deferred:
+                if info.filename == 'xl/styles.xml':
+                    zf.writestr(info, styles_xml.encode('utf-8'))
+                else:
+                    zf.writestr(info, shared_strings_xml().encode('utf-8'))
+            if new_strings and not self.sst_xml:
+                raise ValueError("Template has no shared strings part; use the openpyxl render path")
+
+
+def _ooxml_add_wrap_style(styles_xml, xf_index):
+    """Append a copy of cellXfs[xf_index] with wrapText enabled. Returns (styles_xml, new_index)."""
+    m = re.search(r'<cellXfs\b[^>]*>(.*?)</cellXfs>', styles_xml, re.S)
+    xfs = re.findall(r'<xf\b[^>]*/>|<xf\b[^>]*>.*?</xf>', m.group(1), re.S)
+    xf = xfs[xf_index] if xf_index < len(xfs) else '<xf numFmtId="0" fontId="0" fillId="0" borderId="0"/>'
+    if '<alignment' in xf:
+        xf = re.sub(r'\swrapText="[^"]*"', '', xf)
+        xf = xf.replace('<alignment', '<alignment wrapText="1"', 1)
+    elif xf.endswith('/>'):
+        xf = xf[:-2] + '><alignment wrapText="1"/></xf>'
+    else:
+        xf = re.sub(r'^(<xf\b[^>]*>)', r'\1<alignment wrapText="1"/>', xf)
+    if 'applyAlignment=' in xf:
+        xf = re.sub(r'applyAlignment="[^"]*"', 'applyAlignment="1"', xf, count=1)
+    else:
+        xf = xf.replace('<xf', '<xf applyAlignment="1"', 1)
+    new_index = len(xfs)
+    body = m.group(1) + xf
+    block = re.sub(r'\bcount="\d+"', f'count="{new_index + 1}"', styles_xml[m.start():m.start(1)], count=1)
+    styles_xml = styles_xml[:m.start()] + block + body + styles_xml[m.end(1):]
+    return styles_xml, new_index
+
+
+def _ooxml_force_recalc(workbook_xml):
+    """Ask Excel to recalculate formulas on open (rewritten formulas carry no cached values)."""
+    if '<calcPr' in workbook_xml:
+        workbook_xml = re.sub(r'\sfullCalcOnLoad="[^"]*"', '', workbook_xml)
+        return workbook_xml.replace('<calcPr', '<calcPr fullCalcOnLoad="1"', 1)
+    return workbook_xml.replace('</workbook>', '<calcPr fullCalcOnLoad="1"/></workbook>')
+
+
+def load_direct_template(template_path, sheet_name) -> DirectTemplate:
+    """Load (and cache) a parsed template for the direct render engine."""
+    key = (str(template_path), sheet_name)
+    mtime = os.path.getmtime(template_path)
+    cached = _DIRECT_TEMPLATE_CACHE.get(key)
+    if cached is None or cached[0] != mtime:
+        cached = (mtime, DirectTemplate(template_path, sheet_name))
+        _DIRECT_TEMPLATE_CACHE[key] = cached
+    return cached[1]
+
+
+# ================= PACKING LIST SHEET =================
+# Placeholder values, text renderer, item rows and the openpyxl sheet fill shared by the
+# packing list and the combined export
+
+def packing_list_replacements(shipment, account):
+    """{placeholder: value} for the packing list shipment and consignee fields"""
+    return {
+        '{{Shipment__c.Consignee__r.Name}}': account.get('Name') or '',
+        '{{Shipment__c.Consignee__r.BillingStreet}}': account.get('BillingStreet') or '',
+        '{{Shipment__c.Consignee__r.BillingCity}}': account.get('BillingCity') or '',
+        '{{Shipment__c.Consignee__r.BillingPostalCode}}': account.get('BillingPostalCode') or '',
+        '{{Shipment__c.Consignee__r.BillingCountry}}': account.get('BillingCountry') or '',
+        '{{Shipment__c.Consignee__r.Phone}}': account.get('Phone') or '',
+        '{{Shipment__c.Consignee__r.Fax__c}}': account.get('Fax__c') or '',
+        '{{Shipment__c.Consignee__r.VAT__c}}': account.get('VAT__c') or '',
+        '{{Shipment__c.Invoice_Packing_list_no__c}}': shipment.get('Invoice_Packing_list_no__c') or '',
+        '{{Shipment__c.Issued_date__c}}': shipment.get('Issued_date__c') or '',
+        '{{Shipment__c.Port_of_Origin__c}}': shipment.get('Port_of_Origin__c') or '',
+        '{{Shipment__c.Final_Destination__c}}': shipment.get('Final_Destination__c') or '',
+        '{{Shipment__c.Stockyard__c}}': shipment.get('Stockyard__c') or '',
+        '{{Shipment__c.Ocean_Vessel__c}}': shipment.get('Ocean_Vessel__c') or '',
+        '{{Shipment__c.B_L_No__c}}': shipment.get('B_L_No__c') or '',
+        '{{Shipment__c.Departure_Date_ETD__c}}': shipment.get('Departure_Date_ETD__c') or '',
+        '{{Shipment__c.Arrival_Schedule_ETA__c}}': shipment.get('Arrival_Schedule_ETA__c') or '',
+        '{{Shipment__c.Remark_number_on_documents__c}}': shipment.get('Remark_number_on_documents__c') or '',
+        '{{Shipment__c.Terms_of_Sales__c}}': shipment.get('Terms_of_Sales__c') or '',
+        '{{Shipment__c.Terms_of_Payment__c}}': shipment.get('Terms_of_Payment__c') or '',
+    }
+
+
+def make_packing_list_text_renderer(replacements, total_containers, freight_options, freight_value):
+    """
+    Build the text renderer for packing list template cells: placeholders, bookings total,
+    "None" cleanup and freight checkboxes.
+
+    Args:
+        replacements: {placeholder: value} (see packing_list_replacements)
+        total_containers: Sum of Booking__c.Cont_Quantity__c
+        freight_options: Shipment__c.Freight__c picklist values
+        freight_value: Shipment__c.Freight__c
+
+    Returns:
+        Function mapping a template string to the rendered cell value
+    """
+    checked_box = '☑'
+    unchecked_box = '☐'
+    freight_upper = (freight_value or '').strip().upper()
+    checkbox_text = "\n".join(
+        f"{checked_box if opt.upper() == freight_upper else unchecked_box} {opt}" for opt in freight_options
+    )
+
+    def render_text(text):
+        for placeholder, value in replacements.items():
+            text = text.replace(placeholder, str(value))
+        if '{{TableStart:Shipment__c.r.Bookings__r}}' in text:
+            text = str(total_containers)
+        # Remove "None" values
+        if 'None' in text:
+            text = text.replace('None', '')
+        return text.replace('{{Shipment__c.Freight__c}}', checkbox_text)
+
+    return render_text
+
+
+def packing_list_item_row(idx, item):
+    """Packing list table values by column index"""
+    container_r = item.get('Container__r') or {}
+    return {
+        1: item.get('Line_item_no_for_print__c') or str(idx + 1),
+        2: item.get('Product_Description__c'),
+        3: item.get('Length__c'),
+        4: item.get('Width__c'),
+        5: item.get('Height__c'),
+        6: item.get('Quantity_For_print__c') or '',
+        7: item.get('Unit_for_print__c') or '',
+        8: item.get('Crates__c'),
+        9: f"{item.get('Packing__c') or ''} pcs/crate",
+        10: container_r.get('Container_Weight_Regulation__c'),
+        11: container_r.get('Name'),
+        13: item.get('Order_No__c'),
+    }
+
+
+def fill_packing_list_sheet(ws, table_start_row, table_expanded, template_path, render_text, item_rows, n_rows):
+    """
+    Fill a packing list sheet loaded with openpyxl.
+
+    Args:
+        ws: Worksheet, pre-expanded to n_rows when table_expanded
+        table_start_row: Row of {{TableStart:ContainerItems}}
+        table_expanded: The item table already has n_rows rows
+        template_path: Packing list template (for the total row anchor)
+        render_text: See make_packing_list_text_renderer
+        item_rows: {column_index: value} per item (see packing_list_item_row)
+        n_rows: Number of table rows (at least 1)
+    """
+    for row in ws.iter_rows():
+        for cell in row:
+            if cell.value and isinstance(cell.value, str):
+                wrap = '{{Shipment__c.Freight__c}}' in cell.value
+                cell.value = render_text(cell.value)
+                if wrap:
+                    if cell.alignment:
+                        new_alignment = style_copy(cell.alignment)
+                    else:
+                        from openpyxl.styles import Alignment
+                        new_alignment = Alignment()
+                    new_alignment.wrap_text = True
+                    cell.alignment = new_alignment
+
+    if not table_start_row:
+        raise ValueError("No table start marker found in template")
+
+    # Total row position comes from the template anchors, shifted past the item rows
+    total_row = template_anchors(template_path, 'PackingList', PACKING_LIST_ANCHORS)["items_total"]
+    total_row = row_mapper([(table_start_row, n_rows - 1)])(total_row)
+
+    # Expand table (already sized when loaded from a bucket)
+    if table_expanded:
+        update_items_totals(ws, table_start_row, n_rows, total_row)
+    else:
+        expand_items_table(ws, table_start_row, n_rows, total_row)
+
+    # Fill in item data
+    for idx, values in enumerate(item_rows):
+        row = table_start_row + idx
+        for col, value in values.items():
+            ws.cell(row, col).value = value
+
 def generate_packing_list(shipment_id: str, template_path: str):
     """Generate packing list for a given shipment ID"""
     
@@ -275,117 +3749,20 @@ def generate_packing_list(shipment_id: str, template_path: str):
     FROM Container_Item__c
     WHERE Shipment__c = '{shipment_id}'
     """
-    items_result = sf.query_all(items_query)
-    items = items_result['records']
-    
-    # Load template
-    wb = openpyxl.load_workbook(template_path)
-    ws = wb['PackingList']
-    
-    # Replace placeholders (excluding Freight__c as it needs special handling)
-    replacements = {
-        '{{Shipment__c.Consignee__r.Name}}': account.get('Name') or '',
-        '{{Shipment__c.Consignee__r.BillingStreet}}': account.get('BillingStreet') or '',
-        '{{Shipment__c.Consignee__r.BillingCity}}': account.get('BillingCity') or '',
-        '{{Shipment__c.Consignee__r.BillingPostalCode}}': account.get('BillingPostalCode') or '',
-        '{{Shipment__c.Consignee__r.BillingCountry}}': account.get('BillingCountry') or '',
-        '{{Shipment__c.Consignee__r.Phone}}': account.get('Phone') or '',
-        '{{Shipment__c.Consignee__r.Fax__c}}': account.get('Fax__c') or '',
-        '{{Shipment__c.Consignee__r.VAT__c}}': account.get('VAT__c') or '',
-        '{{Shipment__c.Invoice_Packing_list_no__c}}': shipment.get('Invoice_Packing_list_no__c') or '',
-        '{{Shipment__c.Issued_date__c}}': shipment.get('Issued_date__c') or '',
-        '{{Shipment__c.Port_of_Origin__c}}': shipment.get('Port_of_Origin__c') or '',
-        '{{Shipment__c.Final_Destination__c}}': shipment.get('Final_Destination__c') or '',
-        '{{Shipment__c.Stockyard__c}}': shipment.get('Stockyard__c') or '',
-        '{{Shipment__c.Ocean_Vessel__c}}': shipment.get('Ocean_Vessel__c') or '',
-        '{{Shipment__c.B_L_No__c}}': shipment.get('B_L_No__c') or '',
-        '{{Shipment__c.Departure_Date_ETD__c}}': shipment.get('Departure_Date_ETD__c') or '',
-        '{{Shipment__c.Arrival_Schedule_ETA__c}}': shipment.get('Arrival_Schedule_ETA__c') or '',
-        '{{Shipment__c.Remark_number_on_documents__c}}': shipment.get('Remark_number_on_documents__c') or '',
-        '{{Shipment__c.Terms_of_Sales__c}}': shipment.get('Terms_of_Sales__c') or '',
-        '{{Shipment__c.Terms_of_Payment__c}}': shipment.get('Terms_of_Payment__c') or '',
-    }
-    
-    for row in ws.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str):
-                for placeholder, value in replacements.items():
-                    cell.value = cell.value.replace(placeholder, str(value))
-                if '{{TableStart:Shipment__c.r.Bookings__r}}' in cell.value:
-                    cell.value = str(total_containers_from_bookings)
-    
-    # Remove "None" values
-    for row in ws.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str) and 'None' in cell.value:
-                cell.value = cell.value.replace('None', '')
-    
-    # Handle freight checkboxes dynamically
-    checked_box = '☑'
-    unchecked_box = '☐'
-    
-    freight_value = (shipment.get('Freight__c') or '').strip()
-    freight_upper = freight_value.upper()
-    
-    # Generate checkbox text with all options from Salesforce
-    lines = []
-    for opt in freight_options:
-        mark = checked_box if opt.upper() == freight_upper else unchecked_box
-        lines.append(f"{mark} {opt}")
-    
-    checkbox_text = "\n".join(lines)
-    
-    # Replace freight placeholder with checkbox text
-    # for row in ws.iter_rows():
-    #     for cell in row:
-    #         if isinstance(cell.value, str) and '{{Shipment__c.Freight__c}}' in cell.value:
-    #             cell.value = cell.value.replace('{{Shipment__c.Freight__c}}', checkbox_text)
-    
-    for row in ws.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str) and '{{Shipment__c.Freight__c}}' in cell.value:
-                cell.value = cell.value.replace('{{Shipment__c.Freight__c}}', checkbox_text)
-                if cell.alignment:
-                    new_alignment = style_copy(cell.alignment)
-                else:
-                    from openpyxl.styles import Alignment
-                    new_alignment = Alignment()
-                new_alignment.wrap_text = True
-                cell.alignment = new_alignment
-    
-    # Find table start row
-    table_start_row = None
-    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=13):
-        for cell in row:
-            if cell.value and '{{TableStart:ContainerItems}}' in str(cell.value):
-                table_start_row = cell.row
-                break
-        if table_start_row:
-            break
-    
-    if not table_start_row:
-        raise ValueError("No table start marker found in template")
-    
-    # Expand table
-    expand_items_table(ws, table_start_row, len(items) if items else 1)
-    
-    # Fill in item data
-    for idx, item in enumerate(items):
-        row = table_start_row + idx
-        container_r = item.get('Container__r', {})
-        line_item_no = item.get('Line_item_no_for_print__c') or str(idx + 1)
-        ws.cell(row, 1).value = line_item_no
-        ws.cell(row, 2).value = item.get('Product_Description__c')
-        ws.cell(row, 3).value = item.get('Length__c')
-        ws.cell(row, 4).value = item.get('Width__c')
-        ws.cell(row, 5).value = item.get('Height__c')
-        ws.cell(row, 6).value = item.get('Quantity_For_print__c') or ''
-        ws.cell(row, 7).value = item.get('Unit_for_print__c') or ''
-        ws.cell(row, 8).value = item.get('Crates__c')
-        ws.cell(row, 9).value = f"{item.get('Packing__c') or ''} pcs/crate"
-        ws.cell(row, 10).value = container_r.get('Container_Weight_Regulation__c')
-        ws.cell(row, 11).value = container_r.get('Name')
-        ws.cell(row, 13).value = item.get('Order_No__c')
+    # Large shipments are streamed page by page instead of loading every item first
+    item_count, item_records = query_records(sf, items_query)
+    stream = item_count >= STREAM_RENDER_MIN_ROWS and not preview_active()
+    items = [] if stream else list(item_records)
+    
+    # Placeholders, bookings total and freight checkboxes (all options from Salesforce)
+    render_text = make_packing_list_text_renderer(packing_list_replacements(shipment, account),
+                                                  total_containers_from_bookings, freight_options,
+                                                  shipment.get('Freight__c'))
+    
+    if stream:
+        item_rows = (packing_list_item_row(idx, item) for idx, item in enumerate(item_records))
+    else:
+        item_rows = [packing_list_item_row(idx, item) for idx, item in enumerate(items)]
     
     # Save file
     now = datetime.datetime.now()
@@ -396,24 +3773,75 @@ def generate_packing_list(shipment_id: str, template_path: str):
     output_dir = get_output_directory()
     file_path = output_dir / file_name
     
-    wb.save(str(file_path))
+    if stream or use_direct_render(template_path):
+        template = load_direct_template(template_path, 'PackingList')
+        table_start = template.find_cell('{{TableStart:ContainerItems}}', max_col=13)
+        if not table_start:
+            raise ValueError("No table start marker found in template")
+        table_start_row = table_start[0]
+        total_cell = template.find_cell('Total', exact=True, min_row=table_start_row + 1, max_col=1)
+        if total_cell is None:
+            raise ValueError("Total row not found")
+        
+        row_count = item_count if stream else len(items)
+        n = row_count or 1
+        total_header_row = total_cell[0] + n - 1
+        first_data_row = table_start_row
+        last_data_row = table_start_row + n - 1
+        # Totals are accumulated while the rows are written and cached in the formula cells
+        totals = TableAggregates(item_rows)
+        # Streamed output goes to a temporary file, so memory doesn't grow with the item count
+        buffer = RenderedFile() if stream else io.BytesIO()
+        template.render_to(
+            buffer,
+            render_text,
+            table_row=table_start_row,
+            table_rows=totals,
+            cell_values={
+                (total_header_row, 8): totals.formula("SUM", 8, first_data_row, last_data_row),
+                (total_header_row, 10): totals.formula("SUM", 10, first_data_row, last_data_row),
+                (total_header_row, 11): totals.formula("COUNTA", 11, first_data_row, last_data_row),
+            },
+            wrap_placeholders=('{{Shipment__c.Freight__c}}',),
+            row_count=row_count,
+            inline_table_strings=stream,
+        )
+        data = buffer.finish() if stream else buffer.getvalue()
+        # Streamed output isn't optimized; parsing its XML again would undo the memory savings
+        if not stream and OPTIMIZE_OUTPUT:
+            data = optimize_xlsx(data, file_name)
+        keep_output(file_path, data)
+    else:
+        # Incremental mode: patch the previous output when only cell values changed
+        bundle = None
+        if INCREMENTAL_RENDER:
+            bundle = build_render_bundle(template_path, 'PackingList', '{{TableStart:ContainerItems}}',
+                                         render_text, item_rows, file_path)
+        data = patch_previous_render(load_render_bundle('packing_list', shipment_id) if bundle else None,
+                                     bundle, file_path)
+        if data is None or INCREMENTAL_RENDER_VERIFY:
+            # Load template, pre-expanded to the item count when a bucket fits
+            n_rows = len(items) if items else 1
+            wb, ws, table_start_row, table_expanded = load_template_for_rows(
+                template_path, 'PackingList', '{{TableStart:ContainerItems}}', n_rows
+            )
+            fill_packing_list_sheet(ws, table_start_row, table_expanded, template_path, render_text, item_rows, n_rows)
+            if bundle:
+                settle_render_bundle(bundle, ws)
+            data = check_patched_render(data, workbook_bytes(wb, file_name), 'PackingList', file_name)
+        keep_output(file_path, data)
+        if bundle:
+            save_render_bundle('packing_list', shipment_id, bundle)
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        data = f.read()
-    encoded = base64.b64encode(data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": shipment_id
-    })
+    content_version = publish_content_version(sf, file_name, data, shipment_id, "Packing_List_")
     
     return {
         "file_path": str(file_path),
         "file_name": file_name,
         "salesforce_content_version_id": content_version['id'],
+        "publish_job_id": content_version.get("publish_job_id"),
+        "download_url": download_url(file_name),
         "freight_options_used": freight_options
     }
 
@@ -429,7 +3857,9 @@ async def root():
             "POST /generate-packing-list": "Generate packing list (production endpoint)",
             "GET /generate_invoice/{shipment_id}": "Generate invoice for a shipment",
             "GET /generate-combined-export/{shipment_id}": "Generate combined packing list and invoice in one Excel file",
-            "GET /download/{file_name}": "Download generated packing list file"
+            "GET /download/{file_name}": "Download generated packing list file",
+            "GET /publish-status/{job_id}": "Status of a background Salesforce upload",
+            "POST /cleanup-documents/{record_id}": "Delete superseded generated documents of a record"
         }
     }
 
@@ -450,12 +3880,16 @@ async def health_check():
         raise HTTPException(status_code=503, detail=f"Service unhealthy: {str(e)}")
 
 @app.get("/generate-packing-list")
-async def generate_packing_list_get(shipment_id: str):
+async def generate_packing_list_get(shipment_id: str, preview: PreviewMode = None, response: ResponseFormat = None,
+                                    pdf: bool = False, accept: Annotated[Optional[str], Header()] = None):
     """
     Generate packing list for a shipment (GET method for testing)
     
     Parameters:
     - shipment_id: Salesforce Shipment ID
+    - preview: "json" or "html" to return the filled values without creating a file
+    - response: "file" to return the xlsx itself (also chosen by an xlsx Accept header)
+    - pdf: also convert the file to PDF and attach it to the record
     """
     try:
         template_path = os.getenv('TEMPLATE_PATH', 'templates/packing_list_template.xlsx')
@@ -466,7 +3900,12 @@ async def generate_packing_list_get(shipment_id: str):
                 detail=f"Template file not found at: {template_path}"
             )
         
-        result = generate_packing_list(shipment_id, template_path)
+        if preview:
+            return await run_in_threadpool(run_preview, preview, generate_packing_list, shipment_id, template_path)
+
+        result = await run_in_threadpool(generate_with_pdf, pdf, generate_packing_list, shipment_id, template_path)
+        if wants_file(response, accept):
+            return file_response(result)
         
         return {
             "status": "success",
@@ -480,12 +3919,16 @@ async def generate_packing_list_get(shipment_id: str):
         raise HTTPException(status_code=500, detail=f"Error generating packing list: {str(e)}")
 
 @app.post("/generate-packing-list")
-async def generate_packing_list_post(request: ShipmentRequest):
+async def generate_packing_list_post(request: ShipmentRequest, preview: PreviewMode = None, response: ResponseFormat = None,
+                                     pdf: bool = False, accept: Annotated[Optional[str], Header()] = None):
     """
     Generate packing list for a shipment (POST method)
     
     Parameters:
     - shipment_id: Salesforce Shipment ID (in request body)
+    - preview: "json" or "html" to return the filled values without creating a file
+    - response: "file" to return the xlsx itself (also chosen by an xlsx Accept header)
+    - pdf: also convert the file to PDF and attach it to the record
     """
     try:
         template_path = os.getenv('TEMPLATE_PATH', 'templates/packing_list_template.xlsx')
@@ -496,7 +3939,12 @@ async def generate_packing_list_post(request: ShipmentRequest):
                 detail=f"Template file not found at: {template_path}"
             )
         
-        result = generate_packing_list(request.shipment_id, template_path)
+        if preview:
+            return await run_in_threadpool(run_preview, preview, generate_packing_list, request.shipment_id, template_path)
+
+        result = await run_in_threadpool(generate_with_pdf, pdf, generate_packing_list, request.shipment_id, template_path)
+        if wants_file(response, accept):
+            return file_response(result)
         
         return {
             "status": "success",
@@ -654,44 +4102,191 @@ async def sync_base_service(case_id: str = SF_CASE_ID_DEFAULT):
 
 
 def expand_invoice_items_table(ws, template_row: int, n: int) -> None:
-    max_col = ws.max_column
-    row_style = []
-    for col in range(1, max_col + 1):
-        cell = ws.cell(row=template_row, column=col)
-        row_style.append(style_copy(cell._style) if cell.has_style else None)
-    row_height = ws.row_dimensions[template_row].height
-    add_rows = max(0, n - 1)
+    expand_rows(ws, [(template_row, n)])
 
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > template_row:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-
-    if add_rows > 0:
-        ws.insert_rows(template_row + 1, amount=add_rows)
-        for offset in range(1, add_rows + 1):
-            r = template_row + offset
-            for col in range(1, max_col + 1):
-                dst = ws.cell(row=r, column=col)
-                dst.value = None
-                st = row_style[col - 1]
-                if st is not None:
-                    dst._style = style_copy(st)
-            if row_height is not None:
-                ws.row_dimensions[r].height = row_height
-
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
+def make_invoice_text_renderer(replacements, checkbox_texts, deposits, refunds, surcharge_amount):
+    """
+    Build the text renderer for invoice template cells, mirroring the openpyxl invoice path:
+    placeholders, "None" cleanup, picklist checkboxes, then the deposit / refund / surcharge
+    cells which are replaced as a whole.
+
+    Args:
+        replacements: {placeholder: value} for the shipment fields
+        checkbox_texts: {placeholder: checkbox text}
+        deposits, refunds: Receipt_Reconciliation__c / Case records
+        surcharge_amount: Shipment__c.Surcharge_amount_USD__c
+
+    Returns:
+        Function mapping a template string to the rendered cell value
+    """
+    deposit_labels = "\n".join(
+        f"Deduct: Deposit of PI {(rec.get('Contract_PI__r') or {}).get('Name') or ''}".strip() for rec in deposits
+    )
+    deposit_amounts = "\n".join(
+        "" if rec.get("Reconciled_Amount__c") is None else f"{rec['Reconciled_Amount__c']:,.2f}" for rec in deposits
+    )
+    refund_lines = []
+    for rec in refunds:
+        reason = rec.get("Reason") or ""
+        amt = rec.get("Refund_Amount__c")
+        refund_lines.append(f"{reason} {amt:,.2f}".strip() if amt is not None else reason)
+
+    def render_text(text):
+        for placeholder, value in replacements.items():
+            text = text.replace(placeholder, str(value))
+        if "None" in text:
+            text = text.replace("None", "")
+        for placeholder, value in checkbox_texts.items():
+            text = text.replace(placeholder, value)
+        if "{{TableStart:InvoiceDeposit}}" in text:
+            return deposit_labels or None
+        if "Reconciled_Amount__c" in text:
+            return deposit_amounts or None
+        if "{{TableStart:Shipment__c.r.Cases__r}}" in text:
+            return "\n".join(refund_lines) or None
+        if not refunds and ("{{Refund_Amount__c" in text or "{{TableEnd:Shipment__c.r.Cases__r}}" in text):
+            text = text.replace("{{Refund_Amount__c\\# #,##0.##}}", "")
+            text = text.replace("{{TableEnd:Shipment__c.r.Cases__r}}", "")
+            return text if text.strip() else None
+        if "{{TableStart:Surcharges}}" in text:
+            return "Surcharge:" if surcharge_amount else None
+        if "Surcharge_amount_USD__c" in text:
+            return f"{surcharge_amount:,.2f}" if surcharge_amount else None
+        return text
+
+    return render_text
+
+def invoice_replacements(shipment, account):
+    """{placeholder: value} for the invoice shipment and consignee fields"""
+    return {
+        "{{Shipment__c.Consignee__r.Name}}": account.get("Name") or "",
+        "{{Shipment__c.Consignee__r.BillingStreet}}": account.get("BillingStreet") or "",
+        "{{Shipment__c.Consignee__r.BillingCity}}": account.get("BillingCity") or "",
+        "{{Shipment__c.Consignee__r.BillingPostalCode}}": account.get("BillingPostalCode") or "",
+        "{{Shipment__c.Consignee__r.BillingCountry}}": account.get("BillingCountry") or "",
+        "{{Shipment__c.Consignee__r.Phone}}": account.get("Phone") or "",
+        "{{Shipment__c.Consignee__r.Fax__c}}": account.get("Fax__c") or "",
+        "{{Shipment__c.Consignee__r.VAT__c}}": account.get("VAT__c") or "",
+        "{{Shipment__c.Invoice_Packing_list_no__c}}": shipment.get("Invoice_Packing_list_no__c") or "",
+        "{{Shipment__c.Issued_date__c}}": shipment.get("Issued_date__c") or "",
+        # Port of Origin in uppercase
+        "{{Shipment__c.Port_of_Origin__c}}": (shipment.get("Port_of_Origin__c") or "").upper(),
+        "{{Shipment__c.Final_Destination__c}}": shipment.get("Final_Destination__c") or "",
+        "{{Shipment__c.Stockyard__c}}": shipment.get("Stockyard__c") or "",
+        "{{Shipment__c.Ocean_Vessel__c}}": shipment.get("Ocean_Vessel__c") or "",
+        "{{Shipment__c.B_L_No__c}}": shipment.get("B_L_No__c") or "",
+        "{{Shipment__c.Departure_Date_ETD__c}}": shipment.get("Departure_Date_ETD__c") or "",
+        "{{Shipment__c.Arrival_Schedule_ETA__c}}": shipment.get("Arrival_Schedule_ETA__c") or "",
+        "{{Shipment__c.Remark_number_on_documents__c}}": shipment.get("Remark_number_on_documents__c") or "",
+        "{{Shipment__c.Subtotal_USD__c\\# #,##0.##}}": shipment.get("Subtotal_USD__c") or 0,
+        "{{Shipment__c.Fumigation__c}}": shipment.get("Fumigation__c") or "",
+        "{{Shipment__c.Total_Price_USD__c\\# #,##0.##}}": shipment.get("Total_Price_USD__c") or 0,
+        "{{Shipment__c.In_words__c}}": shipment.get("In_words__c") or "",
+
+        # 🔹 NEW: discount placeholders used by invoice_template_w_discount.xlsx
+        "{{Shipment__c.Discount_Percentage__c}}": shipment.get("Discount_Percentage__c") or "",
+        "{{Shipment__c.Discount_Amount__c\\# #,##0.##}}": shipment.get("Discount_Amount__c") or 0,
+    }
+
+def invoice_checkbox_texts(shipment, freight_options, terms_of_sales_options, terms_of_payment_options):
+    """{placeholder: checkbox text} for the invoice picklist fields (uppercase)"""
+    return {
+        "{{Shipment__c.Freight__c}}": format_picklist_checkboxes(
+            freight_options, shipment.get("Freight__c"), uppercase=True),
+        "{{Shipment__c.Terms_of_Sales__c}}": format_picklist_checkboxes(
+            terms_of_sales_options, shipment.get("Terms_of_Sales__c"), uppercase=True),
+        "{{Shipment__c.Terms_of_Payment__c}}": format_picklist_checkboxes(
+            terms_of_payment_options, shipment.get("Terms_of_Payment__c"), uppercase=True),
+    }
+
+def invoice_item_row(idx, item):
+    """Invoice table values by column index"""
+    container_r = item.get("Container__r") or {}
+    return {
+        1: item.get("Line_item_no_for_print__c") or str(idx + 1),
+        2: item.get("Product_Description__c"),
+        3: item.get("Length__c"),
+        4: item.get("Width__c"),
+        5: item.get("Height__c"),
+        6: item.get("Quantity_For_print__c"),
+        7: item.get("Unit_for_print__c"),
+        8: container_r.get("STT_Cont__c") or container_r.get("Name"),
+        9: f"{item.get('Sales_Price_USD__c') or ''} {item.get('Charge_Unit__c') or ''}".strip(),
+        10: item.get("Total_Price_USD__c"),
+        11: item.get("Order_No__c"),
+    }
+
+def fill_invoice_sheet(ws, table_start_row, table_expanded, render_text, checkbox_texts, item_rows, n_rows):
+    """
+    Fill an invoice sheet loaded with openpyxl.
+
+    Args:
+        ws: Worksheet, pre-expanded to n_rows when table_expanded
+        table_start_row: Row of {{TableStart:ContainerItems}}
+        table_expanded: The item table already has n_rows rows
+        render_text: See make_invoice_text_renderer
+        checkbox_texts: {placeholder: checkbox text}; these cells are wrapped
+        item_rows: {column_index: value} per item (see invoice_item_row)
+        n_rows: Number of table rows (at least 1)
+    """
+    for row in ws.iter_rows():
+        for cell in row:
+            if isinstance(cell.value, str):
+                wrap = any(placeholder in cell.value for placeholder in checkbox_texts)
+                cell.value = render_text(cell.value)
+                if wrap:
+                    cell.alignment = cell.alignment.copy(wrap_text=True)
+
+    # --- ContainerItems table expansion ---
+    if not table_start_row:
+        raise ValueError("No ContainerItems table start marker found in template")
+
+    if not table_expanded:
+        expand_invoice_items_table(ws, table_start_row, n_rows)
+
+    for idx, values in enumerate(item_rows):
+        row_idx = table_start_row + idx
+        for col, value in values.items():
+            ws.cell(row_idx, col).value = value
+
+def render_invoice_stream(template_path, out, render_text, checkbox_texts, item_rows, item_count):
+    """
+    Write an invoice with the direct render engine, consuming item rows lazily.
+
+    Args:
+        template_path: Invoice template (with or without discount)
+        out: Binary file object the xlsx is written to
+        render_text: See make_invoice_text_renderer
+        checkbox_texts: {placeholder: checkbox text}; these cells are wrapped
+        item_rows: Iterator of {column_index: value} dicts
+        item_count: Number of rows item_rows will yield
+    """
+    template = load_direct_template(template_path, "Invoice")
+    table_start = template.find_cell("{{TableStart:ContainerItems}}")
+    if not table_start:
+        raise ValueError("No ContainerItems table start marker found in template")
+
+    template.render_to(
+        out,
+        render_text,
+        table_row=table_start[0],
+        table_rows=item_rows,
+        wrap_placeholders=tuple(checkbox_texts),
+        row_count=item_count,
+        inline_table_strings=True,
+    )
 
 @app.get("/generate_invoice/{shipment_id}")
-def generate_invoice(shipment_id: str):
+def generate_invoice(shipment_id: str, preview: PreviewMode = None, response: ResponseFormat = None,
+                     pdf: bool = False, accept: Annotated[Optional[str], Header()] = None):
+    if preview:
+        return run_preview(preview, generate_invoice, shipment_id)
+    if pdf:
+        result = generate_with_pdf(pdf, generate_invoice, shipment_id)
+        return file_response(result) if wants_file(response, accept) else result
+    if wants_file(response, accept):
+        return file_response(generate_invoice(shipment_id))
+
     sf = get_salesforce_connection()
 
     # Base and discount templates
@@ -760,8 +4355,10 @@ def generate_invoice(shipment_id: str):
     WHERE Shipment__c = '{shipment_id}'
     ORDER BY Line_item_no_for_print__c
     """
-    items_result = sf.query_all(items_query)
-    items = items_result["records"]
+    # Large shipments are streamed page by page instead of loading every item first
+    item_count, item_records = query_records(sf, items_query)
+    stream = item_count >= STREAM_RENDER_MIN_ROWS and not preview_active()
+    items = [] if stream else list(item_records)
 
     # 💡 FIXED: use existing fields only
     deposit_query = f"""
@@ -769,221 +4366,39 @@ def generate_invoice(shipment_id: str):
     FROM Receipt_Reconciliation__c
     WHERE Invoice__c = '{shipment_id}'
     """
-    deposits = sf.query_all(deposit_query)["records"]
-
-    refunds_query = f"""
-    SELECT Reason, Refund_Amount__c
-    FROM Case
-    WHERE Refund_in_Shipment__c = '{shipment_id}'
-    """
-    refunds = sf.query_all(refunds_query)["records"]
-
-    # Build debug data for response
-    debug_data = {
-        "shipment": {k: v for k, v in shipment.items() if k != "attributes"},
-        "account": {k: v for k, v in account.items() if k != "attributes"} if account else {},
-        "container_items": [
-            {k: v for k, v in item.items() if k != "attributes"}
-            for item in items
-        ],
-        "deposits": [
-            {k: v for k, v in dep.items() if k != "attributes"}
-            for dep in deposits
-        ],
-        "refunds": [
-            {k: v for k, v in ref.items() if k != "attributes"}
-            for ref in refunds
-        ],
-        "picklist_options": {
-            "Freight__c": freight_options,
-            "Terms_of_Sales__c": terms_of_sales_options,
-            "Terms_of_Payment__c": terms_of_payment_options,
-        },
-        "discount_exists": discount_exists,
-        "template_used": template_path,
-    }
-
-    wb = openpyxl.load_workbook(template_path)
-    ws = wb["Invoice"] if "Invoice" in wb.sheetnames else wb.active
-
-    # Format Port of Origin in uppercase
-    port_of_origin = (shipment.get("Port_of_Origin__c") or "").upper()
-
-    replacements = {
-        "{{Shipment__c.Consignee__r.Name}}": account.get("Name") or "",
-        "{{Shipment__c.Consignee__r.BillingStreet}}": account.get("BillingStreet") or "",
-        "{{Shipment__c.Consignee__r.BillingCity}}": account.get("BillingCity") or "",
-        "{{Shipment__c.Consignee__r.BillingPostalCode}}": account.get("BillingPostalCode") or "",
-        "{{Shipment__c.Consignee__r.BillingCountry}}": account.get("BillingCountry") or "",
-        "{{Shipment__c.Consignee__r.Phone}}": account.get("Phone") or "",
-        "{{Shipment__c.Consignee__r.Fax__c}}": account.get("Fax__c") or "",
-        "{{Shipment__c.Consignee__r.VAT__c}}": account.get("VAT__c") or "",
-        "{{Shipment__c.Invoice_Packing_list_no__c}}": shipment.get("Invoice_Packing_list_no__c") or "",
-        "{{Shipment__c.Issued_date__c}}": shipment.get("Issued_date__c") or "",
-        "{{Shipment__c.Port_of_Origin__c}}": port_of_origin,
-        "{{Shipment__c.Final_Destination__c}}": shipment.get("Final_Destination__c") or "",
-        "{{Shipment__c.Stockyard__c}}": shipment.get("Stockyard__c") or "",
-        "{{Shipment__c.Ocean_Vessel__c}}": shipment.get("Ocean_Vessel__c") or "",
-        "{{Shipment__c.B_L_No__c}}": shipment.get("B_L_No__c") or "",
-        "{{Shipment__c.Departure_Date_ETD__c}}": shipment.get("Departure_Date_ETD__c") or "",
-        "{{Shipment__c.Arrival_Schedule_ETA__c}}": shipment.get("Arrival_Schedule_ETA__c") or "",
-        "{{Shipment__c.Remark_number_on_documents__c}}": shipment.get("Remark_number_on_documents__c") or "",
-        "{{Shipment__c.Subtotal_USD__c\\# #,##0.##}}": shipment.get("Subtotal_USD__c") or 0,
-        "{{Shipment__c.Fumigation__c}}": shipment.get("Fumigation__c") or "",
-        "{{Shipment__c.Total_Price_USD__c\\# #,##0.##}}": shipment.get("Total_Price_USD__c") or 0,
-        "{{Shipment__c.In_words__c}}": shipment.get("In_words__c") or "",
-
-        # 🔹 NEW: discount placeholders used by invoice_template_w_discount.xlsx
-        "{{Shipment__c.Discount_Percentage__c}}": shipment.get("Discount_Percentage__c") or "",
-        "{{Shipment__c.Discount_Amount__c\\# #,##0.##}}": shipment.get("Discount_Amount__c") or 0,
-    }
-
-    for row in ws.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                for placeholder, value in replacements.items():
-                    cell.value = cell.value.replace(placeholder, str(value))
-
-    # Clean "None"
-    for row in ws.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str) and "None" in cell.value:
-                cell.value = cell.value.replace("None", "")
-
-    # 💡 FIXED: correct parameter order for checkboxes + uppercase
-    freight_checkbox_text = format_picklist_checkboxes(
-        freight_options, shipment.get("Freight__c"), uppercase=True
-    )
-    terms_of_sales_checkbox_text = format_picklist_checkboxes(
-        terms_of_sales_options, shipment.get("Terms_of_Sales__c"), uppercase=True
-    )
-    terms_of_payment_checkbox_text = format_picklist_checkboxes(
-        terms_of_payment_options, shipment.get("Terms_of_Payment__c"), uppercase=True
-    )
-
-    for row in ws.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                if "{{Shipment__c.Freight__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Freight__c}}", freight_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-                if "{{Shipment__c.Terms_of_Sales__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Terms_of_Sales__c}}", terms_of_sales_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-                if "{{Shipment__c.Terms_of_Payment__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Terms_of_Payment__c}}", terms_of_payment_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-
-    # --- ContainerItems table expansion ---
-    table_start_row = None
-    for row in ws.iter_rows(min_row=1, max_row=ws.max_row, min_col=1, max_col=ws.max_column):
-        for cell in row:
-            if isinstance(cell.value, str) and "{{TableStart:ContainerItems}}" in cell.value:
-                table_start_row = cell.row
-                break
-        if table_start_row:
-            break
-
-    if not table_start_row:
-        raise ValueError("No ContainerItems table start marker found in template")
-
-    expand_invoice_items_table(ws, table_start_row, len(items) if items else 1)
-
-    for idx, item in enumerate(items):
-        row_idx = table_start_row + idx
-        container_r = item.get("Container__r") or {}
-        line_item_no = item.get("Line_item_no_for_print__c") or str(idx + 1)
-        ws.cell(row_idx, 1).value = line_item_no
-        ws.cell(row_idx, 2).value = item.get("Product_Description__c")
-        ws.cell(row_idx, 3).value = item.get("Length__c")
-        ws.cell(row_idx, 4).value = item.get("Width__c")
-        ws.cell(row_idx, 5).value = item.get("Height__c")
-        ws.cell(row_idx, 6).value = item.get("Quantity_For_print__c")
-        ws.cell(row_idx, 7).value = item.get("Unit_for_print__c")
-        ws.cell(row_idx, 8).value = container_r.get("STT_Cont__c") or container_r.get("Name")
-        ws.cell(row_idx, 9).value = f"{item.get('Sales_Price_USD__c') or ''} {item.get('Charge_Unit__c') or ''}".strip()
-        ws.cell(row_idx, 10).value = item.get("Total_Price_USD__c")
-        ws.cell(row_idx, 11).value = item.get("Order_No__c")
-
-    # --- Deposits / refunds / surcharge sections (back to working behaviour) ---
-    deposit_text_cell = None
-    deposit_amount_cell = None
-    refund_cell = None
-    surcharge_text_cell = None
-    surcharge_amount_cell = None
-
-    for row in ws.iter_rows():
-        for cell in row:
-            if not isinstance(cell.value, str):
-                continue
-            val = cell.value
-            if "{{TableStart:InvoiceDeposit}}" in val:
-                deposit_text_cell = cell
-            if "Reconciled_Amount__c" in val:
-                deposit_amount_cell = cell
-            if "{{TableStart:Shipment__c.r.Cases__r}}" in val:
-                refund_cell = cell
-            if "{{TableStart:Surcharges}}" in val:
-                surcharge_text_cell = cell
-            if "Surcharge_amount_USD__c" in val:
-                surcharge_amount_cell = cell
-
-    # Deposits: multi-line "Deduct: Deposit of PI X"
-    if deposit_text_cell and deposit_amount_cell:
-        if deposits:
-            labels = []
-            amounts = []
-            for rec in deposits:
-                pi_name = (rec.get("Contract_PI__r") or {}).get("Name") or ""
-                labels.append(f"Deduct: Deposit of PI {pi_name}".strip())
-                amt = rec.get("Reconciled_Amount__c")
-                amounts.append("" if amt is None else f"{amt:,.2f}")
-            deposit_text_cell.value = "\n".join(labels)
-            deposit_amount_cell.value = "\n".join(amounts)
-        else:
-            deposit_text_cell.value = None
-            deposit_amount_cell.value = None
-
-    # Refunds section
-    if refund_cell:
-        if refunds:
-            lines = []
-            for rec in refunds:
-                reason = rec.get("Reason") or ""
-                amt = rec.get("Refund_Amount__c")
-                part = reason
-                if amt is not None:
-                    part = f"{reason} {amt:,.2f}".strip()
-                lines.append(part)
-            refund_cell.value = "\n".join(lines)
-        else:
-            refund_cell.value = None
+    deposits = sf.query_all(deposit_query)["records"]
 
-    # Clean remaining refund placeholders if no refunds
-    for row in ws.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                if "{{Refund_Amount__c" in cell.value or "{{TableEnd:Shipment__c.r.Cases__r}}" in cell.value:
-                    if not refunds:
-                        cell.value = cell.value.replace("{{Refund_Amount__c\\# #,##0.##}}", "")
-                        cell.value = cell.value.replace("{{TableEnd:Shipment__c.r.Cases__r}}", "")
-                        if cell.value and not cell.value.strip():
-                            cell.value = None
-
-    # Surcharge
-    surcharge_amount = shipment.get("Surcharge_amount_USD__c")
-    if surcharge_text_cell or surcharge_amount_cell:
-        if surcharge_amount:
-            if surcharge_text_cell:
-                surcharge_text_cell.value = "Surcharge:"
-            if surcharge_amount_cell:
-                surcharge_amount_cell.value = f"{surcharge_amount:,.2f}"
-        else:
-            if surcharge_text_cell:
-                surcharge_text_cell.value = None
-            if surcharge_amount_cell:
-                surcharge_amount_cell.value = None
+    refunds_query = f"""
+    SELECT Reason, Refund_Amount__c
+    FROM Case
+    WHERE Refund_in_Shipment__c = '{shipment_id}'
+    """
+    refunds = sf.query_all(refunds_query)["records"]
 
+    # Build debug data for response
+    debug_data = {
+        "shipment": {k: v for k, v in shipment.items() if k != "attributes"},
+        "account": {k: v for k, v in account.items() if k != "attributes"} if account else {},
+        "container_items": [
+            {k: v for k, v in item.items() if k != "attributes"}
+            for item in items
+        ],
+        "deposits": [
+            {k: v for k, v in dep.items() if k != "attributes"}
+            for dep in deposits
+        ],
+        "refunds": [
+            {k: v for k, v in ref.items() if k != "attributes"}
+            for ref in refunds
+        ],
+        "picklist_options": {
+            "Freight__c": freight_options,
+            "Terms_of_Sales__c": terms_of_sales_options,
+            "Terms_of_Payment__c": terms_of_payment_options,
+        },
+        "discount_exists": discount_exists,
+        "template_used": template_path,
+    }
 
     # Save file
     now = datetime.datetime.now()
@@ -994,36 +4409,69 @@ def generate_invoice(shipment_id: str):
     output_dir = get_output_directory()
     file_path = output_dir / file_name
 
-    wb.save(str(file_path))
+    # Placeholders, picklist checkboxes and the deposit / refund / surcharge cells
+    checkbox_texts = invoice_checkbox_texts(shipment, freight_options, terms_of_sales_options,
+                                            terms_of_payment_options)
+    render_text = make_invoice_text_renderer(invoice_replacements(shipment, account), checkbox_texts,
+                                             deposits, refunds, shipment.get("Surcharge_amount_USD__c"))
+
+    if stream:
+        # Rendered into a temporary file, uploaded and served from it
+        rendered = RenderedFile()
+        render_invoice_stream(
+            template_path, rendered, render_text, checkbox_texts,
+            (invoice_item_row(idx, item) for idx, item in enumerate(item_records)), item_count,
+        )
+        data = keep_output(file_path, rendered.finish())
+    else:
+        invoice_rows = [invoice_item_row(idx, item) for idx, item in enumerate(items)]
+
+        # Incremental mode: patch the previous output when only cell values changed
+        bundle = None
+        if INCREMENTAL_RENDER:
+            bundle = build_render_bundle(template_path, "Invoice", "{{TableStart:ContainerItems}}",
+                                         render_text, invoice_rows, file_path)
+        data = patch_previous_render(load_render_bundle("invoice", shipment_id) if bundle else None,
+                                     bundle, file_path)
+        if data is None or INCREMENTAL_RENDER_VERIFY:
+            # Load template, pre-expanded to the item count when a bucket fits
+            wb, ws, table_start_row, table_expanded = load_template_for_rows(
+                template_path, "Invoice", "{{TableStart:ContainerItems}}", len(items) if items else 1
+            )
+
+            fill_invoice_sheet(ws, table_start_row, table_expanded, render_text, checkbox_texts, invoice_rows,
+                               len(items) if items else 1)
+            if bundle:
+                settle_render_bundle(bundle, ws)
+            data = check_patched_render(data, workbook_bytes(wb, file_name), "Invoice", file_name)
+        keep_output(file_path, data)
+        if bundle:
+            save_render_bundle("invoice", shipment_id, bundle)
 
     # Upload to Salesforce as ContentVersion
-    with open(file_path, "rb") as f:
-        data = f.read()
-    encoded = base64.b64encode(data).decode("utf-8")
-
-    content_version = sf.ContentVersion.create(
-        {
-            "Title": file_name.rsplit(".", 1)[0],
-            "PathOnClient": file_name,
-            "VersionData": encoded,
-            "FirstPublishLocationId": shipment_id,
-        }
-    )
+    content_version = publish_content_version(sf, file_name, data, shipment_id, "Invoice_")
 
     return {
         "file_path": str(file_path),
         "file_name": file_name,
         "salesforce_content_version_id": content_version["id"],
+        "publish_job_id": content_version.get("publish_job_id"),
+        "download_url": download_url(file_name),
         "freight_options_used": freight_options,
         "deposit_count": len(deposits),
         "refund_count": len(refunds),
         "discount_exists": discount_exists,
         "template_used": template_path,
+        "streamed": stream,
         "debug_data": debug_data,
     }
 
+# Salesforce reads of the combined export, shared by all requests
+_COMBINED_QUERY_WORKERS = ThreadPoolExecutor(max_workers=8, thread_name_prefix="combined-query")
+
 @app.get("/generate-combined-export/{shipment_id}")
-def generate_combined_export(shipment_id: str):
+def generate_combined_export(shipment_id: str, preview: PreviewMode = None, response: ResponseFormat = None,
+                             pdf: bool = False, accept: Annotated[Optional[str], Header()] = None):
     """
     Generate combined packing list and invoice in one Excel file with two sheets.
     First sheet: "Packing List"
@@ -1031,7 +4479,18 @@ def generate_combined_export(shipment_id: str):
     
     Parameters:
     - shipment_id: Salesforce Shipment ID
+    - preview: "json" or "html" to return the filled values without creating a file
+    - response: "file" to return the xlsx itself (also chosen by an xlsx Accept header)
+    - pdf: also convert the file to PDF and attach it to the record
     """
+    if preview:
+        return run_preview(preview, generate_combined_export, shipment_id)
+    if pdf:
+        result = generate_with_pdf(pdf, generate_combined_export, shipment_id)
+        return file_response(result) if wants_file(response, accept) else result
+    if wants_file(response, accept):
+        return file_response(generate_combined_export(shipment_id))
+
     sf = get_salesforce_connection()
     
     # Templates
@@ -1046,10 +4505,11 @@ def generate_combined_export(shipment_id: str):
             detail=f"Packing list template not found at: {packing_list_template_path}"
         )
     
+    # Independent Salesforce reads are network bound, so they run concurrently
     # Get picklist values dynamically
-    freight_options = get_picklist_values(sf, 'Shipment__c', 'Freight__c')
-    terms_of_sales_options = get_picklist_values(sf, 'Shipment__c', 'Terms_of_Sales__c')
-    terms_of_payment_options = get_picklist_values(sf, 'Shipment__c', 'Terms_of_Payment__c')
+    freight_options_f = _COMBINED_QUERY_WORKERS.submit(get_picklist_values, sf, 'Shipment__c', 'Freight__c')
+    terms_of_sales_options_f = _COMBINED_QUERY_WORKERS.submit(get_picklist_values, sf, 'Shipment__c', 'Terms_of_Sales__c')
+    terms_of_payment_options_f = _COMBINED_QUERY_WORKERS.submit(get_picklist_values, sf, 'Shipment__c', 'Terms_of_Payment__c')
     
     # Query shipment data (combining fields from both packing list and invoice)
     shipment_query = f"""
@@ -1087,10 +4547,9 @@ def generate_combined_export(shipment_id: str):
         FROM Account
         WHERE Id = '{shipment['Consignee__c']}'
         """
-        account_result = sf.query(account_query)
-        account = account_result["records"][0] if account_result["records"] else {}
+        account_f = _COMBINED_QUERY_WORKERS.submit(sf.query, account_query)
     else:
-        account = {}
+        account_f = None
     
     # Query bookings (for packing list)
     bookings_query = f"""
@@ -1098,9 +4557,7 @@ def generate_combined_export(shipment_id: str):
     FROM Booking__c
     WHERE Shipment__c = '{shipment_id}'
     """
-    bookings_result = sf.query_all(bookings_query)
-    bookings = bookings_result['records']
-    total_containers_from_bookings = sum(booking.get('Cont_Quantity__c') or 0 for booking in bookings)
+    bookings_f = _COMBINED_QUERY_WORKERS.submit(sf.query_all, bookings_query)
     
     # Query container items (both packing list and invoice use this)
     items_query = f"""
@@ -1115,8 +4572,7 @@ def generate_combined_export(shipment_id: str):
     WHERE Shipment__c = '{shipment_id}'
     ORDER BY Line_item_no_for_print__c
     """
-    items_result = sf.query_all(items_query)
-    items = items_result["records"]
+    items_f = _COMBINED_QUERY_WORKERS.submit(sf.query_all, items_query)
     
     # Query deposits (for invoice)
     deposit_query = f"""
@@ -1124,7 +4580,7 @@ def generate_combined_export(shipment_id: str):
     FROM Receipt_Reconciliation__c
     WHERE Invoice__c = '{shipment_id}'
     """
-    deposits = sf.query_all(deposit_query)["records"]
+    deposits_f = _COMBINED_QUERY_WORKERS.submit(sf.query_all, deposit_query)
     
     # Query refunds (for invoice)
     refunds_query = f"""
@@ -1132,344 +4588,53 @@ def generate_combined_export(shipment_id: str):
     FROM Case
     WHERE Refund_in_Shipment__c = '{shipment_id}'
     """
-    refunds = sf.query_all(refunds_query)["records"]
-    
-    # ===== GENERATE PACKING LIST SHEET =====
-    wb_packing = openpyxl.load_workbook(packing_list_template_path)
-    ws_packing = wb_packing['PackingList']
-    
-    # Packing list replacements
-    packing_replacements = {
-        '{{Shipment__c.Consignee__r.Name}}': account.get('Name') or '',
-        '{{Shipment__c.Consignee__r.BillingStreet}}': account.get('BillingStreet') or '',
-        '{{Shipment__c.Consignee__r.BillingCity}}': account.get('BillingCity') or '',
-        '{{Shipment__c.Consignee__r.BillingPostalCode}}': account.get('BillingPostalCode') or '',
-        '{{Shipment__c.Consignee__r.BillingCountry}}': account.get('BillingCountry') or '',
-        '{{Shipment__c.Consignee__r.Phone}}': account.get('Phone') or '',
-        '{{Shipment__c.Consignee__r.Fax__c}}': account.get('Fax__c') or '',
-        '{{Shipment__c.Consignee__r.VAT__c}}': account.get('VAT__c') or '',
-        '{{Shipment__c.Invoice_Packing_list_no__c}}': shipment.get('Invoice_Packing_list_no__c') or '',
-        '{{Shipment__c.Issued_date__c}}': shipment.get('Issued_date__c') or '',
-        '{{Shipment__c.Port_of_Origin__c}}': shipment.get('Port_of_Origin__c') or '',
-        '{{Shipment__c.Final_Destination__c}}': shipment.get('Final_Destination__c') or '',
-        '{{Shipment__c.Stockyard__c}}': shipment.get('Stockyard__c') or '',
-        '{{Shipment__c.Ocean_Vessel__c}}': shipment.get('Ocean_Vessel__c') or '',
-        '{{Shipment__c.B_L_No__c}}': shipment.get('B_L_No__c') or '',
-        '{{Shipment__c.Departure_Date_ETD__c}}': shipment.get('Departure_Date_ETD__c') or '',
-        '{{Shipment__c.Arrival_Schedule_ETA__c}}': shipment.get('Arrival_Schedule_ETA__c') or '',
-        '{{Shipment__c.Remark_number_on_documents__c}}': shipment.get('Remark_number_on_documents__c') or '',
-        '{{Shipment__c.Terms_of_Sales__c}}': shipment.get('Terms_of_Sales__c') or '',
-        '{{Shipment__c.Terms_of_Payment__c}}': shipment.get('Terms_of_Payment__c') or '',
-    }
-    
-    for row in ws_packing.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str):
-                for placeholder, value in packing_replacements.items():
-                    cell.value = cell.value.replace(placeholder, str(value))
-                if '{{TableStart:Shipment__c.r.Bookings__r}}' in cell.value:
-                    cell.value = str(total_containers_from_bookings)
-    
-    # Remove "None" values
-    for row in ws_packing.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str) and 'None' in cell.value:
-                cell.value = cell.value.replace('None', '')
-    
-    # Handle freight checkboxes for packing list
-    freight_value = (shipment.get('Freight__c') or '').strip()
-    freight_upper = freight_value.upper()
-    checked_box = '☑'
-    unchecked_box = '☐'
-    
-    lines = []
-    for opt in freight_options:
-        mark = checked_box if opt.upper() == freight_upper else unchecked_box
-        lines.append(f"{mark} {opt}")
-    checkbox_text = "\n".join(lines)
-    
-    for row in ws_packing.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str) and '{{Shipment__c.Freight__c}}' in cell.value:
-                cell.value = cell.value.replace('{{Shipment__c.Freight__c}}', checkbox_text)
-                if cell.alignment:
-                    new_alignment = style_copy(cell.alignment)
-                else:
-                    from openpyxl.styles import Alignment
-                    new_alignment = Alignment()
-                new_alignment.wrap_text = True
-                cell.alignment = new_alignment
-    
-    # Find table start row for packing list
-    table_start_row = None
-    for row in ws_packing.iter_rows(min_row=1, max_row=ws_packing.max_row, min_col=1, max_col=13):
-        for cell in row:
-            if cell.value and '{{TableStart:ContainerItems}}' in str(cell.value):
-                table_start_row = cell.row
-                break
-        if table_start_row:
-            break
-    
-    if not table_start_row:
-        raise ValueError("No table start marker found in packing list template")
-    
-    # Expand table for packing list
-    expand_items_table(ws_packing, table_start_row, len(items) if items else 1)
-    
-    # Fill in item data for packing list
-    for idx, item in enumerate(items):
-        row = table_start_row + idx
-        container_r = item.get('Container__r', {})
-        line_item_no = item.get('Line_item_no_for_print__c') or str(idx + 1)
-        ws_packing.cell(row, 1).value = line_item_no
-        ws_packing.cell(row, 2).value = item.get('Product_Description__c')
-        ws_packing.cell(row, 3).value = item.get('Length__c')
-        ws_packing.cell(row, 4).value = item.get('Width__c')
-        ws_packing.cell(row, 5).value = item.get('Height__c')
-        ws_packing.cell(row, 6).value = item.get('Quantity_For_print__c') or ''
-        ws_packing.cell(row, 7).value = item.get('Unit_for_print__c') or ''
-        ws_packing.cell(row, 8).value = item.get('Crates__c')
-        ws_packing.cell(row, 9).value = f"{item.get('Packing__c') or ''} pcs/crate"
-        ws_packing.cell(row, 10).value = container_r.get('Container_Weight_Regulation__c')
-        ws_packing.cell(row, 11).value = container_r.get('Name')
-        ws_packing.cell(row, 13).value = item.get('Order_No__c')
-    
-    # ===== GENERATE INVOICE SHEET =====
-    wb_invoice = openpyxl.load_workbook(invoice_template_path)
-    ws_invoice = wb_invoice["Invoice"] if "Invoice" in wb_invoice.sheetnames else wb_invoice.active
-    
-    # Format Port of Origin in uppercase
-    port_of_origin = (shipment.get("Port_of_Origin__c") or "").upper()
-    
-    # Invoice replacements
-    invoice_replacements = {
-        "{{Shipment__c.Consignee__r.Name}}": account.get("Name") or "",
-        "{{Shipment__c.Consignee__r.BillingStreet}}": account.get("BillingStreet") or "",
-        "{{Shipment__c.Consignee__r.BillingCity}}": account.get("BillingCity") or "",
-        "{{Shipment__c.Consignee__r.BillingPostalCode}}": account.get("BillingPostalCode") or "",
-        "{{Shipment__c.Consignee__r.BillingCountry}}": account.get("BillingCountry") or "",
-        "{{Shipment__c.Consignee__r.Phone}}": account.get("Phone") or "",
-        "{{Shipment__c.Consignee__r.Fax__c}}": account.get("Fax__c") or "",
-        "{{Shipment__c.Consignee__r.VAT__c}}": account.get("VAT__c") or "",
-        "{{Shipment__c.Invoice_Packing_list_no__c}}": shipment.get("Invoice_Packing_list_no__c") or "",
-        "{{Shipment__c.Issued_date__c}}": shipment.get("Issued_date__c") or "",
-        "{{Shipment__c.Port_of_Origin__c}}": port_of_origin,
-        "{{Shipment__c.Final_Destination__c}}": shipment.get("Final_Destination__c") or "",
-        "{{Shipment__c.Stockyard__c}}": shipment.get("Stockyard__c") or "",
-        "{{Shipment__c.Ocean_Vessel__c}}": shipment.get("Ocean_Vessel__c") or "",
-        "{{Shipment__c.B_L_No__c}}": shipment.get("B_L_No__c") or "",
-        "{{Shipment__c.Departure_Date_ETD__c}}": shipment.get("Departure_Date_ETD__c") or "",
-        "{{Shipment__c.Arrival_Schedule_ETA__c}}": shipment.get("Arrival_Schedule_ETA__c") or "",
-        "{{Shipment__c.Remark_number_on_documents__c}}": shipment.get("Remark_number_on_documents__c") or "",
-        "{{Shipment__c.Subtotal_USD__c\\# #,##0.##}}": shipment.get("Subtotal_USD__c") or 0,
-        "{{Shipment__c.Fumigation__c}}": shipment.get("Fumigation__c") or "",
-        "{{Shipment__c.Total_Price_USD__c\\# #,##0.##}}": shipment.get("Total_Price_USD__c") or 0,
-        "{{Shipment__c.In_words__c}}": shipment.get("In_words__c") or "",
-        "{{Shipment__c.Discount_Percentage__c}}": shipment.get("Discount_Percentage__c") or "",
-        "{{Shipment__c.Discount_Amount__c\\# #,##0.##}}": shipment.get("Discount_Amount__c") or 0,
-    }
-    
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                for placeholder, value in invoice_replacements.items():
-                    cell.value = cell.value.replace(placeholder, str(value))
+    refunds_f = _COMBINED_QUERY_WORKERS.submit(sf.query_all, refunds_query)
+    
+    # Two-sheet template (compiled once from the packing list and invoice templates)
+    combined_template_f = _COMBINED_QUERY_WORKERS.submit(compile_combined_template, [
+        (packing_list_template_path, 'PackingList', 'Packing List'),
+        (invoice_template_path, 'Invoice', 'Invoice'),
+    ])
+    
+    freight_options = freight_options_f.result()
+    terms_of_sales_options = terms_of_sales_options_f.result()
+    terms_of_payment_options = terms_of_payment_options_f.result()
+    if account_f:
+        account_result = account_f.result()
+        account = account_result["records"][0] if account_result["records"] else {}
+    else:
+        account = {}
+    bookings = bookings_f.result()['records']
+    items = items_f.result()["records"]
+    deposits = deposits_f.result()["records"]
+    refunds = refunds_f.result()["records"]
+    combined_template_path = combined_template_f.result()
+    total_containers_from_bookings = sum(booking.get('Cont_Quantity__c') or 0 for booking in bookings)
     
-    # Clean "None"
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str) and "None" in cell.value:
-                cell.value = cell.value.replace("None", "")
+    n_rows = len(items) if items else 1
     
-    # Format picklist fields with checkboxes (uppercase)
-    freight_checkbox_text = format_picklist_checkboxes(
-        freight_options, shipment.get("Freight__c"), uppercase=True
+    # Both sheets live in one workbook, pre-expanded to the item count when a bucket fits
+    combined_wb, [(ws_packing, table_start_row), (ws_invoice, invoice_table_start_row)], tables_expanded = load_template_tables(
+        combined_template_path,
+        [('Packing List', '{{TableStart:ContainerItems}}'), ('Invoice', '{{TableStart:ContainerItems}}')],
+        n_rows,
     )
-    terms_of_sales_checkbox_text = format_picklist_checkboxes(
-        terms_of_sales_options, shipment.get("Terms_of_Sales__c"), uppercase=True
-    )
-    terms_of_payment_checkbox_text = format_picklist_checkboxes(
-        terms_of_payment_options, shipment.get("Terms_of_Payment__c"), uppercase=True
-    )
-    
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                if "{{Shipment__c.Freight__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Freight__c}}", freight_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-                if "{{Shipment__c.Terms_of_Sales__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Terms_of_Sales__c}}", terms_of_sales_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-                if "{{Shipment__c.Terms_of_Payment__c}}" in cell.value:
-                    cell.value = cell.value.replace("{{Shipment__c.Terms_of_Payment__c}}", terms_of_payment_checkbox_text)
-                    cell.alignment = cell.alignment.copy(wrap_text=True)
-    
-    # Find ContainerItems table for invoice
-    invoice_table_start_row = None
-    for row in ws_invoice.iter_rows(min_row=1, max_row=ws_invoice.max_row, min_col=1, max_col=ws_invoice.max_column):
-        for cell in row:
-            if isinstance(cell.value, str) and "{{TableStart:ContainerItems}}" in cell.value:
-                invoice_table_start_row = cell.row
-                break
-        if invoice_table_start_row:
-            break
-    
-    if not invoice_table_start_row:
-        raise ValueError("No ContainerItems table start marker found in invoice template")
-    
-    expand_invoice_items_table(ws_invoice, invoice_table_start_row, len(items) if items else 1)
-    
-    for idx, item in enumerate(items):
-        row_idx = invoice_table_start_row + idx
-        container_r = item.get("Container__r") or {}
-        line_item_no = item.get("Line_item_no_for_print__c") or str(idx + 1)
-        ws_invoice.cell(row_idx, 1).value = line_item_no
-        ws_invoice.cell(row_idx, 2).value = item.get("Product_Description__c")
-        ws_invoice.cell(row_idx, 3).value = item.get("Length__c")
-        ws_invoice.cell(row_idx, 4).value = item.get("Width__c")
-        ws_invoice.cell(row_idx, 5).value = item.get("Height__c")
-        ws_invoice.cell(row_idx, 6).value = item.get("Quantity_For_print__c")
-        ws_invoice.cell(row_idx, 7).value = item.get("Unit_for_print__c")
-        ws_invoice.cell(row_idx, 8).value = container_r.get("STT_Cont__c") or container_r.get("Name")
-        ws_invoice.cell(row_idx, 9).value = f"{item.get('Sales_Price_USD__c') or ''} {item.get('Charge_Unit__c') or ''}".strip()
-        ws_invoice.cell(row_idx, 10).value = item.get("Total_Price_USD__c")
-        ws_invoice.cell(row_idx, 11).value = item.get("Order_No__c")
-    
-    # Handle deposits / refunds / surcharge sections
-    deposit_text_cell = None
-    deposit_amount_cell = None
-    refund_cell = None
-    surcharge_text_cell = None
-    surcharge_amount_cell = None
-    
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if not isinstance(cell.value, str):
-                continue
-            val = cell.value
-            if "{{TableStart:InvoiceDeposit}}" in val:
-                deposit_text_cell = cell
-            if "Reconciled_Amount__c" in val:
-                deposit_amount_cell = cell
-            if "{{TableStart:Shipment__c.r.Cases__r}}" in val:
-                refund_cell = cell
-            if "{{TableStart:Surcharges}}" in val:
-                surcharge_text_cell = cell
-            if "Surcharge_amount_USD__c" in val:
-                surcharge_amount_cell = cell
-    
-    if deposit_text_cell and deposit_amount_cell:
-        if deposits:
-            labels = []
-            amounts = []
-            for rec in deposits:
-                pi_name = (rec.get("Contract_PI__r") or {}).get("Name") or ""
-                labels.append(f"Deduct: Deposit of PI {pi_name}".strip())
-                amt = rec.get("Reconciled_Amount__c")
-                amounts.append("" if amt is None else f"{amt:,.2f}")
-            deposit_text_cell.value = "\n".join(labels)
-            deposit_amount_cell.value = "\n".join(amounts)
-        else:
-            deposit_text_cell.value = None
-            deposit_amount_cell.value = None
-    
-    if refund_cell:
-        if refunds:
-            lines = []
-            for rec in refunds:
-                reason = rec.get("Reason") or ""
-                amt = rec.get("Refund_Amount__c")
-                part = reason
-                if amt is not None:
-                    part = f"{reason} {amt:,.2f}".strip()
-                lines.append(part)
-            refund_cell.value = "\n".join(lines)
-        else:
-            refund_cell.value = None
-    
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str):
-                if "{{Refund_Amount__c" in cell.value or "{{TableEnd:Shipment__c.r.Cases__r}}" in cell.value:
-                    if not refunds:
-                        cell.value = cell.value.replace("{{Refund_Amount__c\\# #,##0.##}}", "")
-                        cell.value = cell.value.replace("{{TableEnd:Shipment__c.r.Cases__r}}", "")
-                        if cell.value and not cell.value.strip():
-                            cell.value = None
-    
-    surcharge_amount = shipment.get("Surcharge_amount_USD__c")
-    if surcharge_text_cell or surcharge_amount_cell:
-        if surcharge_amount:
-            if surcharge_text_cell:
-                surcharge_text_cell.value = "Surcharge:"
-            if surcharge_amount_cell:
-                surcharge_amount_cell.value = f"{surcharge_amount:,.2f}"
-        else:
-            if surcharge_text_cell:
-                surcharge_text_cell.value = None
-            if surcharge_amount_cell:
-                surcharge_amount_cell.value = None
-    
-    # ===== COMBINE INTO ONE WORKBOOK =====
-    # Create a new workbook and copy sheets
-    combined_wb = openpyxl.Workbook()
-    combined_wb.remove(combined_wb.active)  # Remove default sheet
-    
-    # Copy packing list sheet
-    ws_packing_copy = combined_wb.create_sheet("Packing List")
-    for row in ws_packing.iter_rows():
-        for cell in row:
-            new_cell = ws_packing_copy.cell(row=cell.row, column=cell.column, value=cell.value)
-            if cell.has_style:
-                new_cell.font = style_copy(cell.font)
-                new_cell.border = style_copy(cell.border)
-                new_cell.fill = style_copy(cell.fill)
-                new_cell.number_format = style_copy(cell.number_format)
-                new_cell.protection = style_copy(cell.protection)
-                new_cell.alignment = style_copy(cell.alignment)
-    
-    # Copy column dimensions
-    for col in ws_packing.column_dimensions:
-        if col in ws_packing.column_dimensions:
-            combined_wb["Packing List"].column_dimensions[col].width = ws_packing.column_dimensions[col].width
-    
-    # Copy row dimensions
-    for row in ws_packing.row_dimensions:
-        if row in ws_packing.row_dimensions:
-            combined_wb["Packing List"].row_dimensions[row].height = ws_packing.row_dimensions[row].height
-    
-    # Copy merged cells
-    for merged_cell in ws_packing.merged_cells.ranges:
-        combined_wb["Packing List"].merge_cells(str(merged_cell))
-    
-    # Copy invoice sheet
-    ws_invoice_copy = combined_wb.create_sheet("Invoice")
-    for row in ws_invoice.iter_rows():
-        for cell in row:
-            new_cell = ws_invoice_copy.cell(row=cell.row, column=cell.column, value=cell.value)
-            if cell.has_style:
-                new_cell.font = style_copy(cell.font)
-                new_cell.border = style_copy(cell.border)
-                new_cell.fill = style_copy(cell.fill)
-                new_cell.number_format = style_copy(cell.number_format)
-                new_cell.protection = style_copy(cell.protection)
-                new_cell.alignment = style_copy(cell.alignment)
-    
-    # Copy column dimensions
-    for col in ws_invoice.column_dimensions:
-        if col in ws_invoice.column_dimensions:
-            combined_wb["Invoice"].column_dimensions[col].width = ws_invoice.column_dimensions[col].width
-    
-    # Copy row dimensions
-    for row in ws_invoice.row_dimensions:
-        if row in ws_invoice.row_dimensions:
-            combined_wb["Invoice"].row_dimensions[row].height = ws_invoice.row_dimensions[row].height
     
-    # Copy merged cells
-    for merged_cell in ws_invoice.merged_cells.ranges:
-        combined_wb["Invoice"].merge_cells(str(merged_cell))
+    # ===== GENERATE PACKING LIST SHEET =====
+    packing_render_text = make_packing_list_text_renderer(packing_list_replacements(shipment, account),
+                                                          total_containers_from_bookings, freight_options,
+                                                          shipment.get('Freight__c'))
+    fill_packing_list_sheet(ws_packing, table_start_row, tables_expanded, packing_list_template_path,
+                            packing_render_text, [packing_list_item_row(idx, item) for idx, item in enumerate(items)],
+                            n_rows)
     
+    # ===== GENERATE INVOICE SHEET =====
+    checkbox_texts = invoice_checkbox_texts(shipment, freight_options, terms_of_sales_options,
+                                            terms_of_payment_options)
+    invoice_render_text = make_invoice_text_renderer(invoice_replacements(shipment, account), checkbox_texts,
+                                                     deposits, refunds, shipment.get("Surcharge_amount_USD__c"))
+    fill_invoice_sheet(ws_invoice, invoice_table_start_row, tables_expanded, invoice_render_text, checkbox_texts,
+                       [invoice_item_row(idx, item) for idx, item in enumerate(items)], n_rows)
     
     # Save combined file
     now = datetime.datetime.now()
@@ -1480,26 +4645,17 @@ def generate_combined_export(shipment_id: str):
     output_dir = get_output_directory()
     file_path = output_dir / file_name
     
-    combined_wb.save(str(file_path))
+    data = keep_output(file_path, workbook_bytes(combined_wb, file_name))
     
     # Upload to Salesforce as ContentVersion
-    with open(file_path, "rb") as f:
-        data = f.read()
-    encoded = base64.b64encode(data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create(
-        {
-            "Title": file_name.rsplit(".", 1)[0],
-            "PathOnClient": file_name,
-            "VersionData": encoded,
-            "FirstPublishLocationId": shipment_id,
-        }
-    )
+    content_version = publish_content_version(sf, file_name, data, shipment_id, "Combined_Export_")
     
     return {
         "file_path": str(file_path),
         "file_name": file_name,
         "salesforce_content_version_id": content_version["id"],
+        "publish_job_id": content_version.get("publish_job_id"),
+        "download_url": download_url(file_name),
         "sheets": ["Packing List", "Invoice"],
         "item_count": len(items),
         "deposit_count": len(deposits),
@@ -1512,37 +4668,101 @@ def generate_combined_export(shipment_id: str):
     }
 
 @app.get("/download/{file_name}")
-async def download_file(file_name: str):
+def download_file(file_name: str, request: Request, expires: Optional[int] = None, signature: Optional[str] = None,
+                  x_api_key: Annotated[Optional[str], Header()] = None,
+                  authorization: Annotated[Optional[str], Header()] = None):
     """
-    Download a generated packing list file
+    Download a generated file
     
     Parameters:
     - file_name: Name of the file to download
+    - expires, signature: Signed link from a generate response's download_url
     
-    Note: In serverless environments (Vercel), files in /tmp are ephemeral.
-    The download endpoint may not work reliably. Files are always uploaded to Salesforce.
+    Supports Range, If-Range and If-None-Match. With object storage the response redirects to
+    a presigned URL. Files no longer kept (e.g. in serverless environments, where /tmp is
+    ephemeral) are fetched from Salesforce, with the API_KEY or a signed, unexpired link only.
     """
-    # Try to find the file in the appropriate output directory
-    output_dir = get_output_directory()
-    file_path = output_dir / file_name
-    
-    # Also check the legacy output directory for backwards compatibility
-    if not file_path.exists():
-        legacy_path = Path("output") / file_name
-        if legacy_path.exists():
-            file_path = legacy_path
-    
-    if not file_path.exists():
+    # A plain def (run in the threadpool): the Salesforce read-through blocks
+    storage = output_storage()
+
+    # Object storage serves the file itself
+    url = storage.download_url(file_name)
+    if url:
+        return RedirectResponse(url, status_code=307)
+
+    # Recent renders are served from memory (streamed ones from their temporary file)
+    data = recent_render(file_name)
+    if data is None:
+        data = spooled_render(file_name)
+    if data is not None:
+        return bytes_download_response(request, data, file_name)
+
+    file_path = storage.path(file_name)
+    if file_path is not None:
+        return file_download_response(request, file_path, file_name)
+
+    # Object storage written by another instance
+    obj = storage.fetch(file_name)
+    if obj is not None:
+        return stored_download_response(request, file_name, obj)
+
+    # Gone locally: read through from the ContentVersion uploaded with this name
+    if not (api_key_valid(x_api_key, authorization) or download_signature_valid(file_name, expires, signature)):
+        raise HTTPException(status_code=404, detail="File not found.")
+    try:
+        response = salesforce_download_response(request, file_name)
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"⚠ Warning: Could not fetch {file_name} from Salesforce: {e}")
+        response = None
+    if response is None:
         raise HTTPException(
             status_code=404, 
-            detail=f"File not found. In serverless environments, use the Salesforce attachment instead."
+            detail="File not found locally or in Salesforce."
         )
-    
-    return FileResponse(
-        path=str(file_path),
-        filename=file_name,
-        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
-    )
+    return response
+
+@app.get("/publish-status/{job_id}")
+async def publish_status_endpoint(job_id: str):
+    """
+    Status of a background Salesforce upload (PUBLISH_IN_BACKGROUND)
+
+    Parameters:
+    - job_id: publish_job_id returned by a generate endpoint
+
+    status is pending, uploading, retrying, done (content_version_id is set) or failed (see error).
+    """
+    job = publish_status(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Publish job not found")
+    return job
+
+@app.post("/cleanup-documents/{record_id}", dependencies=[Depends(require_api_key)])
+def cleanup_documents_endpoint(record_id: str, document_type: str, extension: Literal["xlsx", "pdf"] = "xlsx"):
+    """
+    Delete superseded generated documents of a record, keeping the most recently changed one
+
+    Parameters:
+    - record_id: Salesforce record the files are linked to
+    - document_type: Title prefix of the generated files (PI_, Quote_, Production_Order_, Case_,
+      Packing_List_, Invoice_ or Combined_Export_)
+    - extension: xlsx (default) or pdf for the PDF copies
+
+    Requires the API_KEY (X-API-Key header).
+    """
+    if not is_salesforce_id(record_id):
+        raise HTTPException(status_code=400, detail="record_id must be a 15 or 18 character Salesforce Id")
+    if document_type not in GENERATED_DOCUMENT_TYPES:
+        raise HTTPException(status_code=400, detail=f"Unknown document type: {document_type}")
+    # A plain def (run in the threadpool): the Salesforce login, query and delete calls block
+    try:
+        sf = get_salesforce_connection()
+        return cleanup_superseded_documents(sf, record_id, document_type, extension=extension)
+    except ValueError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Error cleaning up documents: {str(e)}")
 
 # --- New Helper Functions for PI, PO, Quote ---
 
@@ -1560,21 +4780,29 @@ def expand_table_by_tag(ws, start_tag, end_tag, data):
     Expand a single row table based on start and end tags.
     Matches logic from test_fill_pi_no_discount.py
     """
-    # Find the row containing the tags
-    table_row_idx = None
-    for row in ws.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str):
-                if start_tag in cell.value:
-                    table_row_idx = cell.row
-                    break
-        if table_row_idx:
-            break
-            
-    if not table_row_idx:
-        print(f"Warning: Table tags {start_tag} not found.")
-        return None
+    return expand_tables_by_tag(ws, [(start_tag, end_tag, data)])[start_tag]
+
+def expand_tables_by_tag(ws, tables, fill=None):
+    """
+    Expand several tag tables with one row shift, then fill each of them.
+
+    Args:
+        ws: Worksheet
+        tables: List of (start_tag, end_tag, data)
+        fill: Fill function (defaults to fill_table_by_tag)
 
+    Returns:
+        {start_tag: first table row, or None if the tag is missing}
+    """
+    fill = fill or fill_table_by_tag
+    rows = expand_tag_tables(ws, [(start_tag, len(data) if data else 1) for start_tag, _, data in tables])
+    for start_tag, end_tag, data in tables:
+        if rows[start_tag]:
+            fill(ws, rows[start_tag], start_tag, end_tag, data)
+    return rows
+
+def fill_table_by_tag(ws, table_row_idx, start_tag, end_tag, data):
+    """Fill an expanded tag table, or clear its tags and placeholders when there is no data."""
     if not data:
         # Clear tags and placeholders, keep static text
         for col in range(1, ws.max_column + 1):
@@ -1587,60 +4815,11 @@ def expand_table_by_tag(ws, start_tag, end_tag, data):
                 cell.value = val
         return table_row_idx
 
-    num_rows = len(data)
-    add_rows = max(0, num_rows - 1)
-    
-    # Capture styles from the template row
-    max_col = ws.max_column
-    row_style = []
-    for col in range(1, max_col + 1):
-        cell = ws.cell(row=table_row_idx, column=col)
-        row_style.append(style_copy(cell._style) if cell.has_style else None)
-    
-    row_height = ws.row_dimensions[table_row_idx].height
-
-    # Handle merged cells (shift them down)
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > table_row_idx:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-    
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-
-    # Insert rows if needed
-    if add_rows > 0:
-        ws.insert_rows(table_row_idx + 1, amount=add_rows)
-        
-        for offset in range(1, add_rows + 1):
-            r = table_row_idx + offset
-            # Copy row height
-            if row_height is not None:
-                ws.row_dimensions[r].height = row_height
-                
-            for col in range(1, max_col + 1):
-                dst = ws.cell(row=r, column=col)
-                # Copy value from template row (to preserve placeholders)
-                src_val = ws.cell(row=table_row_idx, column=col).value
-                dst.value = src_val
-                
-                # Copy style
-                st = row_style[col - 1]
-                if st is not None:
-                    dst._style = style_copy(st)
-                    
-    # Re-merge shifted cells
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
-                    
     # Fill data
+    max_col = ws.max_column
     for i, record in enumerate(data):
         current_row_idx = table_row_idx + i
-        for col in range(1, ws.max_column + 1):
+        for col in range(1, max_col + 1):
             cell = ws.cell(row=current_row_idx, column=col)
             if cell.value and isinstance(cell.value, str):
                 cell_val = cell.value.replace(start_tag, "").replace(end_tag, "")
@@ -1727,64 +4906,44 @@ def merge_identical_cells(ws, start_row, count, col_idx):
     if not start_row or count <= 0:
         return
 
-    start_merge_row = start_row
-    current_val = str(ws.cell(row=start_merge_row, column=col_idx).value)
-    
-    for i in range(1, count):
-        row_idx = start_row + i
-        cell_val = str(ws.cell(row=row_idx, column=col_idx).value)
-        
-        if cell_val != current_val:
-            if row_idx - 1 > start_merge_row:
-                ws.merge_cells(start_row=start_merge_row, start_column=col_idx, end_row=row_idx-1, end_column=col_idx)
-                ws.cell(row=start_merge_row, column=col_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                adjust_row_height_for_merged_cell(ws, start_merge_row, row_idx-1, col_idx, current_val)
-            start_merge_row = row_idx
-            current_val = cell_val
-            
-    # Last block
-    last_row = start_row + count - 1
-    if last_row > start_merge_row:
-        ws.merge_cells(start_row=start_merge_row, start_column=col_idx, end_row=last_row, end_column=col_idx)
-        ws.cell(row=start_merge_row, column=col_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-        adjust_row_height_for_merged_cell(ws, start_merge_row, last_row, col_idx, current_val)
+    from openpyxl.styles import Alignment
+    values = [str(ws.cell(row=start_row + i, column=col_idx).value) for i in range(count)]
+    merge_runs(ws, start_row, values, {col_idx: Alignment(horizontal='left', vertical='center', wrap_text=True)},
+               fit_height=True)
 
 def adjust_row_height_for_merged_cell(ws, start_row, end_row, col_idx, text, line_height_base=25):
     """
     Helper to adjust row height for merged cells.
     """
-    val_str = str(text) if text else ""
-    text_len = len(val_str)
-    
-    col_letter = get_column_letter(col_idx)
-    col_width = ws.column_dimensions[col_letter].width
-    if not col_width: col_width = 30
-    
-    chars_per_line = int(col_width * 1.2)
-    if chars_per_line < 10: chars_per_line = 30
-    
-    explicit_lines = val_str.count('\n') + 1
-    wrap_lines = (text_len // chars_per_line) + 1
-    estimated_lines = max(explicit_lines, wrap_lines)
-    
-    if estimated_lines > 1:
-        required_height = estimated_lines * line_height_base
-    else:
-        required_height = 30
-    required_height += 10
-    
-    current_total_height = 0
-    for r in range(start_row, end_row + 1):
-        h = ws.row_dimensions[r].height
-        if h is None: h = 15
-        current_total_height += h
-    
-    if required_height > current_total_height:
-        extra_per_row = (required_height - current_total_height) / (end_row - start_row + 1)
+    fit_merged_row_heights(ws, [(start_row, end_row, col_idx, text)], line_height_base)
+
+
+def fit_merged_row_heights(ws, spans, line_height_base=25, index=None):
+    """
+    Grow row heights so the wrapped text of each (start_row, end_row, col_idx, text)
+    span fits; the extra height is shared by the span's rows.
+    """
+    texts = [str(text) if text else "" for _, _, _, text in spans]
+    line_counts = text_line_counts(ws, [(start_row, col_idx) for start_row, _, col_idx, _ in spans], texts, index)
+    for (start_row, end_row, _, _), estimated_lines in zip(spans, line_counts):
+        if estimated_lines > 1:
+            required_height = estimated_lines * line_height_base
+        else:
+            required_height = 30
+        required_height += 10
+
+        current_total_height = 0
         for r in range(start_row, end_row + 1):
             h = ws.row_dimensions[r].height
             if h is None: h = 15
-            ws.row_dimensions[r].height = h + extra_per_row
+            current_total_height += h
+
+        if required_height > current_total_height:
+            extra_per_row = (required_height - current_total_height) / (end_row - start_row + 1)
+            for r in range(start_row, end_row + 1):
+                h = ws.row_dimensions[r].height
+                if h is None: h = 15
+                ws.row_dimensions[r].height = h + extra_per_row
 # --- Helper: Number to Words (English USD) ---
 def number_to_text(n):
     if n < 0:
@@ -2105,40 +5264,27 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
                              val = val.replace(f"{{{{{key}\\#{fmt}}}}}", str(value) if value is not None else "")
                 cell.value = val
 
-    # Fill Product Table
-    table_start_row = expand_table_by_tag(ws, "{{TableStart:ContractProduct2}}", "{{TableEnd:ContractProduct2}}", contract_items)
+    # Fill Product, Surcharge, Deposit and Discount tables with a single row shift
+    table_rows = expand_tables_by_tag(ws, [
+        ("{{TableStart:ContractProduct2}}", "{{TableEnd:ContractProduct2}}", contract_items),
+        ("{{TableStart:PISurcharge}}", "{{TableEnd:PISurcharge}}", surcharge_items),
+        ("{{TableStart:PIDeposit}}", "{{TableEnd:PIDeposit}}", deposit_items),
+        ("{{TableStart:PIDiscount}}", "{{TableEnd:PIDiscount}}", discount_items),
+    ])
+    table_start_row = table_rows["{{TableStart:ContractProduct2}}"]
     
     if table_start_row and contract_items:
-        # Merge duplicate "TÊN HÀNG" (Column B / 2) - MỚI
+        # Merge duplicate "TÊN HÀNG" (Column B / 2) - MỚI, together with K, L, M (11, 12, 13)
         if contract_items:
-            start_row = table_start_row 
-            end_row = table_start_row + len(contract_items) - 1 
-            col_b_idx = 2
-            
-            merge_start_row = start_row
-            current_val = ws.cell(row=start_row, column=col_b_idx).value
-            
             from openpyxl.styles import Alignment
-            for r in range(start_row + 1, end_row + 2): 
-                val = ws.cell(row=r, column=col_b_idx).value if r <= end_row else "SENTINEL"
-                
-                should_break = (val != current_val)
-                
-                if should_break:
-                    if r - 1 > merge_start_row:
-                        ws.merge_cells(start_row=merge_start_row, start_column=col_b_idx, end_row=r-1, end_column=col_b_idx)
-                        ws.cell(row=merge_start_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                        
-                        # Merge K, L, M (11, 12, 13)
-                        for col_idx in [11, 12, 13]:
-                            ws.merge_cells(start_row=merge_start_row, start_column=col_idx, end_row=r-1, end_column=col_idx)
-                            # Center alignment for merged price/amount cells
-                            ws.cell(row=merge_start_row, column=col_idx).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-
-                    merge_start_row = r
-                    current_val = val
+            align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
+            # Center alignment for merged price/amount cells
+            align_center = Alignment(horizontal='center', vertical='center', wrap_text=True)
+            names = [ws.cell(row=table_start_row + i, column=2).value for i in range(len(contract_items))]
+            merge_runs(ws, table_start_row, names, {2: align_left, 11: align_center, 12: align_center, 13: align_center})
 
         # Format Price Columns (L=12, M=13) and Packing (G=7)
+        number_format_cells = {}  # format -> cells, applied once per format after the loop
         for i in range(len(contract_items)):
             row_idx = table_start_row + i
             
@@ -2152,7 +5298,7 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
                         cell_packing.value = int(val_curr) if val_curr.is_integer() else val_curr
                     
                     # Apply custom number format
-                    cell_packing.number_format = '#,##0 "pcs/crates"'
+                    number_format_cells.setdefault('#,##0 "pcs/crates"', []).append(cell_packing)
                 except ValueError:
                     pass
 
@@ -2178,7 +5324,7 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
                     else:
                         suffix = "USD"
 
-                    cell.number_format = f'#,##0.00 "{suffix}"'
+                    number_format_cells.setdefault(f'#,##0.00 "{suffix}"', []).append(cell)
                 except: pass
             
             # Total Price
@@ -2188,25 +5334,28 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
             if total_raw is not None:
                 try:
                     cell.value = float(total_raw)
-                    cell.number_format = '#,##0.00'
+                    number_format_cells.setdefault('#,##0.00', []).append(cell)
                 except: pass
 
+        for number_format, cells in number_format_cells.items():
+            apply_style_ids(cells, intern_style(wb, number_format=number_format))
+
     # Fill Surcharges
-    sur_start = expand_table_by_tag(ws, "{{TableStart:PISurcharge}}", "{{TableEnd:PISurcharge}}", surcharge_items)
+    sur_start = table_rows["{{TableStart:PISurcharge}}"]
     if sur_start and surcharge_items:
         for i in range(len(surcharge_items)):
             r = sur_start + i
             ws.merge_cells(start_row=r, start_column=11, end_row=r, end_column=13)
 
     # Fill Deposits
-    dep_start = expand_table_by_tag(ws, "{{TableStart:PIDeposit}}", "{{TableEnd:PIDeposit}}", deposit_items)
+    dep_start = table_rows["{{TableStart:PIDeposit}}"]
     if dep_start and deposit_items:
         for i in range(len(deposit_items)):
             r = dep_start + i
             ws.merge_cells(start_row=r, start_column=11, end_row=r, end_column=13)
 
     # Fill Discounts
-    disc_start = expand_table_by_tag(ws, "{{TableStart:PIDiscount}}", "{{TableEnd:PIDiscount}}", discount_items)
+    disc_start = table_rows["{{TableStart:PIDiscount}}"]
     if disc_start and discount_items:
         for i in range(len(discount_items)):
             r = disc_start + i
@@ -2216,61 +5365,38 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
     # SỬA ĐỔI: LOGIC MERGE CỘT A-J (1-10) TỰ ĐỘNG THEO SUBTOTAL VÀ TOTAL
     # -------------------------------------------------------------------------
     from openpyxl.styles import Alignment
-    
-    start_merge_row = None
-    end_merge_row = None
 
-    # Quét qua các dòng để tìm vị trí thực tế của Subtotal và Total
-    # Vì các bảng ở trên (Surcharge, Discount...) có thể giãn ra, số dòng sẽ thay đổi.
-    for r in range(1, ws.max_row + 1):
-        # Lấy nội dung text của cả dòng để kiểm tra từ khóa
-        row_text_u = ""
-        for c in range(1, 15): # Quét 15 cột đầu
-            val = ws.cell(row=r, column=c).value
-            if val:
-                row_text_u += str(val).upper()
-        
-        # 1. Tìm dòng bắt đầu (SUBTOTAL)
-        # Kiểm tra từ khóa: SUBTOTAL, SUB TOTAL, SUB-TOTAL
-        if "SUBTOTAL" in row_text_u or "SUB TOTAL" in row_text_u or "SUB-TOTAL" in row_text_u:
-            # Chỉ lấy dòng Subtotal đầu tiên tìm thấy sau khi các bảng đã giãn
-            if start_merge_row is None:
-                start_merge_row = r
-        
-        # 2. Tìm dòng kết thúc (TOTAL)
-        # Kiểm tra từ khóa: TOTAL (tránh Subtotal), TỔNG CỘNG, GRAND TOTAL
-        # Lưu ý: "TOTAL" phải nằm dưới "SUBTOTAL"
-        if ("TOTAL" in row_text_u and "SUB" not in row_text_u) or "TỔNG CỘNG" in row_text_u or "GRAND TOTAL" in row_text_u:
-            if start_merge_row is not None and r > start_merge_row:
-                end_merge_row = r
-                # Nếu tìm thấy Total hợp lệ thì có thể dừng vòng lặp hoặc tiếp tục để tìm Total cuối cùng (nếu có nhiều block)
-                # Ở đây ta giả định PI chỉ có 1 phần tổng ở cuối, nên ta cập nhật end_merge_row liên tục nếu có nhiều dòng Total
+    # Vị trí Subtotal và Total lấy từ anchor của template, dịch theo số dòng các bảng
+    # ở trên (Product, Surcharge, Deposit, Discount) đã giãn ra.
+    pi_anchors = template_anchors(template_path, ws.title, PI_ANCHORS)
+    table_sizes = {
+        "{{TableStart:ContractProduct2}}": contract_items,
+        "{{TableStart:PISurcharge}}": surcharge_items,
+        "{{TableStart:PIDeposit}}": deposit_items,
+        "{{TableStart:PIDiscount}}": discount_items,
+    }
+    summary_row = row_mapper([
+        (row, (len(table_sizes[tag]) if table_sizes[tag] else 1) - 1)
+        for tag, row in pi_anchors["table_rows"].items()
+    ])
+    start_merge_row, end_merge_row = (summary_row(r) for r in pi_anchors["summary"])
     
     # Thực hiện Merge nếu tìm thấy cả 2 mốc
     if start_merge_row and end_merge_row and end_merge_row > start_merge_row:
         # Phạm vi cột cần merge: A (1) đến J (10)
         min_col, max_col = 1, 10
         
-        # Bước 1: Unmerge (Gỡ bỏ) các ô đã merge sẵn nằm trong vùng này để tránh lỗi
-        ranges_to_unmerge = []
-        for mr in ws.merged_cells.ranges:
-            # Kiểm tra xem vùng merge có giao nhau với vùng ta chuẩn bị merge không
-            if (mr.min_row <= end_merge_row and mr.max_row >= start_merge_row and
-                mr.min_col <= max_col and mr.max_col >= min_col):
-                ranges_to_unmerge.append(mr)
-        
-        for mr in ranges_to_unmerge:
-            try:
-                ws.unmerge_cells(str(mr))
-            except Exception as e:
-                pass # Bỏ qua lỗi nếu ô đó không thực sự merge
+        # Bước 1: Unmerge (Gỡ bỏ) các ô đã merge sẵn giao nhau với vùng này để tránh lỗi
+        merge_index = MergedRangeIndex(ws)
+        for mr in merge_index.overlapping(start_merge_row, min_col, end_merge_row, max_col):
+            merge_index.unmerge(mr)
 
         # Bước 2: Thực hiện Merge từ dòng Subtotal đến dòng Total
         try:
-            ws.merge_cells(start_row=start_merge_row, start_column=1, end_row=end_merge_row-1, end_column=10)
+            merge_index.merge(start_merge_row, 1, end_merge_row-1, 10)
             
             # Merge cho dòng Total riêng biệt
-            ws.merge_cells(start_row=end_merge_row, start_column=1, end_row=end_merge_row, end_column=10)
+            merge_index.merge(end_merge_row, 1, end_merge_row, 10)
             
             # Bước 3: Căn chỉnh lại text (Căn trái, lên trên)
             cell = ws.cell(row=start_merge_row, column=1)
@@ -2294,28 +5420,22 @@ def generate_pi_no_discount_file(contract_id: str, template_path: str):
     prefix = "PI_Discount_" if has_discount else "PI_NoDiscount_"
     file_name = f"{prefix}{safe_name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    file_data = keep_output(file_path, workbook_bytes(wb, file_name))
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": contract_id
-    })
+    content_version = publish_content_version(sf, file_name, file_data, contract_id, "PI_")
     
     return {
         "file_path": str(file_path),
         "file_name": file_name,
-        "salesforce_content_version_id": content_version["id"]
+        "salesforce_content_version_id": content_version["id"],
+        "publish_job_id": content_version.get("publish_job_id"),
+        "download_url": download_url(file_name)
     }
 
 @app.get("/generate-pi-no-discount/{contract_id}")
-async def generate_pi_no_discount_endpoint(contract_id: str):
+async def generate_pi_no_discount_endpoint(contract_id: str, preview: PreviewMode = None, response: ResponseFormat = None,
+                                           pdf: bool = False, accept: Annotated[Optional[str], Header()] = None):
     try:
         template_path = os.getenv('PI_NO_DISCOUNT_TEMPLATE_PATH', 'templates/proforma_invoice_template_no_discount.xlsx')
         if not os.path.exists(template_path):
@@ -2325,7 +5445,12 @@ async def generate_pi_no_discount_endpoint(contract_id: str):
              else:
                  raise HTTPException(status_code=404, detail=f"Template not found: {template_path}")
         
-        result = generate_pi_no_discount_file(contract_id, template_path)
+        if preview:
+            return await run_in_threadpool(run_preview, preview, generate_pi_no_discount_file, contract_id, template_path)
+
+        result = await run_in_threadpool(generate_with_pdf, pdf, generate_pi_no_discount_file, contract_id, template_path)
+        if wants_file(response, accept):
+            return file_response(result)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -2476,12 +5601,8 @@ def generate_production_order_file(contract_id: str, template_path: str):
                 cell.value = val
 
     # Fill Table
-    table_start_row = None
-    for r in range(1, ws.max_row + 1):
-        cell_val = ws.cell(row=r, column=1).value
-        if cell_val and "{{TableStart:ProPlanProduct}}" in str(cell_val):
-            table_start_row = r
-            break
+    po_anchors = template_anchors(template_path, ws.title, PO_ANCHORS)
+    table_start_row = po_anchors["table_row"]
             
     if table_start_row:
         if products_data:
@@ -2489,100 +5610,38 @@ def generate_production_order_file(contract_id: str, template_path: str):
             rows_to_insert = num_items - 1
             
             if rows_to_insert > 0:
-                # FOOTER PRESERVATION: Capture footer content BEFORE inserting rows
-                # Footer starts after the TỔNG CỘNG row (table_start_row + 2 = LƯU Ý row in template)
-                # TỔNG CỘNG is at table_start_row + 1, we capture from row after it
-                footer_start_row_original = table_start_row + 2  # Skip TỔNG CỘNG, start at LƯU Ý
-                footer_data = []  # List of {row_offset, col, value, font, alignment, border, number_format}
-                footer_merges = []  # List of merge info relative to footer_start
-                
-                # Capture all cell values and styles in footer (from LƯU Ý to end of sheet)
-                for r in range(footer_start_row_original, ws.max_row + 1):
-                    for c in range(1, 16):
-                        cell = ws.cell(row=r, column=c)
-                        if cell.value is not None:  # Only capture cells with values
-                            footer_data.append({
-                                'row_offset': r - footer_start_row_original,
-                                'col': c,
-                                'value': cell.value,
-                                'font': style_copy(cell.font) if cell.font else None,
-                                'alignment': style_copy(cell.alignment) if cell.alignment else None,
-                                'border': style_copy(cell.border) if cell.border else None,
-                                'number_format': cell.number_format
-                            })
-                
-                # Capture merged ranges in footer zone
-                for merged_range in list(ws.merged_cells.ranges):
-                    if merged_range.min_row >= footer_start_row_original:
-                        footer_merges.append({
-                            'min_row_offset': merged_range.min_row - footer_start_row_original,
-                            'max_row_offset': merged_range.max_row - footer_start_row_original,
-                            'min_col': merged_range.min_col,
-                            'max_col': merged_range.max_col
-                        })
-                
-                # Now insert rows
-                ws.insert_rows(table_start_row + 1, amount=rows_to_insert)
-                
-                # FOOTER RESTORATION: Restore captured footer content to new positions
-                # New footer start row = product rows + TỔNG CỘNG = table_start_row + num_items + 1
-                footer_start_row_new = table_start_row + num_items + 1
-                
-                # Restore cell values
-                for item in footer_data:
-                    new_row = footer_start_row_new + item['row_offset']
-                    cell = ws.cell(row=new_row, column=item['col'])
-                    cell.value = item['value']
-                    if item['font']: cell.font = item['font']
-                    if item['alignment']: cell.alignment = item['alignment']
-                    if item['border']: cell.border = item['border']
-                    if item['number_format']: cell.number_format = item['number_format']
-                
-                # Restore merged ranges (first unmerge any existing, then re-merge)
-                for merge_info in footer_merges:
-                    new_min_row = footer_start_row_new + merge_info['min_row_offset']
-                    new_max_row = footer_start_row_new + merge_info['max_row_offset']
-                    # Unmerge any existing ranges in this area first
-                    for col in range(merge_info['min_col'], merge_info['max_col'] + 1):
-                        cell = ws.cell(row=new_min_row, column=col)
-                        for existing_merge in list(ws.merged_cells.ranges):
-                            if cell.coordinate in existing_merge:
-                                try: ws.unmerge_cells(str(existing_merge))
-                                except: pass
-                    # Re-apply the merge
-                    try:
-                        ws.merge_cells(start_row=new_min_row, start_column=merge_info['min_col'],
-                                       end_row=new_max_row, end_column=merge_info['max_col'])
-                    except: pass
+                # Move the footer (TỔNG CỘNG to the end of the sheet) down in one block,
+                # together with its merges and row heights, to make room for the product rows
+                relocate_block(ws, table_start_row + 1, ws.max_row, rows_to_insert)
 
             thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
             align_center = Alignment(horizontal='center', vertical='center', wrap_text=True)
             align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
+            border_ids = intern_style(wb, border=thin_border)
+            center_ids = intern_style(wb, alignment=align_center)
+            number_format_cells = {}  # format -> cells, applied once per format after filling
             
             # Copy styles
             if num_items > 1:
+                source_cells = [ws.cell(row=table_start_row, column=col) for col in range(1, 16)]
                 for i in range(1, num_items):
-                    for col in range(1, 16):
-                        source_cell = ws.cell(row=table_start_row, column=col)
+                    for col, source_cell in enumerate(source_cells, start=1):
                         target_cell = ws.cell(row=table_start_row + i, column=col)
-                        if source_cell.border: target_cell.border = style_copy(source_cell.border)
-                        if source_cell.font: target_cell.font = style_copy(source_cell.font)
-                        if source_cell.alignment: target_cell.alignment = style_copy(source_cell.alignment)
-                        if source_cell.number_format: target_cell.number_format = style_copy(source_cell.number_format)
+                        copy_style_ids(source_cell, target_cell, ('border', 'font', 'alignment', 'number_format'))
 
             ws.cell(row=table_start_row, column=1).value = ""
+            merge_index = MergedRangeIndex(ws)
             
             for i, item in enumerate(products_data):
                 row_idx = table_start_row + i
                 
                 # Unmerge
                 for col in range(1, 16):
-                    cell = ws.cell(row=row_idx, column=col)
-                    for merged_range in list(ws.merged_cells.ranges):
-                        if cell.coordinate in merged_range:
-                            try: ws.unmerge_cells(str(merged_range))
-                            except: pass
-                    ws.cell(row=row_idx, column=col).border = thin_border
+                    merged_range = merge_index.find(row_idx, col)
+                    while merged_range is not None:
+                        merge_index.unmerge(merged_range)
+                        merged_range = merge_index.find(row_idx, col)
+                apply_style_ids((ws.cell(row=row_idx, column=col) for col in range(1, 16)), border_ids)
 
                 # Map Data
                 ws.cell(row=row_idx, column=1).value = i + 1
@@ -2614,15 +5673,15 @@ def generate_production_order_file(contract_id: str, template_path: str):
                 
                 if item.get("m2__c"): 
                     ws.cell(row=row_idx, column=10).value = float(item.get("m2__c"))
-                    ws.cell(row=row_idx, column=10).number_format = '0.00'
+                    number_format_cells.setdefault('0.00', []).append(ws.cell(row=row_idx, column=10))
                 if item.get("m3__c"):
                     ws.cell(row=row_idx, column=11).value = float(item.get("m3__c"))
-                    ws.cell(row=row_idx, column=11).number_format = '0.00'
+                    number_format_cells.setdefault('0.00', []).append(ws.cell(row=row_idx, column=11))
                     
                 ws.cell(row=row_idx, column=12).value = item.get("Tons__c")
                 ws.cell(row=row_idx, column=13).value = item.get("Cont__c")
                 
-                for col in range(5, 14): ws.cell(row=row_idx, column=col).alignment = align_center
+                apply_style_ids((ws.cell(row=row_idx, column=col) for col in range(5, 14)), center_ids)
                 
                 # Packing
                 packing_val = item.get("Packing__c")
@@ -2630,7 +5689,7 @@ def generate_production_order_file(contract_id: str, template_path: str):
                     try:
                         # Chuyển sang int
                         ws.cell(row=row_idx, column=14).value = int(float(packing_val))
-                        ws.cell(row=row_idx, column=14).number_format = '0 "viên/kiện"'
+                        number_format_cells.setdefault('0 "viên/kiện"', []).append(ws.cell(row=row_idx, column=14))
                     except:
                         ws.cell(row=row_idx, column=14).value = f"{packing_val}\nviên/kiện"
                 ws.cell(row=row_idx, column=14).alignment = align_center
@@ -2649,39 +5708,15 @@ def generate_production_order_file(contract_id: str, template_path: str):
                         ws.cell(row=row_idx, column=15).value = del_date
                 ws.cell(row=row_idx, column=15).alignment = align_center
 
-            # Merge duplicate "TÊN HÀNG" (Column D / 4) - Sync with Delivery Date Logic
-            start_merge_row = table_start_row
-            current_val = ws.cell(row=start_merge_row, column=4).value
-            for i in range(1, len(products_data)):
-                row_idx = table_start_row + i
-                val = ws.cell(row=row_idx, column=4).value
-                if val != current_val:
-                    if row_idx - 1 > start_merge_row:
-                        ws.merge_cells(start_row=start_merge_row, start_column=4, end_row=row_idx-1, end_column=4)
-                        ws.cell(row=start_merge_row, column=4).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                    start_merge_row = row_idx
-                    current_val = val
-            last_row = table_start_row + len(products_data) - 1
-            if last_row > start_merge_row:
-                ws.merge_cells(start_row=start_merge_row, start_column=4, end_row=last_row, end_column=4)
-                ws.cell(row=start_merge_row, column=4).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-            
-            # Merge duplicate "THỜI GIAN GIAO HÀNG" (Column O / 15)
-            start_merge_row = table_start_row
-            current_val = ws.cell(row=start_merge_row, column=15).value
-            for i in range(1, len(products_data)):
-                row_idx = table_start_row + i
-                val = ws.cell(row=row_idx, column=15).value
-                if val != current_val:
-                    if row_idx - 1 > start_merge_row:
-                        ws.merge_cells(start_row=start_merge_row, start_column=15, end_row=row_idx-1, end_column=15)
-                        ws.cell(row=start_merge_row, column=15).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-                    start_merge_row = row_idx
-                    current_val = val
-            last_row = table_start_row + len(products_data) - 1
-            if last_row > start_merge_row:
-                ws.merge_cells(start_row=start_merge_row, start_column=15, end_row=last_row, end_column=15)
-                ws.cell(row=start_merge_row, column=15).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+            for number_format, cells in number_format_cells.items():
+                apply_style_ids(cells, intern_style(wb, number_format=number_format))
+
+            # Merge duplicate "TÊN HÀNG" (Column D / 4) and "THỜI GIAN GIAO HÀNG" (Column O / 15)
+            rows = range(table_start_row, table_start_row + len(products_data))
+            merge_runs(ws, table_start_row, [ws.cell(row=r, column=4).value for r in rows], {4: align_left},
+                       index=merge_index)
+            merge_runs(ws, table_start_row, [ws.cell(row=r, column=15).value for r in rows], {15: align_center},
+                       index=merge_index)
         else:
             # CLEANUP: If no products_data, clear placeholders and tags from the template row
             for col in range(1, 16):
@@ -2700,50 +5735,36 @@ def generate_production_order_file(contract_id: str, template_path: str):
     # ----------------------------------------------------
     # MERGE I, J, K FOR ROWS WITH "Người soạn lệnh" OR "Ngọc Bích"
     # ----------------------------------------------------
-    for r in range(1, ws.max_row + 1):
-        found_keyword = False
-        row_values_ijk = []
-        target_val = None
+    # Signature rows come from the template anchors, shifted below the product rows
+    signature_row = row_mapper([(table_start_row, max(len(products_data), 1) - 1)] if table_start_row else [])
+    for r in map(signature_row, po_anchors["signatures"]):
+        # Check content in I(9), J(10), K(11) to preserve it
+        # We want to keep the value if it exists in one of these cells
+        val_9 = ws.cell(row=r, column=9).value
+        val_10 = ws.cell(row=r, column=10).value
+        val_11 = ws.cell(row=r, column=11).value
         
-        # Check entire row to find the keyword "Người soạn lệnh" or "Ngọc Bích"
-        for col in range(1, ws.max_column + 1):
-            cell = ws.cell(row=r, column=col)
-            if cell.value and isinstance(cell.value, str):
-                val_upper = str(cell.value).strip().upper()
-                if "NGƯỜI SOẠN LỆNH" in val_upper or "NGƯỜI SOAN LỆNH" in val_upper or "NGỌC BÍCH" in val_upper:
-                    found_keyword = True
-                    # If we found it, we break. But we need to know WHICH value to keep in IJK merge.
-                    # We will resume scanning IJK specifically below.
-                    break
+        # Prioritize the first non-empty value among them
+        final_val = val_9 if val_9 is not None else (val_10 if val_10 is not None else val_11)
         
-        if found_keyword:
-            # Check content in I(9), J(10), K(11) to preserve it
-            # We want to keep the value if it exists in one of these cells
-            val_9 = ws.cell(row=r, column=9).value
-            val_10 = ws.cell(row=r, column=10).value
-            val_11 = ws.cell(row=r, column=11).value
+        try:
+            # Unmerge if already merged (sanity check)
+            # Then set value to I(9) and clear J, K
+            ws.cell(row=r, column=9).value = final_val
+            ws.cell(row=r, column=10).value = None
+            ws.cell(row=r, column=11).value = None
             
-            # Prioritize the first non-empty value among them
-            final_val = val_9 if val_9 is not None else (val_10 if val_10 is not None else val_11)
+            # Apply Styling
+            val_str = str(final_val).upper() if final_val else ""
+            if "NGƯỜI SOẠN LỆNH" in val_str or "NGƯỜI SOAN LỆNH" in val_str:
+                ws.cell(row=r, column=9).font = Font(bold=True, underline='single', name='Times New Roman', size=11)
+            elif "NGỌC BÍCH" in val_str:
+                ws.cell(row=r, column=9).font = Font(bold=True, name='Times New Roman', size=11)
             
-            try:
-                # Unmerge if already merged (sanity check)
-                # Then set value to I(9) and clear J, K
-                ws.cell(row=r, column=9).value = final_val
-                ws.cell(row=r, column=10).value = None
-                ws.cell(row=r, column=11).value = None
-                
-                # Apply Styling
-                val_str = str(final_val).upper() if final_val else ""
-                if "NGƯỜI SOẠN LỆNH" in val_str or "NGƯỜI SOAN LỆNH" in val_str:
-                    ws.cell(row=r, column=9).font = Font(bold=True, underline='single', name='Times New Roman', size=11)
-                elif "NGỌC BÍCH" in val_str:
-                    ws.cell(row=r, column=9).font = Font(bold=True, name='Times New Roman', size=11)
-                
-                ws.merge_cells(start_row=r, start_column=9, end_row=r, end_column=11)
-                ws.cell(row=r, column=9).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            except Exception as e:
-                print(f"Error merging IJK at row {r}: {e}")
+            ws.merge_cells(start_row=r, start_column=9, end_row=r, end_column=11)
+            ws.cell(row=r, column=9).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+        except Exception as e:
+            print(f"Error merging IJK at row {r}: {e}")
 
     now = datetime.datetime.now()
     timestamp = now.strftime("%Y-%m-%d_%H-%M-%S")
@@ -2751,24 +5772,17 @@ def generate_production_order_file(contract_id: str, template_path: str):
     file_name = f"Production_Order_{safe_name}_{timestamp}.xlsx"
     output_dir = get_output_directory()
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    file_data = keep_output(file_path, workbook_bytes(wb, file_name))
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": contract_id
-    })
+    content_version = publish_content_version(sf, file_name, file_data, contract_id, "Production_Order_")
     
     return {
         "file_path": str(file_path),
         "file_name": file_name,
-        "salesforce_content_version_id": content_version["id"]
+        "salesforce_content_version_id": content_version["id"],
+        "publish_job_id": content_version.get("publish_job_id"),
+        "download_url": download_url(file_name)
     }
 
 
@@ -2984,11 +5998,15 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
                              val = val.replace(f"{{{{{key}\\#{fmt}}}}}", str(value) if value is not None else "")
                 cell.value = val
 
-    # Fill Product Table
-    table_start_row = expand_table_by_tag(ws, "{{TableStart:GetQuoteLine}}", "{{TableEnd:GetQuoteLine}}", quote_items)
+    # Fill Product and Discount tables with a single row shift
+    table_rows = expand_tables_by_tag(ws, [
+        ("{{TableStart:GetQuoteLine}}", "{{TableEnd:GetQuoteLine}}", quote_items),
+        ("{{TableStart:QuoteDiscount}}", "{{TableEnd:QuoteDiscount}}", discount_items),
+    ])
+    table_start_row = table_rows["{{TableStart:GetQuoteLine}}"]
 
     # Fill Discounts
-    disc_start = expand_table_by_tag(ws, "{{TableStart:QuoteDiscount}}", "{{TableEnd:QuoteDiscount}}", discount_items)
+    disc_start = table_rows["{{TableStart:QuoteDiscount}}"]
     if disc_start and discount_items:
         for i in range(len(discount_items)):
             r = disc_start + i
@@ -3025,15 +6043,9 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
         min_col, max_col = 1, 10
         
         # Unmerge overlapping ranges
-        ranges_to_unmerge = []
-        for mr in ws.merged_cells.ranges:
-            if (mr.min_row <= max_row and mr.max_row >= min_row and
-                mr.min_col <= max_col and mr.max_col >= min_col):
-                ranges_to_unmerge.append(mr)
-        
-        for mr in ranges_to_unmerge:
-            try: ws.unmerge_cells(str(mr))
-            except: pass
+        merge_index = MergedRangeIndex(ws)
+        for mr in merge_index.overlapping(min_row, min_col, max_row, max_col):
+            merge_index.unmerge(mr)
 
         try:
              ws.merge_cells(start_row=start_merge_row, start_column=1, end_row=end_merge_row, end_column=10)
@@ -3045,28 +6057,12 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
     if table_start_row and quote_items:
         # Merge duplicate "TÊN HÀNG" (Column B / 2) - MỚI
         if quote_items:
-            start_row = table_start_row
-            end_row = table_start_row + len(quote_items) - 1
-            col_b_idx = 2
-            
-            merge_start_row = start_row
-            current_val = ws.cell(row=start_row, column=col_b_idx).value
-            
             from openpyxl.styles import Alignment
-            for r in range(start_row + 1, end_row + 2):
-                val = ws.cell(row=r, column=col_b_idx).value if r <= end_row else "SENTINEL"
-                
-                should_break = (val != current_val)
-                
-                if should_break:
-                    if r - 1 > merge_start_row:
-                        ws.merge_cells(start_row=merge_start_row, start_column=col_b_idx, end_row=r-1, end_column=col_b_idx)
-                        ws.cell(row=merge_start_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                    
-                    merge_start_row = r
-                    current_val = val
+            names = [ws.cell(row=table_start_row + i, column=2).value for i in range(len(quote_items))]
+            merge_runs(ws, table_start_row, names, {2: Alignment(horizontal='left', vertical='center', wrap_text=True)})
 
         # Format Price Columns (L=12, M=13)
+        price_cells, total_cells = [], []
         for i in range(len(quote_items)):
             row_idx = table_start_row + i
             # Unit Price
@@ -3075,7 +6071,7 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
                 try:
                     val_str = str(cell.value).replace(',', '')
                     cell.value = float(val_str)
-                    cell.number_format = '#,##0.00 "USD"'
+                    price_cells.append(cell)
                 except: pass
             # Total Price
             cell = ws.cell(row=row_idx, column=13)
@@ -3083,8 +6079,10 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
                 try:
                     val_str = str(cell.value).replace(',', '')
                     cell.value = float(val_str)
-                    cell.number_format = '#,##0.00'
+                    total_cells.append(cell)
                 except: pass
+        apply_style_ids(price_cells, intern_style(wb, number_format='#,##0.00 "USD"'))
+        apply_style_ids(total_cells, intern_style(wb, number_format='#,##0.00'))
 
     # Footer Row Height
     for row in ws.iter_rows():
@@ -3102,24 +6100,17 @@ def generate_quote_no_discount_file(quote_id: str, template_path: str):
     file_name = f"{prefix}{safe_name}_{timestamp}.xlsx"
     output_dir = get_output_directory()
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    file_data = keep_output(file_path, workbook_bytes(wb, file_name))
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": quote_id
-    })
+    content_version = publish_content_version(sf, file_name, file_data, quote_id, "Quote_")
     
     return {
         "file_path": str(file_path),
         "file_name": file_name,
-        "salesforce_content_version_id": content_version["id"]
+        "salesforce_content_version_id": content_version["id"],
+        "publish_job_id": content_version.get("publish_job_id"),
+        "download_url": download_url(file_name)
     }
 
 
@@ -3133,21 +6124,10 @@ def expand_table_pi(ws, start_tag, end_tag, data):
     """
     Expand a single row table based on start and end tags (PI version).
     """
-    # Find the row containing the tags
-    table_row_idx = None
-    for row in ws.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str):
-                if start_tag in cell.value:
-                    table_row_idx = cell.row
-                    break
-        if table_row_idx:
-            break
-            
-    if not table_row_idx:
-        print(f"Warning: Table tags {start_tag} not found.")
-        return None
+    return expand_tables_by_tag(ws, [(start_tag, end_tag, data)], fill=fill_table_pi)[start_tag]
 
+def fill_table_pi(ws, table_row_idx, start_tag, end_tag, data):
+    """Fill an expanded tag table (PI version), or clear its tags when there is no data."""
     if not data:
         # Clear tags
         for col in range(1, ws.max_column + 1):
@@ -3156,60 +6136,11 @@ def expand_table_pi(ws, start_tag, end_tag, data):
                 cell.value = cell.value.replace(start_tag, "").replace(end_tag, "")
         return table_row_idx
 
-    num_rows = len(data)
-    add_rows = max(0, num_rows - 1)
-    
-    # Capture styles from the template row
-    max_col = ws.max_column
-    row_style = []
-    for col in range(1, max_col + 1):
-        cell = ws.cell(row=table_row_idx, column=col)
-        row_style.append(style_copy(cell._style) if cell.has_style else None)
-    
-    row_height = ws.row_dimensions[table_row_idx].height
-
-    # Handle merged cells (shift them down)
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > table_row_idx:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-    
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-
-    # Insert rows if needed
-    if add_rows > 0:
-        ws.insert_rows(table_row_idx + 1, amount=add_rows)
-        
-        for offset in range(1, add_rows + 1):
-            r = table_row_idx + offset
-            # Copy row height
-            if row_height is not None:
-                ws.row_dimensions[r].height = row_height
-                
-            for col in range(1, max_col + 1):
-                dst = ws.cell(row=r, column=col)
-                # Copy value from template row
-                src_val = ws.cell(row=table_row_idx, column=col).value
-                dst.value = src_val
-                
-                # Copy style
-                st = row_style[col - 1]
-                if st is not None:
-                    dst._style = style_copy(st)
-                    
-    # Re-merge shifted cells
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
-                    
     # Fill data
+    max_col = ws.max_column
     for i, record in enumerate(data):
         current_row_idx = table_row_idx + i
-        for col in range(1, ws.max_column + 1):
+        for col in range(1, max_col + 1):
             cell = ws.cell(row=current_row_idx, column=col)
             if cell.value and isinstance(cell.value, str):
                 cell_val = cell.value.replace(start_tag, "").replace(end_tag, "")
@@ -3503,60 +6434,7 @@ def generate_pi_no_discount_logic(contract_id, template_path):
                 
                 cell.value = val
 
-    table_start_row = expand_table_pi(ws, "{{TableStart:ContractProduct2}}", "{{TableEnd:ContractProduct2}}", contract_items)
-    
-    if table_start_row and contract_items:
-        col_b_idx = 2
-        for i, item in enumerate(contract_items):
-            row_idx = table_start_row + i
-            cell = ws.cell(row=row_idx, column=col_b_idx)
-            product_name = None
-            if 'Product__r' in item and item['Product__r']:
-                product_name = item['Product__r'].get('Name')
-            current_desc = str(cell.value) if cell.value else ""
-
-    if table_start_row and contract_items:
-        col_b_idx = 2
-        start_merge_row = table_start_row
-        current_val = str(ws.cell(row=start_merge_row, column=col_b_idx).value)
-        for i in range(1, len(contract_items)):
-            row_idx = table_start_row + i
-            cell_val = str(ws.cell(row=row_idx, column=col_b_idx).value)
-            if cell_val == current_val:
-                continue
-            else:
-                if row_idx - 1 > start_merge_row:
-                    ws.merge_cells(start_row=start_merge_row, start_column=col_b_idx, end_row=row_idx-1, end_column=col_b_idx)
-                    cell = ws.cell(row=start_merge_row, column=col_b_idx)
-                    cell.alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                start_merge_row = row_idx
-                current_val = cell_val
-        last_row = table_start_row + len(contract_items) - 1
-        if last_row > start_merge_row:
-             ws.merge_cells(start_row=start_merge_row, start_column=col_b_idx, end_row=last_row, end_column=col_b_idx)
-             ws.cell(row=start_merge_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-
-    if table_start_row and contract_items:
-        for i in range(len(contract_items)):
-            row_idx = table_start_row + i
-            cell = ws.cell(row=row_idx, column=12)
-            if cell.value:
-                try:
-                    val_str = str(cell.value).replace(',', '')
-                    cell.value = float(val_str)
-                    cell.number_format = '#,##0.00 "USD"'
-                except ValueError:
-                    pass 
-            cell = ws.cell(row=row_idx, column=13)
-            if cell.value:
-                try:
-                    val_str = str(cell.value).replace(',', '')
-                    cell.value = float(val_str)
-                    cell.number_format = '#,##0.00'
-                except ValueError:
-                    pass
-
-    # Fill Surcharge Table
+    # Surcharge Table data
     # The template uses {{TableStart:PISurcharge}}...{{TableEnd:PISurcharge}}
     surcharge_query = f"""
     SELECT Id, Name, Surcharge_amount_USD__c 
@@ -3579,9 +6457,7 @@ def generate_pi_no_discount_logic(contract_id, template_path):
                 "Surcharge_amount_USD__c": item.get('Surcharge_amount_USD__c')
             })
 
-    expand_table_pi(ws, "{{TableStart:PISurcharge}}", "{{TableEnd:PISurcharge}}", surcharge_items)
-
-    # Fill Deposit Table (Single row from Contract)
+    # Deposit Table data (Single row from Contract)
     deposit_items = []
     if contract_data:
         total_amount = safe_float(contract_data.get('Total_Price_USD__c'))
@@ -3595,7 +6471,51 @@ def generate_pi_no_discount_logic(contract_id, template_path):
             "Balance__c": balance 
         })
         
-    expand_table_pi(ws, "{{TableStart:PIDeposit}}", "{{TableEnd:PIDeposit}}", deposit_items)
+    # Fill Product, Surcharge and Deposit tables with a single row shift
+    table_rows = expand_tables_by_tag(ws, [
+        ("{{TableStart:ContractProduct2}}", "{{TableEnd:ContractProduct2}}", contract_items),
+        ("{{TableStart:PISurcharge}}", "{{TableEnd:PISurcharge}}", surcharge_items),
+        ("{{TableStart:PIDeposit}}", "{{TableEnd:PIDeposit}}", deposit_items),
+    ], fill=fill_table_pi)
+    table_start_row = table_rows["{{TableStart:ContractProduct2}}"]
+    
+    if table_start_row and contract_items:
+        col_b_idx = 2
+        for i, item in enumerate(contract_items):
+            row_idx = table_start_row + i
+            cell = ws.cell(row=row_idx, column=col_b_idx)
+            product_name = None
+            if 'Product__r' in item and item['Product__r']:
+                product_name = item['Product__r'].get('Name')
+            current_desc = str(cell.value) if cell.value else ""
+
+    if table_start_row and contract_items:
+        col_b_idx = 2
+        names = [str(ws.cell(row=table_start_row + i, column=col_b_idx).value) for i in range(len(contract_items))]
+        merge_runs(ws, table_start_row, names, {col_b_idx: Alignment(horizontal='left', vertical='center', wrap_text=True)})
+
+    if table_start_row and contract_items:
+        price_cells, total_cells = [], []
+        for i in range(len(contract_items)):
+            row_idx = table_start_row + i
+            cell = ws.cell(row=row_idx, column=12)
+            if cell.value:
+                try:
+                    val_str = str(cell.value).replace(',', '')
+                    cell.value = float(val_str)
+                    price_cells.append(cell)
+                except ValueError:
+                    pass 
+            cell = ws.cell(row=row_idx, column=13)
+            if cell.value:
+                try:
+                    val_str = str(cell.value).replace(',', '')
+                    cell.value = float(val_str)
+                    total_cells.append(cell)
+                except ValueError:
+                    pass
+        apply_style_ids(price_cells, intern_style(wb, number_format='#,##0.00 "USD"'))
+        apply_style_ids(total_cells, intern_style(wb, number_format='#,##0.00'))
 
     for row in ws.iter_rows():
         for cell in row:
@@ -3608,28 +6528,22 @@ def generate_pi_no_discount_logic(contract_id, template_path):
     safe_name = sanitize_filename(contract_data.get('Name'))
     file_name = f"PI_{safe_name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    file_data = keep_output(file_path, workbook_bytes(wb, file_name))
 
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": contract_id
-    })
+    content_version = publish_content_version(sf, file_name, file_data, contract_id, "PI_")
     
     return {
         "file_path": str(file_path),
         "file_name": file_name,
-        "salesforce_content_version_id": content_version["id"]
+        "salesforce_content_version_id": content_version["id"],
+        "publish_job_id": content_version.get("publish_job_id"),
+        "download_url": download_url(file_name)
     }
 
 @app.get("/generate-pi-no-discount/{contract_id}")
-async def generate_pi_no_discount_endpoint(contract_id: str):
+async def generate_pi_no_discount_endpoint(contract_id: str, preview: PreviewMode = None, response: ResponseFormat = None,
+                                           pdf: bool = False, accept: Annotated[Optional[str], Header()] = None):
     try:
         # Check if contract has discount first
         sf = get_salesforce_connection()
@@ -3663,7 +6577,12 @@ async def generate_pi_no_discount_endpoint(contract_id: str):
                  else:
                      raise HTTPException(status_code=404, detail=f"PI Template not found: {template_path}")
 
-        result = generate_pi_no_discount_logic(contract_id, template_path)
+        if preview:
+            return await run_in_threadpool(run_preview, preview, generate_pi_no_discount_logic, contract_id, template_path)
+
+        result = await run_in_threadpool(generate_with_pdf, pdf, generate_pi_no_discount_logic, contract_id, template_path)
+        if wants_file(response, accept):
+            return file_response(result)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -3673,20 +6592,10 @@ def expand_table_quote(ws, start_tag, end_tag, data):
     """
     Expand a single row table based on start and end tags (Quote version with strict types).
     """
-    table_row_idx = None
-    for row in ws.iter_rows():
-        for cell in row:
-            if cell.value and isinstance(cell.value, str):
-                if start_tag in cell.value:
-                    table_row_idx = cell.row
-                    break
-        if table_row_idx:
-            break
-            
-    if not table_row_idx:
-        print(f"Warning: Table tags {start_tag} not found.")
-        return None
+    return expand_tables_by_tag(ws, [(start_tag, end_tag, data)], fill=fill_table_quote)[start_tag]
 
+def fill_table_quote(ws, table_row_idx, start_tag, end_tag, data):
+    """Fill an expanded tag table (Quote version with strict types), or clear its tags when there is no data."""
     if not data:
         for col in range(1, ws.max_column + 1):
             cell = ws.cell(row=table_row_idx, column=col)
@@ -3694,49 +6603,10 @@ def expand_table_quote(ws, start_tag, end_tag, data):
                 cell.value = cell.value.replace(start_tag, "").replace(end_tag, "")
         return table_row_idx
 
-    num_rows = len(data)
-    add_rows = max(0, num_rows - 1)
-    
     max_col = ws.max_column
-    row_style = []
-    for col in range(1, max_col + 1):
-        cell = ws.cell(row=table_row_idx, column=col)
-        row_style.append(style_copy(cell._style) if cell.has_style else None)
-    
-    row_height = ws.row_dimensions[table_row_idx].height
-
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > table_row_idx:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-    
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-
-    if add_rows > 0:
-        ws.insert_rows(table_row_idx + 1, amount=add_rows)
-        for offset in range(1, add_rows + 1):
-            r = table_row_idx + offset
-            if row_height is not None:
-                ws.row_dimensions[r].height = row_height
-            for col in range(1, max_col + 1):
-                dst = ws.cell(row=r, column=col)
-                src_val = ws.cell(row=table_row_idx, column=col).value
-                dst.value = src_val
-                st = row_style[col - 1]
-                if st is not None:
-                    dst._style = style_copy(st)
-                    
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
-                    
     for i, record in enumerate(data):
         current_row_idx = table_row_idx + i
-        for col in range(1, ws.max_column + 1):
+        for col in range(1, max_col + 1):
             cell = ws.cell(row=current_row_idx, column=col)
             if cell.value and isinstance(cell.value, str):
                 cell_val = cell.value.replace(start_tag, "").replace(end_tag, "")
@@ -3995,25 +6865,11 @@ def generate_quote_no_discount_logic(quote_id, template_path):
 
     if table_start_row and quote_items:
         col_b_idx = 2
-        start_merge_row = table_start_row
-        current_val = str(ws.cell(row=start_merge_row, column=col_b_idx).value)
-        for i in range(1, len(quote_items)):
-            row_idx = table_start_row + i
-            cell_val = str(ws.cell(row=row_idx, column=col_b_idx).value)
-            if cell_val == current_val:
-                continue
-            else:
-                if row_idx - 1 > start_merge_row:
-                    ws.merge_cells(start_row=start_merge_row, start_column=col_b_idx, end_row=row_idx-1, end_column=col_b_idx)
-                    ws.cell(row=start_merge_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                start_merge_row = row_idx
-                current_val = cell_val
-        last_row = table_start_row + len(quote_items) - 1
-        if last_row > start_merge_row:
-             ws.merge_cells(start_row=start_merge_row, start_column=col_b_idx, end_row=last_row, end_column=col_b_idx)
-             ws.cell(row=start_merge_row, column=col_b_idx).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
+        names = [str(ws.cell(row=table_start_row + i, column=col_b_idx).value) for i in range(len(quote_items))]
+        merge_runs(ws, table_start_row, names, {col_b_idx: Alignment(horizontal='left', vertical='center', wrap_text=True)})
  
     if table_start_row and quote_items:
+        price_cells, total_cells = [], []
         for i in range(len(quote_items)):
             row_idx = table_start_row + i
             cell = ws.cell(row=row_idx, column=12)
@@ -4021,7 +6877,7 @@ def generate_quote_no_discount_logic(quote_id, template_path):
                 try:
                     val_str = str(cell.value).replace(',', '')
                     cell.value = float(val_str)
-                    cell.number_format = '#,##0.00 "USD"'
+                    price_cells.append(cell)
                 except ValueError:
                     pass 
             cell = ws.cell(row=row_idx, column=13)
@@ -4029,9 +6885,11 @@ def generate_quote_no_discount_logic(quote_id, template_path):
                 try:
                     val_str = str(cell.value).replace(',', '')
                     cell.value = float(val_str)
-                    cell.number_format = '#,##0.00'
+                    total_cells.append(cell)
                 except ValueError:
                     pass
+        apply_style_ids(price_cells, intern_style(wb, number_format='#,##0.00 "USD"'))
+        apply_style_ids(total_cells, intern_style(wb, number_format='#,##0.00'))
 
     for row in ws.iter_rows():
         for cell in row:
@@ -4044,34 +6902,33 @@ def generate_quote_no_discount_logic(quote_id, template_path):
     safe_name = sanitize_filename(quote_data.get('Name'))
     file_name = f"Quote_{safe_name}_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.xlsx"
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    file_data = keep_output(file_path, workbook_bytes(wb, file_name))
 
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
-    content_version = sf.ContentVersion.create({
-        "Title": file_name.rsplit(".", 1)[0],
-        "PathOnClient": file_name,
-        "VersionData": encoded,
-        "FirstPublishLocationId": quote_id
-    })
+    content_version = publish_content_version(sf, file_name, file_data, quote_id, "Quote_")
     
     return {
         "file_path": str(file_path),
         "file_name": file_name,
-        "salesforce_content_version_id": content_version["id"]
+        "salesforce_content_version_id": content_version["id"],
+        "publish_job_id": content_version.get("publish_job_id"),
+        "download_url": download_url(file_name)
     }
 
 @app.get("/generate-quote-no-discount/{quote_id}")
-async def generate_quote_no_discount_endpoint(quote_id: str):
+async def generate_quote_no_discount_endpoint(quote_id: str, preview: PreviewMode = None, response: ResponseFormat = None,
+                                              pdf: bool = False, accept: Annotated[Optional[str], Header()] = None):
     try:
         template_path = os.getenv('QUOTE_TEMPLATE_PATH', 'templates/quotation_template_no_discount.xlsx')
         if not os.path.exists(template_path):
              raise HTTPException(status_code=404, detail=f"Quote Template not found")
 
-        result = generate_quote_no_discount_logic(quote_id, template_path)
+        if preview:
+            return await run_in_threadpool(run_preview, preview, generate_quote_no_discount_logic, quote_id, template_path)
+
+        result = await run_in_threadpool(generate_with_pdf, pdf, generate_quote_no_discount_logic, quote_id, template_path)
+        if wants_file(response, accept):
+            return file_response(result)
         return result
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -4195,15 +7052,10 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
                     cell.value = val
 
     # Fill Table
-    table_start_row = None
-    total_row_template_idx = None # Thêm biến để lưu chỉ mục dòng Tổng Cộng template
-    
-    for r in range(1, ws.max_row + 1):
-        cell_val = ws.cell(row=r, column=1).value
-        if cell_val and "{{TableStart:ProPlanProduct}}" in str(cell_val):
-            table_start_row = r
-        if ws.cell(row=r, column=4).value and "TỔNG CỘNG" in str(ws.cell(row=r, column=4).value).upper():
-            total_row_template_idx = r
+    # Dòng bảng và dòng Tổng Cộng của template lấy từ anchor (đã tính sẵn cho file template)
+    po_anchors = template_anchors(template_path, ws.title, PO_ANCHORS)
+    table_start_row = po_anchors["table_row"]
+    total_row_template_idx = po_anchors["total_row"]
             
     if not table_start_row:
         print("Error: Table start marker {{TableStart:ProPlanProduct}} not found.")
@@ -4231,50 +7083,32 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
                              bottom=Side(style='thin'))
         align_center = Alignment(horizontal='center', vertical='center', wrap_text=True)
         align_left = Alignment(horizontal='left', vertical='center', wrap_text=True)
+        border_ids = intern_style(wb, border=thin_border)
+        center_ids = intern_style(wb, alignment=align_center)
 
         # 2. Copy styles (Giữ nguyên logic copy style)
         if num_items > 1:
+            source_cells = [ws.cell(row=table_start_row, column=col) for col in range(1, 16)]
             for i in range(1, num_items):
                 target_row = table_start_row + i
-                source_row = table_start_row
-                for col in range(1, 16):
-                    source_cell = ws.cell(row=source_row, column=col)
-                    target_cell = ws.cell(row=target_row, column=col)
-                    
-                    if source_cell.border:
-                        target_cell.border = style_copy(source_cell.border)
-                    if source_cell.font:
-                        target_cell.font = style_copy(source_cell.font)
-                    if source_cell.alignment:
-                        target_cell.alignment = style_copy(source_cell.alignment)
-                    if source_cell.fill:
-                        target_cell.fill = style_copy(source_cell.fill)
-                    if source_cell.number_format:
-                        target_cell.number_format = style_copy(source_cell.number_format)
+                for col, source_cell in enumerate(source_cells, start=1):
+                    copy_style_ids(source_cell, ws.cell(row=target_row, column=col),
+                                   ('border', 'font', 'alignment', 'fill', 'number_format'))
 
         # 3. Clear the first row template marker
         ws.cell(row=table_start_row, column=1).value = ""
 
         # 4. Fill data
+        merge_index = MergedRangeIndex(ws)
+        height_texts = []
         for i, item in enumerate(products_data):
             row_idx = table_start_row + i
             
             # CRITICAL: Unmerge cells before writing (Giữ nguyên phần này)
             for col in range(1, 16):
-                cell = ws.cell(row=row_idx, column=col)
-                is_merged = False
-                target_range = None
-                for merged_range in ws.merged_cells.ranges:
-                    if cell.coordinate in merged_range:
-                        is_merged = True
-                        target_range = merged_range
-                        break
-                
-                if is_merged and target_range:
-                    try:
-                        ws.unmerge_cells(str(target_range))
-                    except KeyError:
-                        pass
+                target_range = merge_index.find(row_idx, col)
+                if target_range is not None:
+                    merge_index.unmerge(target_range)
                 
                 cell = ws.cell(row=row_idx, column=col)
                 cell.border = thin_border 
@@ -4319,15 +7153,8 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
             
             ws.cell(row=row_idx, column=4).alignment = align_left
             
-            # Auto-adjust row height (Giữ nguyên phần này)
-            desc_str = str(desc_val)
-            explicit_lines = desc_str.count('\n') + 1
-            wrap_lines = (len(desc_str) // 25) + 1 
-            order_str = str(item_map["Order__r.Name"])
-            order_lines = (len(order_str) // 10) + 1
-            max_lines = max(explicit_lines, wrap_lines, order_lines)
-            
-            ws.row_dimensions[row_idx].height = max_lines * 20 if max_lines > 1 else 20
+            # Row height is fitted after the loop from the description and order texts
+            height_texts.append((row_idx, str(desc_val), str(item_map["Order__r.Name"])))
             
             # Size columns (E, F, G) - Center
             ws.cell(row=row_idx, column=5).value = item_map["Length"]
@@ -4351,8 +7178,7 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
             ws.cell(row=row_idx, column=12).value = item_map["Tons__c"]
             ws.cell(row=row_idx, column=13).value = item_map["Cont__c"]
             
-            for col in range(5, 14):
-                ws.cell(row=row_idx, column=col).alignment = align_center
+            apply_style_ids((ws.cell(row=row_idx, column=col) for col in range(5, 14)), center_ids)
 
             packing_val = item_map["Packing__c"]
             if packing_val:
@@ -4374,8 +7200,15 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
             ws.cell(row=row_idx, column=15).alignment = align_center
 
             # Apply borders
-            for col in range(1, 16):
-                ws.cell(row=row_idx, column=col).border = thin_border
+            apply_style_ids((ws.cell(row=row_idx, column=col) for col in range(1, 16)), border_ids)
+
+        # Auto-adjust row heights: description (D) and order (B) wrapped lines
+        line_counts = text_line_counts(
+            ws, [(row_idx, col) for row_idx, _, _ in height_texts for col in (4, 2)],
+            [text for _, desc, order in height_texts for text in (desc, order)], merge_index)
+        for (row_idx, _, _), desc_lines, order_lines in zip(height_texts, line_counts[::2], line_counts[1::2]):
+            max_lines = max(desc_lines, order_lines)
+            ws.row_dimensions[row_idx].height = max_lines * 20 if max_lines > 1 else 20
     
     
     # ----------------------------------------------------
@@ -4390,20 +7223,9 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
         # CRITICAL: Unmerge cells in Total row to ensure totals are visible
         # Check columns H (8) to M (13)
         for col in range(8, 14):
-            cell = ws.cell(row=total_row, column=col)
-            is_merged = False
-            target_range = None
-            for merged_range in ws.merged_cells.ranges:
-                if cell.coordinate in merged_range:
-                    is_merged = True
-                    target_range = merged_range
-                    break
-            
-            if is_merged and target_range:
-                try:
-                    ws.unmerge_cells(str(target_range))
-                except KeyError:
-                    pass
+            target_range = merge_index.find(total_row, col)
+            if target_range is not None:
+                merge_index.unmerge(target_range)
 
         # Cột H: Quantity (Viên)
         ws.cell(row=total_row, column=8).value = f"=SUM({get_column_letter(8)}{first_data_row}:{get_column_letter(8)}{last_data_row})"
@@ -4437,22 +7259,15 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
     # ----------------------------------------------------
     # MERGE I, J, K FOR ROWS WITH "Người soạn lệnh" OR "Ngọc Bích"
     # ----------------------------------------------------
-    for r in range(1, ws.max_row + 1):
-        found_keyword = False
-        for cell in ws[r]:
-            if cell.value and isinstance(cell.value, str):
-                val_upper = str(cell.value).strip().upper()
-                if "NGƯỜI SOẠN LỆNH" in val_upper or "NGƯỜI SOAN LỆNH" in val_upper or "NGỌC BÍCH" in val_upper:
-                    found_keyword = True
-                    break
-        
-        if found_keyword:
-            # Merge columns I (9), J (10), K (11)
-            try:
-                ws.merge_cells(start_row=r, start_column=9, end_row=r, end_column=11)
-                ws.cell(row=r, column=9).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-            except Exception as e:
-                print(f"Error merging IJK at row {r}: {e}")
+    # Signature rows come from the template anchors, shifted below the product rows
+    signature_row = row_mapper([(table_start_row, max(num_items, 1) - 1)])
+    for r in map(signature_row, po_anchors["signatures"]):
+        # Merge columns I (9), J (10), K (11)
+        try:
+            ws.merge_cells(start_row=r, start_column=9, end_row=r, end_column=11)
+            ws.cell(row=r, column=9).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
+        except Exception as e:
+            print(f"Error merging IJK at row {r}: {e}")
 
     # ----------------------------------------------------
     # KHẮC PHỤC LỖI MERGE CELL (Giữ nguyên logic merge)
@@ -4467,65 +7282,33 @@ def fill_production_order_template(template_path, output_path, contract_data, pr
         return str(val).strip() if val is not None else ""
 
 
-    # Merge duplicate "TÊN HÀNG" (Column D / 4)
-    if products_data:
-        start_row = table_start_row 
-        end_row = table_start_row + len(products_data) - 1 
-        
-        merge_start_row = start_row
-        current_val_str = get_cell_content_for_comparison(ws.cell(row=start_row, column=4))
-        
-        for r in range(start_row + 1, end_row + 2): 
-            val_str = get_cell_content_for_comparison(ws.cell(row=r, column=4)) if r <= end_row else "SENTINEL" # Sử dụng giá trị phân biệt
-            
-            should_break = (val_str != current_val_str)
-            
-            if should_break:
-                if r - 1 > merge_start_row: 
-                    # Merge cells
-                    ws.merge_cells(start_row=merge_start_row, start_column=4, end_row=r-1, end_column=4)
-                    # Giữ nguyên căn chỉnh cho ô đầu tiên sau khi merge
-                    ws.cell(row=merge_start_row, column=4).alignment = Alignment(horizontal='left', vertical='center', wrap_text=True)
-                
-                merge_start_row = r
-                current_val_str = val_str
-                
-    # Merge duplicate "THỜI GIAN GIAO HÀNG" (Column O / 15)
+    # Merge duplicate "TÊN HÀNG" (Column D / 4) and "THỜI GIAN GIAO HÀNG" (Column O / 15)
+    # Giữ nguyên căn chỉnh cho ô đầu tiên sau khi merge
     if products_data:
-        start_row = table_start_row
-        end_row = table_start_row + len(products_data) - 1
-        
-        merge_start_row = start_row
-        current_val = ws.cell(row=start_row, column=15).value
-        
-        for r in range(start_row + 1, end_row + 2):
-            val = ws.cell(row=r, column=15).value if r <= end_row else "SENTINEL"
-            
-            should_break = (val != current_val)
-            
-            if should_break:
-                if r - 1 > merge_start_row:
-                    # Merge cells
-                    ws.merge_cells(start_row=merge_start_row, start_column=15, end_row=r-1, end_column=15)
-                    # Giữ nguyên căn chỉnh cho ô đầu tiên sau khi merge
-                    ws.cell(row=merge_start_row, column=15).alignment = Alignment(horizontal='center', vertical='center', wrap_text=True)
-                
-                merge_start_row = r
-                current_val = val
+        rows = range(table_start_row, table_start_row + len(products_data))
+        merge_runs(ws, table_start_row, [get_cell_content_for_comparison(ws.cell(row=r, column=4)) for r in rows],
+                   {4: align_left})
+        merge_runs(ws, table_start_row, [ws.cell(row=r, column=15).value for r in rows], {15: align_center})
 
-    wb.save(output_path)
+    save_workbook(wb, output_path)
     print(f"Filled template saved to: {output_path}")
 
 @app.get("/generate-production-order/{contract_id}")
-async def generate_production_order_endpoint(contract_id: str):
+async def generate_production_order_endpoint(contract_id: str, preview: PreviewMode = None, response: ResponseFormat = None,
+                                             pdf: bool = False, accept: Annotated[Optional[str], Header()] = None):
     try:
         template_path = os.getenv('PO_TEMPLATE_PATH', 'templates/production_order_template.xlsx')
         if not os.path.exists(template_path):
              # Fallback
              template_path = 'production_order_template.xlsx'
              
+        if preview:
+            return await run_in_threadpool(run_preview, preview, generate_production_order_file, contract_id, template_path)
+
         # Call the UPDATED function directly
-        result = generate_production_order_file(contract_id, template_path)
+        result = await run_in_threadpool(generate_with_pdf, pdf, generate_production_order_file, contract_id, template_path)
+        if wants_file(response, accept):
+            return file_response(result)
         return result
 
     except Exception as e:
@@ -4690,44 +7473,7 @@ async def sync_base_workflow(case_id: str = None):
 
 def expand_case_items_table(ws, template_row, n):
     """Expand the case items table to accommodate n rows"""
-    max_col = ws.max_column
-    row_style = []
-    for col in range(1, max_col + 1):
-        cell = ws.cell(row=template_row, column=col)
-        row_style.append(style_copy(cell._style) if cell.has_style else None)
-    row_height = ws.row_dimensions[template_row].height
-    add_rows = max(0, n - 1)
-    
-    # Handle merged cells
-    merges_to_shift = []
-    for mr in ws.merged_cells.ranges:
-        if mr.min_row > template_row:
-            merges_to_shift.append((mr.min_row, mr.max_row, mr.min_col, mr.max_col))
-    
-    for mr in merges_to_shift:
-        rng = f"{get_column_letter(mr[2])}{mr[0]}:{get_column_letter(mr[3])}{mr[1]}"
-        ws.unmerge_cells(rng)
-    
-    # Insert rows
-    if add_rows > 0:
-        ws.insert_rows(template_row + 1, amount=add_rows)
-        for offset in range(1, add_rows + 1):
-            r = template_row + offset
-            for col in range(1, max_col + 1):
-                dst = ws.cell(row=r, column=col)
-                dst.value = None
-                st = row_style[col - 1]
-                if st is not None:
-                    dst._style = style_copy(st)
-            if row_height is not None:
-                ws.row_dimensions[r].height = row_height
-    
-    # Re-merge shifted cells
-    for mr in merges_to_shift:
-        new_min_row = mr[0] + add_rows
-        new_max_row = mr[1] + add_rows
-        rng = f"{get_column_letter(mr[2])}{new_min_row}:{get_column_letter(mr[3])}{new_max_row}"
-        ws.merge_cells(rng)
+    expand_rows(ws, [(template_row, n)])
 
 
 def generate_case_report(case_id: str, template_path: str):
@@ -4873,18 +7619,8 @@ def generate_case_report(case_id: str, template_path: str):
                      # Better: count actual newlines + wrap
                      text_val = str(richtext_val).replace('\r', '') # richtext str conversion might be simple text
                      
-                     # Simple estimation:
-                     # Split by format-forced newlines
-                     # Also estimate wrapping for long lines (e.g. > 100 chars)
-                     lines = text_val.split('\n')
-                     total_lines = 0
-                     estimated_chars_per_line = 90 # Adjust based on column width in template
-                     
-                     for line in lines:
-                        if len(line) > estimated_chars_per_line:
-                            total_lines += (len(line) // estimated_chars_per_line) + 1
-                        else:
-                            total_lines += 1
+                     # Wrapped lines across the merged content cell
+                     total_lines = text_line_counts(ws, [(cell.row, cell.column)], [text_val])[0]
                      
                      # Set height (minimum 15, add buffer)
                      new_height = max(1, total_lines) * 21 + 15 
@@ -4899,14 +7635,8 @@ def generate_case_report(case_id: str, template_path: str):
     # Finding rows under "PHẢN HỒI TỪ BỘ PHẬN CUNG ỨNG"
     # User feedback: "kéo rộng ra" -> likely means make rows taller.
     
-    supply_header_row = None
-    for row in ws.iter_rows():
-        for cell in row:
-            if isinstance(cell.value, str) and "PHẢN HỒI TỪ BỘ PHẬN CUNG ỨNG" in cell.value:
-                supply_header_row = cell.row
-                break
-        if supply_header_row:
-            break
+    # The product table is not expanded yet, so the template anchor is the sheet row
+    supply_header_row = template_anchors(template_path, ws.title, CASE_ANCHORS)["supply_header"]
             
     if supply_header_row:
         # Expand next 3 rows (Nội dung, Nguyên Nhân, Kết luận)
@@ -4990,29 +7720,24 @@ def generate_case_report(case_id: str, template_path: str):
     
     output_dir = get_output_directory()
     file_path = output_dir / file_name
-    wb.save(str(file_path))
+    data = keep_output(file_path, workbook_bytes(wb, file_name))
     
     # Upload to Salesforce
-    with open(file_path, "rb") as f:
-        data = f.read()
-    encoded = base64.b64encode(data).decode("utf-8")
-    
     try:
-        content_version = sf.ContentVersion.create({
-            "Title": file_name.rsplit(".", 1)[0],
-            "PathOnClient": file_name,
-            "VersionData": encoded,
-            "FirstPublishLocationId": case_id
-        })
+        content_version = publish_content_version(sf, file_name, data, case_id, "Case_")
         cv_id = content_version['id']
+        publish_job_id = content_version.get("publish_job_id")
     except Exception as e:
         print(f"Failed to upload to Salesforce: {e}")
         cv_id = None
+        publish_job_id = None
 
     return {
         "file_path": str(file_path),
         "file_name": file_name,
-        "salesforce_content_version_id": cv_id
+        "salesforce_content_version_id": cv_id,
+        "publish_job_id": publish_job_id,
+        "download_url": download_url(file_name)
     }
 
 
@@ -5277,18 +8002,17 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
         except Exception as e:
             print(f"Error in Photo Integration: {e}")
 
+    # Feedback Section Fixed Height
+    # Label rows come from the template anchors, shifted below the product rows
+    feedback_row = row_mapper([(table_start_row, (len(products_data) if products_data else 1) - 1)] if table_start_row else [])
+    for r in map(feedback_row, template_anchors(template_path, ws.title, CASE_ANCHORS)["feedback_rows"]):
+        ws.row_dimensions[r].height = 100
+
     # Fill Placeholders
     for row in ws.iter_rows():
         for cell in row:
             if cell.value and isinstance(cell.value, str):
                 val = cell.value
-                
-                # Feedback Section Fixed Height
-                val_lower = val.lower()
-                if ("nội dung:" in val_lower or "nguyên nhân:" in val_lower or "kết luận và hướng xử lý:" in val_lower):
-                     row_has_summary = any("{{summary}}" in str(c.value).lower() for c in ws[cell.row] if c.value)
-                     if not row_has_summary:
-                         ws.row_dimensions[cell.row].height = 100
     
                 # SPECIAL: Customer Complain Content
                 if "{{Customer_Complain_Content__c}}" in val:
@@ -5300,11 +8024,7 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
                          cell.alignment = Alignment(wrap_text=True, vertical='top')
                          
                          text_val = str(clean_text)
-                         newlines = text_val.count('\n') + 1
-                         estimated_lines = newlines
-                         
-                         wrapped_lines = sum(1 for line in text_val.split('\n') if len(line) > 90)
-                         estimated_lines += wrapped_lines
+                         estimated_lines = text_line_counts(ws, [(cell.row, cell.column)], [text_val])[0]
                          
                          new_height = max(1, estimated_lines) * 21 + 15
                          ws.row_dimensions[cell.row].height = new_height
@@ -5340,28 +8060,24 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
     file_path = output_dir / file_name
     
     print(f"Saving to local output: {file_path}")
-    wb.save(str(file_path))
+    file_data = keep_output(file_path, workbook_bytes(wb, file_name))
 
     # Upload to Salesforce
     print(f"Uploading to Salesforce for Case: {case_id}")
-    with open(file_path, "rb") as f:
-        file_data = f.read()
-    encoded = base64.b64encode(file_data).decode("utf-8")
-    
     try:
-        content_version = sf.ContentVersion.create({
-            "Title": file_name.rsplit(".", 1)[0],
-            "PathOnClient": file_name,
-            "VersionData": encoded,
-            "FirstPublishLocationId": case_id
-        })
-        print(f"Upload Success! ContentVersion ID: {content_version['id']}")
+        content_version = publish_content_version(sf, file_name, file_data, case_id, "Case_")
+        if content_version["id"]:
+            print(f"Upload Success! ContentVersion ID: {content_version['id']}")
+        else:
+            print(f"Upload queued: {content_version['publish_job_id']}")
         
         return {
             "status": "success",
             "file_path": str(file_path),
             "file_name": file_name,
             "salesforce_content_version_id": content_version["id"],
+            "publish_job_id": content_version.get("publish_job_id"),
+            "download_url": download_url(file_name),
             "message": "Report generated and attached to Case successfully"
         }
     except Exception as e:
@@ -5382,14 +8098,20 @@ def generate_case_report(case_id: str, template_path: str = "templates/case_temp
 
 
 @app.get("/generate-case-report/{case_id}")
-async def generate_case_report_endpoint(case_id: str):
+async def generate_case_report_endpoint(case_id: str, preview: PreviewMode = None, response: ResponseFormat = None,
+                                        pdf: bool = False, accept: Annotated[Optional[str], Header()] = None):
     """Generate Excel report for a Case"""
     try:
         template_path = os.getenv('CASE_TEMPLATE_PATH', 'templates/case_template.xlsx')
         if not os.path.exists(template_path):
              raise HTTPException(status_code=404, detail=f"Template not found: {template_path}")
              
-        result = generate_case_report(case_id, template_path)
+        if preview:
+            return await run_in_threadpool(run_preview, preview, generate_case_report, case_id, template_path)
+
+        result = await run_in_threadpool(generate_with_pdf, pdf, generate_case_report, case_id, template_path)
+        if wants_file(response, accept):
+            return file_response(result)
         return {
             "status": "success",
             "data": result